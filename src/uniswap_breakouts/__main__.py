@@ -5,14 +5,18 @@ import logging
 from typing import Optional
 
 from uniswap_breakouts.config.load import set_chain_resource_config_path, set_position_spec_config_path
-from uniswap_breakouts.report.report_runner import create_position_reports
+from uniswap_breakouts.report.report_runner import create_position_reports, create_position_reports_async
 
 
+# one argument per command line option
+# pylint: disable=too-many-arguments
 def configure_and_run(
     verbose: int,
     chain_config: Optional[str] = None,
     position_config: Optional[str] = None,
     out_file: Optional[str] = None,
+    async_concurrency: Optional[int] = None,
+    workers: Optional[int] = None,
 ) -> None:
     log_verbosity = [logging.ERROR, logging.INFO, logging.DEBUG]
     logging.basicConfig(
@@ -24,7 +28,10 @@ def configure_and_run(
     if position_config is not None:
         set_position_spec_config_path(position_config)
 
-    create_position_reports(out_file)
+    if async_concurrency is not None:
+        create_position_reports_async(out_file, async_concurrency)
+    else:
+        create_position_reports(out_file, workers)
 
 
 parser = ArgumentParser(
@@ -50,6 +57,21 @@ parser.add_argument(
     required=False,
     help='If specified, reports will be output to path specified rather than the default STDOUT',
 )
+concurrency_group = parser.add_mutually_exclusive_group()
+concurrency_group.add_argument(
+    '-a',
+    '--async-concurrency',
+    required=False,
+    type=int,
+    help='If specified, positions are evaluated concurrently with at most this many in flight per chain',
+)
+concurrency_group.add_argument(
+    '-w',
+    '--workers',
+    required=False,
+    type=int,
+    help='If specified, positions are evaluated on worker threads with at most this many in flight per chain',
+)
 parser.add_argument('-v', '--verbose', action='count', default=0)
 
 args = parser.parse_args()
@@ -1,11 +1,17 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from decimal import Decimal
 from typing import Any, List, Optional
 
 from dataclasses_json import DataClassJsonMixin
 from marshmallow import Schema, fields, post_load
 
+# how independent contract calls are batched for a chain. 'multicall' sends them through Multicall3,
+# 'rpc' sends them as a single JSON-RPC batch request and 'none' makes one request per call
+BATCH_MODES = ('multicall', 'rpc', 'none')
 
+
+# pylint: disable=too-many-instance-attributes
+# one attribute per chain config option
 @dataclass(frozen=True)
 class ChainResources:
     name: str
@@ -13,6 +19,15 @@ class ChainResources:
     scanner_api_key: str
     rpc_url: str
     tick_lens_address: Optional[str] = None
+    multicall_address: Optional[str] = None
+    v3_factory_address: Optional[str] = None
+    batch_mode: str = 'multicall'
+    rpc_rate_limit: Optional[float] = None
+    scanner_rate_limit: Optional[float] = None
+
+    def __post_init__(self):
+        if self.batch_mode not in BATCH_MODES:
+            raise ValueError(f"batch mode for chain {self.name} must be one of {BATCH_MODES}")
 
 
 @dataclass(frozen=True)
@@ -66,15 +81,40 @@ class V3SpecSchema(Schema):
         return V3PositionSpec(**data)
 
 
+@dataclass(frozen=True)
+class V3OwnerPositionSpec(DataClassJsonMixin):
+    """
+    Every V3 position a wallet holds in a position manager, enumerated when the report is run
+    """
+
+    chain: str
+    wallet_address: str
+    nft_address: str
+    block_no: Optional[int]
+
+
+class V3OwnerSpecSchema(Schema):
+    chain = fields.String(required=True)
+    wallet_address = fields.String(required=True)
+    nft_address = fields.String(required=True)
+    block_no = fields.Integer(required=False, missing=None)
+
+    @post_load
+    def post_load(self, data: dict, **kwargs: Any) -> V3OwnerPositionSpec:  # pylint: disable=unused-argument
+        return V3OwnerPositionSpec(**data)
+
+
 @dataclass(frozen=True)
 class PositionSpecs:
     v2_positions: List[V2PositionSpec]
     v3_positions: List[V3PositionSpec]
+    v3_owner_positions: List[V3OwnerPositionSpec] = field(default_factory=list)
 
 
 class PositionSpecsSchema(Schema):
     v2_positions = fields.Nested(V2SpecSchema, many=True, missing=[])
     v3_positions = fields.Nested(V3SpecSchema, many=True, missing=[])
+    v3_owner_positions = fields.Nested(V3OwnerSpecSchema, many=True, missing=[])
 
     @post_load
     def post_load(self, data: dict, **kwargs: Any) -> PositionSpecs:  # pylint: disable=unused-argument
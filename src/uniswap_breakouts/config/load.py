@@ -1,4 +1,5 @@
 import logging
+import threading
 from typing import List, Optional
 
 import toml
@@ -14,12 +15,17 @@ chain_resources: Optional[List[ChainResources]] = None
 position_spec_config_path: Optional[str] = None
 position_specs: Optional[PositionSpecs] = None
 
+# the config is loaded lazily by whichever thread first needs it, so loading and setting paths are serialized.
+# reentrant because the getters fall back on setting the path from the environment
+config_lock = threading.RLock()
+
 
 def set_chain_resource_config_path(path: str) -> None:
     global chain_resource_config_path  # pylint: disable=global-statement
-    assert chain_resource_config_path is None, "chain resource config path was already set"
-    logger.info("setting chain resource config file to %s", path)
-    chain_resource_config_path = path
+    with config_lock:
+        assert chain_resource_config_path is None, "chain resource config path was already set"
+        logger.info("setting chain resource config file to %s", path)
+        chain_resource_config_path = path
 
 
 def set_chain_resource_config_path_from_env() -> None:
@@ -34,23 +40,24 @@ def set_chain_resource_config_path_from_env() -> None:
 
 def get_chain_resources() -> List[ChainResources]:
     global chain_resources  # pylint: disable=global-statement
-    if chain_resources is not None:
-        logger.debug("using cached chain resources config")
+    with config_lock:
+        if chain_resources is not None:
+            logger.debug("using cached chain resources config")
+            return chain_resources
+
+        if chain_resource_config_path is None:
+            logger.debug("chain resource config path is not set, attempting to get it from environment")
+            set_chain_resource_config_path_from_env()
+
+        logger.info("loading chain resource config from %s", chain_resource_config_path)
+        assert chain_resource_config_path is not None
+        with open(chain_resource_config_path, encoding='utf-8') as chain_config_file:
+            chain_resource_config = toml.load(chain_config_file)
+
+        chain_resources = [ChainResources(**chain) for chain in chain_resource_config['chains']]
+        logger.debug("chain resource config successfully loaded from %s", chain_resource_config_path)
         return chain_resources
 
-    if chain_resource_config_path is None:
-        logger.debug("chain resource config path is not set, attempting to get it from environment")
-        set_chain_resource_config_path_from_env()
-
-    logger.info("loading chain resource config from %s", chain_resource_config_path)
-    assert chain_resource_config_path is not None
-    with open(chain_resource_config_path, encoding='utf-8') as chain_config_file:
-        chain_resource_config = toml.load(chain_config_file)
-
-    chain_resources = [ChainResources(**chain) for chain in chain_resource_config['chains']]
-    logger.debug("chain resource config successfully loaded from %s", chain_resource_config_path)
-    return chain_resources
-
 
 def get_chain_resource(chain: str) -> ChainResources:
     logger.debug("getting chain resources for %s", chain)
@@ -64,9 +71,10 @@ def get_chain_resource(chain: str) -> ChainResources:
 
 def set_position_spec_config_path(path: str) -> None:
     global position_spec_config_path  # pylint: disable=global-statement
-    assert position_spec_config_path is None, "position spec config path was already set"
-    logger.info("setting position config path to %s", path)
-    position_spec_config_path = path
+    with config_lock:
+        assert position_spec_config_path is None, "position spec config path was already set"
+        logger.info("setting position config path to %s", path)
+        position_spec_config_path = path
 
 
 def set_position_spec_config_path_from_env() -> None:
@@ -83,18 +91,19 @@ def set_position_spec_config_path_from_env() -> None:
 
 def get_position_specs() -> PositionSpecs:
     global position_specs  # pylint: disable=global-statement
-    if position_specs is not None:
-        logger.debug("using cached position config")
-        return position_specs
+    with config_lock:
+        if position_specs is not None:
+            logger.debug("using cached position config")
+            return position_specs
 
-    if position_spec_config_path is None:
-        logger.debug("position spec config path is not set, attempting to get it from environment")
-        set_position_spec_config_path_from_env()
+        if position_spec_config_path is None:
+            logger.debug("position spec config path is not set, attempting to get it from environment")
+            set_position_spec_config_path_from_env()
 
-    logger.info("loading position config from %s", position_spec_config_path)
-    assert position_spec_config_path is not None
-    with open(position_spec_config_path, encoding='utf-8') as position_spec_config_file:
-        position_specs = PositionSpecsSchema().loads(position_spec_config_file.read())
+        logger.info("loading position config from %s", position_spec_config_path)
+        assert position_spec_config_path is not None
+        with open(position_spec_config_path, encoding='utf-8') as position_spec_config_file:
+            position_specs = PositionSpecsSchema().loads(position_spec_config_file.read())
 
-    logger.debug("position config successfully loaded from %s", position_spec_config_path)
-    return position_specs
+        logger.debug("position config successfully loaded from %s", position_spec_config_path)
+        return position_specs
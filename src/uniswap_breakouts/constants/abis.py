@@ -15,3 +15,27 @@ v3_pool_abi_path = Path(__file__).parent / 'v3_pool_abi.json'
 with open(v3_pool_abi_path, encoding='utf-8') as v3_abi_file:
     logger.debug("loading V3 pool contract abi from %s", v3_pool_abi_path)
     V3_POOL_CONTRACT_ABI = json.load(v3_abi_file)
+
+
+multicall3_abi_path = Path(__file__).parent / 'multicall3_abi.json'
+with open(multicall3_abi_path, encoding='utf-8') as multicall3_abi_file:
+    logger.debug("loading Multicall3 contract abi from %s", multicall3_abi_path)
+    MULTICALL3_ABI = json.load(multicall3_abi_file)
+
+
+v3_factory_abi_path = Path(__file__).parent / 'v3_factory_abi.json'
+with open(v3_factory_abi_path, encoding='utf-8') as v3_factory_abi_file:
+    logger.debug("loading V3 factory contract abi from %s", v3_factory_abi_path)
+    V3_FACTORY_CONTRACT_ABI = json.load(v3_factory_abi_file)
+
+
+v2_pair_events_abi_path = Path(__file__).parent / 'v2_pair_events_abi.json'
+with open(v2_pair_events_abi_path, encoding='utf-8') as v2_pair_events_abi_file:
+    logger.debug("loading V2 pair event abis from %s", v2_pair_events_abi_path)
+    V2_PAIR_EVENTS_ABI = json.load(v2_pair_events_abi_file)
+
+
+v3_position_manager_events_abi_path = Path(__file__).parent / 'v3_position_manager_events_abi.json'
+with open(v3_position_manager_events_abi_path, encoding='utf-8') as v3_position_manager_events_abi_file:
+    logger.debug("loading V3 position manager event abis from %s", v3_position_manager_events_abi_path)
+    V3_POSITION_MANAGER_EVENTS_ABI = json.load(v3_position_manager_events_abi_file)
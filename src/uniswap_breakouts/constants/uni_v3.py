@@ -1 +1,8 @@
 TICK_BITMAP_ARRAY_LENGTH = 256
+
+# the factory is deployed at this address on ethereum, arbitrum, optimism and polygon, chains with another
+# deployment set `v3_factory_address` in their chain config
+UNISWAP_V3_FACTORY_ADDRESS = '0x1F98431c8aD98523631AE4a59f267346ea31F984'
+
+# the fee tiers the factory enables, in hundredths of a bip: 0.01%, 0.05%, 0.3% and 1%
+V3_FEE_TIERS = (100, 500, 3000, 10000)
@@ -1,3 +1,6 @@
 from decimal import Decimal
 
 E18 = Decimal(10**18)
+
+# Multicall3 is deployed at the same address on nearly every EVM chain, see https://www.multicall3.com
+MULTICALL3_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
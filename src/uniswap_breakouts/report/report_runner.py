@@ -1,50 +1,186 @@
+import asyncio
+from dataclasses import replace
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal
 import json
 import logging
-from typing import Dict, List, Optional
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, TypeVar, Union
 
+from dataclasses_json import DataClassJsonMixin
 import pandas as pd
 
 from uniswap_breakouts.config.load import get_position_specs, get_chain_resource
-from uniswap_breakouts.uniswap import v2, v3, v3_ticks
+from uniswap_breakouts.config.datatypes import (
+    PositionSpecs,
+    V2PositionSpec,
+    V3OwnerPositionSpec,
+    V3PositionSpec,
+)
+from uniswap_breakouts.constants.uni_v3 import V3_FEE_TIERS
+from uniswap_breakouts.uniswap import v2, v3, v3_owner, v3_pairs, v3_swaps, v3_ticks
+from uniswap_breakouts.uniswap.pool_metadata import get_pool_fee, prewarm_pool_metadata
+from uniswap_breakouts.uniswap.pool_state import prewarm_v3_pool_states
+from uniswap_breakouts.uniswap.v3_depth_matrix import V3DepthMatrix, build_depth_matrix
+from uniswap_breakouts.uniswap.v3_profile import V3LiquidityProfile
+from uniswap_breakouts.utils.call_cache import CALL_CACHING, get_call_cache_stats
+from uniswap_breakouts.utils.web3_utils import pin_block_no
 
 logger = logging.getLogger(__name__)
 
+PositionSpecT = TypeVar('PositionSpecT', V2PositionSpec, V3PositionSpec)
+ItemT = TypeVar('ItemT')
+ResultT = TypeVar('ResultT')
 
-def create_position_reports(out_file: Optional[str]):
-    position_specs = get_position_specs()
-    report_dict: Dict[str, List[Dict[str, dict]]] = {'V2 Positions': [], 'V3 Positions': []}
 
+def prewarm_position_metadata(position_specs: PositionSpecs) -> None:
+    pools_by_chain: Dict[str, List[str]] = {}
     for v2_spec in position_specs.v2_positions:
-        if v2_spec.wallet_address is not None:
-            logger.info("generating v2 position snapshot from wallet: %s", v2_spec.to_dict())
-            v2_position_snapshot = v2.get_underlying_balances_from_address(
-                v2_spec.chain, v2_spec.pool_address, v2_spec.wallet_address, v2_spec.block_no
-            )
-        else:
-            assert v2_spec.lp_balance is not None
-            logger.info("generating v2 position snapshot from lp balance: %s", v2_spec.to_dict())
-            v2_position_snapshot = v2.get_underlying_balances_from_lp_balance(
-                v2_spec.chain, v2_spec.pool_address, v2_spec.lp_balance, v2_spec.block_no
+        pools_by_chain.setdefault(v2_spec.chain, []).append(v2_spec.pool_address)
+    for v3_spec in position_specs.v3_positions:
+        pools_by_chain.setdefault(v3_spec.chain, []).append(v3_spec.pool_address)
+
+    for chain, pool_addresses in pools_by_chain.items():
+        logger.info("prewarming token metadata for %s pools on %s", len(pool_addresses), chain)
+        prewarm_pool_metadata(chain, pool_addresses)
+
+
+def prewarm_position_pool_states(position_specs: PositionSpecs) -> None:
+    """
+    Read the state of every V3 pool the positions are in, one batch per chain and block
+
+    Positions in the same pool and block then share that one read of the pool's price and liquidity. The
+    positions' blocks have to be pinned first.
+    """
+    pools_by_block: Dict[Tuple[str, int], List[str]] = {}
+    for v3_spec in position_specs.v3_positions:
+        assert v3_spec.block_no is not None
+        pools_by_block.setdefault((v3_spec.chain, v3_spec.block_no), []).append(v3_spec.pool_address)
+
+    for (chain, block_no), pool_addresses in pools_by_block.items():
+        logger.info(
+            "prewarming pool state for %s v3 positions on %s at block %s",
+            len(pool_addresses),
+            chain,
+            block_no,
+        )
+        prewarm_v3_pool_states(chain, pool_addresses, block_no)
+
+
+def pin_position_blocks(position_specs: PositionSpecs) -> PositionSpecs:
+    """
+    Pin every position without a block to its chain's head, resolved once per chain for the whole report
+
+    This keeps all the positions on a chain at the same block, which the snapshots then record, and lets
+    their calls be batched and cached like calls at any other block.
+    """
+    chains_to_pin = (
+        {v2_spec.chain for v2_spec in position_specs.v2_positions if v2_spec.block_no is None}
+        | {v3_spec.chain for v3_spec in position_specs.v3_positions if v3_spec.block_no is None}
+        | {
+            owner_spec.chain
+            for owner_spec in position_specs.v3_owner_positions
+            if owner_spec.block_no is None
+        }
+    )
+    head_blocks = {chain: pin_block_no(chain, None) for chain in sorted(chains_to_pin)}
+
+    return PositionSpecs(
+        v2_positions=[
+            v2_spec if v2_spec.block_no is not None else replace(v2_spec, block_no=head_blocks[v2_spec.chain])
+            for v2_spec in position_specs.v2_positions
+        ],
+        v3_positions=[
+            v3_spec if v3_spec.block_no is not None else replace(v3_spec, block_no=head_blocks[v3_spec.chain])
+            for v3_spec in position_specs.v3_positions
+        ],
+        v3_owner_positions=[
+            (
+                owner_spec
+                if owner_spec.block_no is not None
+                else replace(owner_spec, block_no=head_blocks[owner_spec.chain])
             )
+            for owner_spec in position_specs.v3_owner_positions
+        ],
+    )
+
 
-        report_dict['V2 Positions'].append(
-            {'position_spec': v2_spec.to_dict(), 'position_breakdown': v2_position_snapshot.to_dict()}
+def v2_position_snapshot(v2_spec: V2PositionSpec) -> v2.V2LiquiditySnapshot:
+    if v2_spec.wallet_address is not None:
+        logger.info("generating v2 position snapshot from wallet: %s", v2_spec.to_dict())
+        return v2.get_underlying_balances_from_address(
+            v2_spec.chain, v2_spec.pool_address, v2_spec.wallet_address, v2_spec.block_no
         )
 
-    for v3_spec in position_specs.v3_positions:
-        logger.info("generating v3 snapshot: %s", v3_spec)
-        v3_position_snapshot = v3.get_underlying_balances(
-            v3_spec.chain,
-            v3_spec.pool_address,
-            v3_spec.nft_address,
-            v3_spec.nft_address,
-            v3_spec.nft_id,
-            v3_spec.block_no,
+    assert v2_spec.lp_balance is not None
+    logger.info("generating v2 position snapshot from lp balance: %s", v2_spec.to_dict())
+    return v2.get_underlying_balances_from_lp_balance(
+        v2_spec.chain, v2_spec.pool_address, v2_spec.lp_balance, v2_spec.block_no
+    )
+
+
+def v3_position_snapshot(v3_spec: V3PositionSpec) -> v3.V3LiquiditySnapshot:
+    logger.info("generating v3 snapshot: %s", v3_spec)
+    return v3.get_underlying_balances(
+        v3_spec.chain,
+        v3_spec.pool_address,
+        v3_spec.nft_address,
+        v3_spec.nft_address,
+        v3_spec.nft_id,
+        v3_spec.block_no,
+    )
+
+
+async def async_v2_position_snapshot(v2_spec: V2PositionSpec) -> v2.V2LiquiditySnapshot:
+    if v2_spec.wallet_address is not None:
+        logger.info("generating v2 position snapshot from wallet: %s", v2_spec.to_dict())
+        return await v2.async_get_underlying_balances_from_address(
+            v2_spec.chain, v2_spec.pool_address, v2_spec.wallet_address, v2_spec.block_no
         )
-        report_dict['V3 Positions'].append(
-            {'position_spec': v3_spec.to_dict(), 'position_breakdown': v3_position_snapshot.to_dict()}
+
+    assert v2_spec.lp_balance is not None
+    logger.info("generating v2 position snapshot from lp balance: %s", v2_spec.to_dict())
+    return await v2.async_get_underlying_balances_from_lp_balance(
+        v2_spec.chain, v2_spec.pool_address, v2_spec.lp_balance, v2_spec.block_no
+    )
+
+
+async def async_v3_position_snapshot(v3_spec: V3PositionSpec) -> v3.V3LiquiditySnapshot:
+    logger.info("generating v3 snapshot: %s", v3_spec)
+    return await v3.async_get_underlying_balances(
+        v3_spec.chain,
+        v3_spec.pool_address,
+        v3_spec.nft_address,
+        v3_spec.nft_address,
+        v3_spec.nft_id,
+        v3_spec.block_no,
+    )
+
+
+def v3_owner_report_entries(owner_spec: V3OwnerPositionSpec) -> List[Dict[str, dict]]:
+    """
+    Report entries for every position a wallet holds, each with the V3 position spec that would evaluate it
+    """
+    logger.info("generating v3 snapshots for every position owned by: %s", owner_spec)
+    return [
+        position_report_entry(v3_spec, v3_snapshot)
+        for v3_spec, v3_snapshot in v3_owner.get_owner_underlying_balances(
+            owner_spec.chain, owner_spec.wallet_address, owner_spec.nft_address, owner_spec.block_no
         )
+    ]
+
+
+def position_report_entry(
+    position_spec: Union[V2PositionSpec, V3PositionSpec],
+    position_snapshot: DataClassJsonMixin,
+) -> Dict[str, dict]:
+    return {'position_spec': position_spec.to_dict(), 'position_breakdown': position_snapshot.to_dict()}
+
+
+def write_position_report(report_dict: Dict[str, List[Dict[str, dict]]], out_file: Optional[str]) -> None:
+    if CALL_CACHING:
+        call_cache_stats = get_call_cache_stats()
+        logger.info("call cache hits: %s | misses: %s", call_cache_stats.hits, call_cache_stats.misses)
 
     if out_file is not None:
         with open(out_file, 'w', encoding='utf-8') as report_output_file:
@@ -53,6 +189,196 @@ def create_position_reports(out_file: Optional[str]):
         print(json.dumps(report_dict, indent=2, default=str))
 
 
+def map_on_chain_executors(
+    items: Sequence[ItemT],
+    item_chain: Callable[[ItemT], str],
+    evaluate: Callable[[ItemT], ResultT],
+    workers_per_chain: int,
+) -> List[ResultT]:
+    """
+    Evaluate items on thread pools, with at most `workers_per_chain` items in flight per chain
+
+    Items are grouped by chain and each chain gets its own pool, so a slow rpc provider only holds up
+    the items on its chain. Results are written back by their item's index, which keeps them in the order of
+    the items no matter which finish first.
+    """
+    item_indices_by_chain: Dict[str, List[int]] = {}
+    for i, item in enumerate(items):
+        item_indices_by_chain.setdefault(item_chain(item), []).append(i)
+
+    results: List[Optional[ResultT]] = [None] * len(items)
+    executors = [
+        ThreadPoolExecutor(max_workers=min(workers_per_chain, len(item_indices)), thread_name_prefix=chain)
+        for chain, item_indices in item_indices_by_chain.items()
+    ]
+    try:
+        futures = {
+            executor.submit(evaluate, items[i]): i
+            for executor, item_indices in zip(executors, item_indices_by_chain.values())
+            for i in item_indices
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    finally:
+        for executor in executors:
+            executor.shutdown(cancel_futures=True)
+
+    return [result for result in results if result is not None]
+
+
+def threaded_position_report_entries(
+    position_specs: Sequence[PositionSpecT],
+    position_snapshot: Callable[[PositionSpecT], DataClassJsonMixin],
+    workers_per_chain: int,
+) -> List[Dict[str, dict]]:
+    """
+    Evaluate positions on per chain thread pools, with the report entries in config order
+    """
+    return map_on_chain_executors(
+        position_specs,
+        lambda position_spec: position_spec.chain,
+        lambda position_spec: position_report_entry(position_spec, position_snapshot(position_spec)),
+        workers_per_chain,
+    )
+
+
+def threaded_v2_snapshots(
+    v2_specs: Sequence[V2PositionSpec], workers_per_chain: int
+) -> List[v2.V2LiquiditySnapshot]:
+    """
+    Threaded equivalent of `v2.get_underlying_balances_for_specs`, with the batch of each chain, pool and
+    block on its chain's thread pool
+
+    The specs' blocks have to be pinned already. Snapshots come back in spec order.
+    """
+    groups = list(v2.group_v2_specs(v2_specs).items())
+    group_snapshots = map_on_chain_executors(
+        groups,
+        lambda group: group[0][0],
+        lambda group: v2.get_underlying_balances_for_group(v2_specs, *group),
+        workers_per_chain,
+    )
+
+    snapshots: List[Optional[v2.V2LiquiditySnapshot]] = [None] * len(v2_specs)
+    for (_, spec_indices), snapshots_of_group in zip(groups, group_snapshots):
+        for i, snapshot in zip(spec_indices, snapshots_of_group):
+            snapshots[i] = snapshot
+    return [snapshot for snapshot in snapshots if snapshot is not None]
+
+
+def create_position_reports(out_file: Optional[str], workers: Optional[int] = None):
+    """
+    Generate the report for every position in the position config
+
+    V2 positions are evaluated together, with one batch of calls per pool and block. The V2 batches and the
+    V3 positions are evaluated one at a time unless `workers` is set, in which case they are evaluated on
+    thread pools with at most that many V2 batches or V3 positions in flight per chain. The report is in
+    config order either way.
+    """
+    if workers is not None and workers < 1:
+        raise ValueError(f"workers must be at least 1, got {workers}")
+
+    position_specs = pin_position_blocks(get_position_specs())
+    prewarm_position_metadata(position_specs)
+    prewarm_position_pool_states(position_specs)
+    report_dict: Dict[str, List[Dict[str, dict]]] = {'V2 Positions': [], 'V3 Positions': []}
+
+    logger.info("generating %s v2 position snapshots grouped by pool", len(position_specs.v2_positions))
+    v2_snapshots = (
+        threaded_v2_snapshots(position_specs.v2_positions, workers)
+        if workers is not None
+        else v2.get_underlying_balances_for_specs(position_specs.v2_positions)
+    )
+    report_dict['V2 Positions'] = [
+        position_report_entry(v2_spec, v2_snapshot)
+        for v2_spec, v2_snapshot in zip(position_specs.v2_positions, v2_snapshots)
+    ]
+
+    if workers is not None:
+        report_dict['V3 Positions'] = threaded_position_report_entries(
+            position_specs.v3_positions, v3_position_snapshot, workers
+        )
+    else:
+        for v3_spec in position_specs.v3_positions:
+            report_dict['V3 Positions'].append(position_report_entry(v3_spec, v3_position_snapshot(v3_spec)))
+
+    # each wallet's positions are already evaluated in a few batches
+    for owner_spec in position_specs.v3_owner_positions:
+        report_dict['V3 Positions'].extend(v3_owner_report_entries(owner_spec))
+
+    write_position_report(report_dict, out_file)
+
+
+async def async_position_report_entries(
+    position_specs: PositionSpecs, concurrency_per_chain: int
+) -> Dict[str, List[Dict[str, dict]]]:
+    """
+    Evaluate every position concurrently, with at most `concurrency_per_chain` positions in flight per chain
+
+    `asyncio.gather` returns results in the order its awaitables were passed, so the report entries come
+    back in config order no matter which positions finish first.
+    """
+    chain_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def chain_semaphore(chain: str) -> asyncio.Semaphore:
+        if chain not in chain_semaphores:
+            chain_semaphores[chain] = asyncio.Semaphore(concurrency_per_chain)
+        return chain_semaphores[chain]
+
+    async def v2_entry(v2_spec: V2PositionSpec) -> Dict[str, dict]:
+        async with chain_semaphore(v2_spec.chain):
+            return position_report_entry(v2_spec, await async_v2_position_snapshot(v2_spec))
+
+    async def v3_entry(v3_spec: V3PositionSpec) -> Dict[str, dict]:
+        async with chain_semaphore(v3_spec.chain):
+            return position_report_entry(v3_spec, await async_v3_position_snapshot(v3_spec))
+
+    async def v3_owner_entries(owner_spec: V3OwnerPositionSpec) -> List[Dict[str, dict]]:
+        async with chain_semaphore(owner_spec.chain):
+            return await asyncio.to_thread(v3_owner_report_entries, owner_spec)
+
+    v2_entries, v3_entries, v3_owner_entry_lists = await asyncio.gather(
+        asyncio.gather(*[v2_entry(v2_spec) for v2_spec in position_specs.v2_positions]),
+        asyncio.gather(*[v3_entry(v3_spec) for v3_spec in position_specs.v3_positions]),
+        asyncio.gather(*[v3_owner_entries(owner_spec) for owner_spec in position_specs.v3_owner_positions]),
+    )
+    return {
+        'V2 Positions': list(v2_entries),
+        'V3 Positions': list(v3_entries) + [entry for entries in v3_owner_entry_lists for entry in entries],
+    }
+
+
+def create_position_reports_async(out_file: Optional[str], concurrency_per_chain: int):
+    """
+    Same report as `create_position_reports`, with the positions evaluated concurrently on an event loop
+
+    Nearly all of the time spent on a report is waiting on the network, so overlapping the requests of many
+    positions is much faster than evaluating them one at a time. The concurrency limit is per chain so that
+    a large report does not flood any single rpc provider.
+    """
+    if concurrency_per_chain < 1:
+        raise ValueError(f"async concurrency must be at least 1, got {concurrency_per_chain}")
+
+    position_specs = pin_position_blocks(get_position_specs())
+    prewarm_position_metadata(position_specs)
+    prewarm_position_pool_states(position_specs)
+    report_dict = asyncio.run(async_position_report_entries(position_specs, concurrency_per_chain))
+    write_position_report(report_dict, out_file)
+
+
+def resolve_tick_lens_address(chain: str, pool_address: str, tick_lens_address: Optional[str]) -> str:
+    if tick_lens_address is None:
+        chain_resource = get_chain_resource(chain)
+        tick_lens_address = chain_resource.tick_lens_address
+
+        if tick_lens_address is None:
+            logger.error("No tick lens address for pool: %s - %s", chain, pool_address)
+            raise ValueError(f"Missing Tick Lens address for chain {chain}")
+    return tick_lens_address
+
+
+# pylint: disable=too-many-arguments
+# keyword only arguments describing the pool and the snapshot to take
 def create_liquidity_df(
     *,
     chain: str,
@@ -60,14 +386,9 @@ def create_liquidity_df(
     depth: Decimal,
     tick_lens_address: Optional[str] = None,
     block_no: Optional[int] = None,
+    exact: bool = False,
 ) -> pd.DataFrame:
-    if tick_lens_address is None:
-        chain_resource = get_chain_resource(chain)
-        tick_lens_address = chain_resource.tick_lens_address
-
-        if tick_lens_address is None:
-            logger.error("No tick lens address for pool: %s - %s", chain, pool_address)
-            raise ValueError(f"Missing Tick Lens address for chain {chain}")
+    tick_lens_address = resolve_tick_lens_address(chain, pool_address, tick_lens_address)
 
     logger.debug("generating liquidity snapshot for pool: %s - %s", chain, pool_address)
     liquidity_snapshot = v3_ticks.get_tick_liquidity_info_for_pool(
@@ -75,6 +396,102 @@ def create_liquidity_df(
     )
 
     logger.debug("generating tick liquidity dataframe for pool: %s - %s", chain, pool_address)
-    liquidity_df = v3_ticks.make_tick_liquidity_df(liquidity_snapshot, depth)
+    liquidity_df = v3_ticks.make_tick_liquidity_df(liquidity_snapshot, depth, exact)
 
     return liquidity_df
+
+
+# pylint: disable=too-many-arguments
+# keyword only arguments describing the pair, its fee tiers and the snapshots to take
+def create_pair_liquidity_df(
+    *,
+    chain: str,
+    token_a: str,
+    token_b: str,
+    depth: Decimal,
+    fee_tiers: Sequence[int] = V3_FEE_TIERS,
+    tick_lens_address: Optional[str] = None,
+    block_no: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Build one tick liquidity dataframe for a token pair, combining its pools in every fee tier
+
+    The pools are found through the factory and snapshotted concurrently at the same block, then merged onto
+    a common grid of ticks, see `v3_pairs.make_pair_liquidity_df`.
+    """
+    pair = f'{token_a}/{token_b}'
+    tick_lens_address = resolve_tick_lens_address(chain, pair, tick_lens_address)
+    block_no = pin_block_no(chain, block_no)
+
+    pool_addresses = v3_pairs.get_pair_pools(chain, token_a, token_b, fee_tiers, block_no)
+    if not pool_addresses:
+        raise ValueError(f"no V3 pools for pair {chain} - {pair} in fee tiers {list(fee_tiers)}")
+
+    logger.debug("generating liquidity snapshots for pools of pair %s - %s: %s", chain, pair, pool_addresses)
+    liquidity_snapshots = v3_pairs.get_pair_tick_liquidity_snapshots(
+        chain, pool_addresses, tick_lens_address, depth, block_no
+    )
+
+    logger.debug("generating pair liquidity dataframe for pair: %s - %s", chain, pair)
+    return v3_pairs.make_pair_liquidity_df(liquidity_snapshots, depth)
+
+
+def create_liquidity_profile(
+    *,
+    chain: str,
+    pool_address: str,
+    depth: Decimal,
+    tick_lens_address: Optional[str] = None,
+    block_no: Optional[int] = None,
+) -> V3LiquidityProfile:
+    """
+    Seed a liquidity profile that can be advanced from the pool's events, rather than snapshotting the whole
+    profile again for every block of interest
+    """
+    tick_lens_address = resolve_tick_lens_address(chain, pool_address, tick_lens_address)
+    logger.debug("seeding liquidity profile for pool: %s - %s", chain, pool_address)
+    return V3LiquidityProfile.from_pool(chain, pool_address, tick_lens_address, depth, block_no)
+
+
+# pylint: disable=too-many-arguments
+# keyword only arguments describing the pool, the blocks and where to store the matrix
+def create_liquidity_depth_matrix(
+    *,
+    chain: str,
+    pool_address: str,
+    depth: Decimal,
+    blocks: Sequence[int],
+    out_dir: Union[str, Path],
+    tick_lens_address: Optional[str] = None,
+) -> V3DepthMatrix:
+    tick_lens_address = resolve_tick_lens_address(chain, pool_address, tick_lens_address)
+    logger.debug("generating liquidity depth matrix for pool: %s - %s", chain, pool_address)
+    return build_depth_matrix(chain, pool_address, tick_lens_address, depth, blocks, out_dir)
+
+
+# pylint: disable=too-many-arguments
+# keyword only arguments describing the pool, the snapshot to take and the impacts to size
+def create_price_impact_ladder(
+    *,
+    chain: str,
+    pool_address: str,
+    depth: Decimal,
+    price_impacts: Sequence[float],
+    tick_lens_address: Optional[str] = None,
+    block_no: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Size the swaps that move a pool's price by each of `price_impacts`, from a single tick liquidity snapshot
+
+    `depth` has to reach past the largest impact, impacts beyond it come out as NaN.
+    """
+    tick_lens_address = resolve_tick_lens_address(chain, pool_address, tick_lens_address)
+
+    logger.debug("generating price impact ladder for pool: %s - %s", chain, pool_address)
+    liquidity_snapshot = v3_ticks.get_tick_liquidity_info_for_pool(
+        chain, pool_address, tick_lens_address, depth, block_no
+    )
+    liquidity_df = v3_ticks.make_tick_liquidity_df(liquidity_snapshot, depth)
+    return v3_swaps.get_price_impact_ladder(
+        liquidity_df, liquidity_snapshot, price_impacts, get_pool_fee(chain, pool_address)
+    )
@@ -0,0 +1,201 @@
+import json
+import logging
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from uniswap_breakouts.constants.abis import TOKEN_CONTRACT_ABI, V3_POOL_CONTRACT_ABI
+from uniswap_breakouts.uniswap.uniswap_utils import PoolToken
+from uniswap_breakouts.utils.batch_calls import contract_calls_at_block
+from uniswap_breakouts.utils.env_utils import get_env_variable
+from uniswap_breakouts.utils.sqlite_store import SqliteStore
+from uniswap_breakouts.utils.web3_utils import ContractCall, find_creation_block
+
+logger = logging.getLogger(__name__)
+
+
+METADATA_CACHING = False
+try:
+    metadata_caching_env_var = get_env_variable("METADATA_CACHING")
+    if metadata_caching_env_var == 'TRUE':
+        logger.info("Pool metadata caching has been Enabled")
+        METADATA_CACHING = True
+except ValueError:
+    pass
+
+
+# pool tokens, token decimals and symbols, a V3 pool's tick spacing and fee and the block a pool was created
+# in are fixed once a contract is deployed, so once we have seen them we never need to request them again.
+# Entries are held in memory for the run and, when metadata caching is on, in a persistent store shared
+# between runs
+pool_metadata: Dict[str, Any] = {}
+metadata_store: Optional[SqliteStore] = None
+metadata_lock = threading.Lock()
+
+
+def get_metadata_store() -> SqliteStore:
+    global metadata_store  # pylint: disable=global-statement
+    with metadata_lock:
+        if metadata_store is None:
+            cache_path = get_env_variable("METADATA_CACHE_PATH")
+            logger.debug("opening pool metadata cache at %s", cache_path)
+            metadata_store = SqliteStore(cache_path, 'pool_metadata')
+        return metadata_store
+
+
+def pool_tokens_key(chain: str, pool_address: str) -> str:
+    return f"pool_tokens:{chain}:{pool_address.lower()}"
+
+
+def token_key(chain: str, token_address: str) -> str:
+    return f"token:{chain}:{token_address.lower()}"
+
+
+def tick_spacing_key(chain: str, pool_address: str) -> str:
+    return f"tick_spacing:{chain}:{pool_address.lower()}"
+
+
+def fee_key(chain: str, pool_address: str) -> str:
+    return f"fee:{chain}:{pool_address.lower()}"
+
+
+def creation_block_key(chain: str, pool_address: str) -> str:
+    return f"creation_block:{chain}:{pool_address.lower()}"
+
+
+def get_metadata(key: str) -> Any:
+    if key in pool_metadata:
+        return pool_metadata[key]
+    if METADATA_CACHING:
+        stored_value = get_metadata_store().get(key)
+        if stored_value is not None:
+            pool_metadata[key] = json.loads(stored_value)
+            return pool_metadata[key]
+    return None
+
+
+def put_metadata(key: str, value: Any) -> None:
+    pool_metadata[key] = value
+    if METADATA_CACHING:
+        get_metadata_store().put(key, json.dumps(value).encode('utf-8'))
+
+
+def prewarm_pool_metadata(
+    chain: str, pool_addresses: Iterable[str], v3_pool_addresses: Iterable[str] = ()
+) -> None:
+    """
+    Load the token metadata for many pools, and the tick spacing and fee for V3 pools, in as few requests as
+    possible
+
+    Everything already in the registry is skipped. The remaining pools' token addresses, tick spacings and
+    fees are requested in one batch, then the decimals and symbols of every token not yet seen in a second
+    one.
+    `token0` and `token1` have the same signature on V2 pairs and V3 pools, so the V3 pool abi is used for
+    both and no abi has to be requested from the block scanner.
+    """
+    unique_pool_addresses = {pool.lower() for pool in pool_addresses}
+    missing_pools = sorted(
+        pool for pool in unique_pool_addresses if get_metadata(pool_tokens_key(chain, pool)) is None
+    )
+    missing_v3_pools = sorted(
+        {
+            pool.lower()
+            for pool in v3_pool_addresses
+            if get_metadata(tick_spacing_key(chain, pool)) is None
+            or get_metadata(fee_key(chain, pool)) is None
+        }
+    )
+    if missing_pools or missing_v3_pools:
+        logger.debug(
+            "requesting metadata for %s pools on %s", len(missing_pools) + len(missing_v3_pools), chain
+        )
+
+    pool_calls = [
+        ContractCall(pool, pool, fn_name, [], V3_POOL_CONTRACT_ABI)
+        for pool in missing_pools
+        for fn_name in ('token0', 'token1')
+    ] + [
+        ContractCall(pool, pool, fn_name, [], V3_POOL_CONTRACT_ABI)
+        for pool in missing_v3_pools
+        for fn_name in ('tickSpacing', 'fee')
+    ]
+    pool_results = contract_calls_at_block(chain, pool_calls)
+
+    for i, pool in enumerate(missing_pools):
+        put_metadata(pool_tokens_key(chain, pool), pool_results[2 * i : 2 * i + 2])
+    v3_pool_results = pool_results[2 * len(missing_pools) :]
+    for i, pool in enumerate(missing_v3_pools):
+        tick_spacing, fee = v3_pool_results[2 * i : 2 * i + 2]
+        put_metadata(tick_spacing_key(chain, pool), int(tick_spacing))
+        put_metadata(fee_key(chain, pool), int(fee))
+
+    prewarm_token_metadata(
+        chain,
+        [token for pool in unique_pool_addresses for token in get_metadata(pool_tokens_key(chain, pool))],
+    )
+
+
+def prewarm_token_metadata(chain: str, token_addresses: Iterable[str]) -> None:
+    missing_tokens = sorted(
+        {token for token in token_addresses if get_metadata(token_key(chain, token)) is None}
+    )
+    token_results = contract_calls_at_block(
+        chain,
+        [
+            ContractCall(token, token, fn_name, [], TOKEN_CONTRACT_ABI)
+            for token in missing_tokens
+            for fn_name in ('decimals', 'symbol')
+        ],
+    )
+    for i, token in enumerate(missing_tokens):
+        token_decimals, token_symbol = token_results[2 * i : 2 * i + 2]
+        put_metadata(
+            token_key(chain, token),
+            {'address': token, 'symbol': token_symbol, 'decimals': int(token_decimals)},
+        )
+
+
+def get_pool_tokens(chain: str, pool_address: str) -> Tuple[PoolToken, PoolToken]:
+    """
+    Get both tokens of a V2 or V3 pool through the metadata registry, requesting them only on first use
+    """
+    prewarm_pool_metadata(chain, [pool_address])
+
+    token_addresses = get_metadata(pool_tokens_key(chain, pool_address))
+    pool_tokens = []
+    for token_index, token_address in enumerate(token_addresses):
+        token_metadata = get_metadata(token_key(chain, token_address))
+        pool_tokens.append(
+            PoolToken(
+                token_index, token_metadata['address'], token_metadata['symbol'], token_metadata['decimals']
+            )
+        )
+
+    logger.debug("pool tokens for %s - %s: %s, %s", chain, pool_address, pool_tokens[0], pool_tokens[1])
+    return pool_tokens[0], pool_tokens[1]
+
+
+def get_v3_pool_metadata(chain: str, pool_address: str, key: str) -> Any:
+    if get_metadata(key) is None:
+        prewarm_pool_metadata(chain, [], [pool_address])
+    return get_metadata(key)
+
+
+def get_tick_spacing(chain: str, pool_address: str) -> int:
+    return int(get_v3_pool_metadata(chain, pool_address, tick_spacing_key(chain, pool_address)))
+
+
+def get_pool_fee(chain: str, pool_address: str) -> int:
+    """
+    Get a V3 pool's fee, in hundredths of a bip
+    """
+    return int(get_v3_pool_metadata(chain, pool_address, fee_key(chain, pool_address)))
+
+
+def get_pool_creation_block(chain: str, pool_address: str, block_no: int) -> int:
+    """
+    Get the block a pool was created in through the metadata registry, `block_no` is any block after it
+    """
+    key = creation_block_key(chain, pool_address)
+    if get_metadata(key) is None:
+        put_metadata(key, find_creation_block(chain, pool_address, block_no))
+    return int(get_metadata(key))
@@ -0,0 +1,130 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import logging
+import threading
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from uniswap_breakouts.constants.abis import V3_POOL_CONTRACT_ABI
+from uniswap_breakouts.uniswap.pool_metadata import get_pool_tokens, get_tick_spacing, prewarm_pool_metadata
+from uniswap_breakouts.uniswap.uniswap_utils import PoolToken
+from uniswap_breakouts.utils.batch_calls import contract_calls_at_block
+from uniswap_breakouts.utils.web3_utils import ContractCall, pin_block_no
+
+logger = logging.getLogger(__name__)
+
+# number of pool states kept in memory, each one is a few ints and the pool's tokens
+POOL_STATE_CACHE_SIZE = 4096
+
+
+# pylint: disable=too-many-instance-attributes
+# the pool's price, liquidity and metadata at one block
+@dataclass(frozen=True)
+class V3PoolState:
+    chain: str
+    pool_address: str
+    block: int
+    sqrt_price_x96: int
+    tick: int
+    liquidity: int
+    tick_spacing: int
+    token0: PoolToken
+    token1: PoolToken
+
+    @property
+    def tokens(self) -> Tuple[PoolToken, PoolToken]:
+        return self.token0, self.token1
+
+
+# the state of a pool at a pinned block never changes, so every position and tick profile on the same pool and
+# block in a run can share one read of it. Entries are keyed by (chain, pool, block) and held in a bounded LRU
+pool_states: 'OrderedDict[Tuple[str, str, int], V3PoolState]' = OrderedDict()
+pool_states_lock = threading.Lock()
+
+
+def pool_state_key(chain: str, pool_address: str, block_no: int) -> Tuple[str, str, int]:
+    return chain, pool_address.lower(), block_no
+
+
+def get_cached_pool_state(chain: str, pool_address: str, block_no: int) -> Optional[V3PoolState]:
+    key = pool_state_key(chain, pool_address, block_no)
+    with pool_states_lock:
+        pool_state = pool_states.get(key)
+        if pool_state is not None:
+            pool_states.move_to_end(key)
+        return pool_state
+
+
+def put_pool_state(pool_state: V3PoolState) -> None:
+    with pool_states_lock:
+        pool_states[pool_state_key(pool_state.chain, pool_state.pool_address, pool_state.block)] = pool_state
+        while len(pool_states) > POOL_STATE_CACHE_SIZE:
+            pool_states.popitem(last=False)
+
+
+def read_v3_pool_states(chain: str, pool_addresses: Sequence[str], block_no: int) -> List[V3PoolState]:
+    """
+    Read the state of many V3 pools at a block and add them to the cache
+
+    The metadata of the pools comes from the registry, then the price and active liquidity of all of them are
+    requested in a single batch.
+    """
+    logger.debug("reading state of %s V3 pools on %s at block %s", len(pool_addresses), chain, block_no)
+    prewarm_pool_metadata(chain, [], pool_addresses)
+    results = contract_calls_at_block(
+        chain,
+        [
+            ContractCall(pool_address, pool_address, fn_name, [], V3_POOL_CONTRACT_ABI)
+            for pool_address in pool_addresses
+            for fn_name in ('slot0', 'liquidity')
+        ],
+        block_no,
+    )
+
+    read_pool_states = []
+    for i, pool_address in enumerate(pool_addresses):
+        slot0_result, liquidity = results[2 * i], results[2 * i + 1]
+        token0, token1 = get_pool_tokens(chain, pool_address)
+        pool_state = V3PoolState(
+            chain=chain,
+            pool_address=pool_address,
+            block=block_no,
+            sqrt_price_x96=int(slot0_result[0]),
+            tick=int(slot0_result[1]),
+            liquidity=int(liquidity),
+            tick_spacing=get_tick_spacing(chain, pool_address),
+            token0=token0,
+            token1=token1,
+        )
+        put_pool_state(pool_state)
+        read_pool_states.append(pool_state)
+    return read_pool_states
+
+
+def prewarm_v3_pool_states(chain: str, pool_addresses: Iterable[str], block_no: int) -> None:
+    """
+    Read the state of every pool not yet in the cache in one batch, so later lookups are all hits
+    """
+    missing_pools = list(
+        dict.fromkeys(
+            pool_address
+            for pool_address in pool_addresses
+            if get_cached_pool_state(chain, pool_address, block_no) is None
+        )
+    )
+    if missing_pools:
+        read_v3_pool_states(chain, missing_pools, block_no)
+
+
+def get_v3_pool_state(chain: str, pool_address: str, block_no: Optional[int] = None) -> V3PoolState:
+    """
+    Get a V3 pool's price, active liquidity, tick spacing and tokens at a block, reading the pool at most once
+    per block in a run
+
+    A missing block is pinned to the chain's head first, so the state is cached against the block it was
+    read at.
+    """
+    block_no = pin_block_no(chain, block_no)
+    pool_state = get_cached_pool_state(chain, pool_address, block_no)
+    if pool_state is None:
+        pool_state = read_v3_pool_states(chain, [pool_address], block_no)[0]
+    return pool_state
@@ -1,13 +1,27 @@
-from dataclasses import dataclass
+import asyncio
+from dataclasses import dataclass, replace
 from decimal import Decimal
 import logging
-from typing import Optional
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 from dataclasses_json import DataClassJsonMixin
 
+from uniswap_breakouts.config.datatypes import V2PositionSpec
 from uniswap_breakouts.constants.w3 import E18
-from uniswap_breakouts.uniswap.uniswap_utils import PoolToken, get_pool_token_info
-from uniswap_breakouts.utils.web3_utils import contract_call_at_block
+from uniswap_breakouts.uniswap.pool_metadata import get_pool_tokens
+from uniswap_breakouts.uniswap.uniswap_utils import PoolToken
+from uniswap_breakouts.utils.async_web3_utils import (
+    async_contract_call_at_block,
+    async_contract_calls_at_block,
+    async_pin_block_no,
+)
+from uniswap_breakouts.utils.batch_calls import contract_calls_at_block
+from uniswap_breakouts.utils.web3_utils import (
+    ContractCall,
+    contract_call_at_block,
+    pin_block_no,
+    to_checksum_address,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +51,7 @@ def get_underlying_balances_from_address(
     and then feeds it into the function that does the math. We separate these because we often
     have to get the balance from a different source (i.e. staking contract)
     """
+    block_no = pin_block_no(chain, block_no)
     logger.debug(
         "requesting underlying LP balances for wallet %s in V2 pool %s",
         wallet_address,
@@ -61,6 +76,89 @@ def get_underlying_balances_from_address(
     return get_underlying_balances_from_lp_balance(chain, pool_address, wallet_lp_balance, block_no)
 
 
+def pool_state_calls(pool_address: str) -> List[ContractCall]:
+    return [
+        ContractCall(pool_address, pool_address, 'totalSupply', []),
+        ContractCall(pool_address, pool_address, 'getReserves', []),
+    ]
+
+
+def pool_state_values(
+    pool_tokens: Tuple[PoolToken, PoolToken], pool_state_results: Sequence[Any]
+) -> Tuple[Decimal, Decimal, Decimal]:
+    """
+    The decimal adjusted total LP supply and reserves of both tokens, from the results of `pool_state_calls`
+    """
+    token0, token1 = pool_tokens
+    pool_total_supply_result, reserves_result = pool_state_results
+    return (
+        Decimal(pool_total_supply_result) / E18,
+        Decimal(reserves_result[0]) / Decimal(10**token0.decimals),
+        Decimal(reserves_result[1]) / Decimal(10**token1.decimals),
+    )
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+# the snapshots need the positions, the pool tokens and both pool state results
+def snapshots_from_pool_state(
+    chain: str,
+    pool_address: str,
+    wallet_lp_balances: Sequence[Decimal],
+    block_no: Optional[int],
+    pool_tokens: Tuple[PoolToken, PoolToken],
+    pool_state_results: Sequence[Any],
+) -> List[V2LiquiditySnapshot]:
+    """
+    Apply LP balances to the pool's total supply and reserves to find each one's claim on the underlyings
+
+    This is the pure math shared by the sync, async and batched breakdowns, `pool_state_results` are the
+    results of the `pool_state_calls` for the pool. The pool state is converted once for all the balances.
+    """
+
+    def pool_str() -> str:
+        return pool_string(chain, pool_address, block_no)
+
+    token0, token1 = pool_tokens
+    pool_total_supply, token0_reserves, token1_reserves = pool_state_values(pool_tokens, pool_state_results)
+    logger.info("total LP supply of %s for %s", pool_total_supply, pool_str())
+    logger.info(
+        "reserves of token0 - %s and token1 - %s for %s", token0_reserves, token1_reserves, pool_str()
+    )
+
+    snapshots = []
+    for wallet_lp_balance in wallet_lp_balances:
+        wallet_share_of_lp = wallet_lp_balance / pool_total_supply
+        token0_underlying_lp = token0_reserves * wallet_share_of_lp
+        token1_underlying_lp = token1_reserves * wallet_share_of_lp
+        logger.info(
+            "LP Share - %s | token 0 underlying - %s | token 1 underlying - %s",
+            wallet_share_of_lp,
+            token0_underlying_lp,
+            token1_underlying_lp,
+        )
+        snapshots.append(
+            V2LiquiditySnapshot(
+                chain, block_no, wallet_lp_balance, token0, token0_underlying_lp, token1, token1_underlying_lp
+            )
+        )
+    return snapshots
+
+
+# pylint: disable=too-many-arguments
+# the snapshot needs the position, the pool tokens and both pool state results
+def snapshot_from_pool_state(
+    chain: str,
+    pool_address: str,
+    wallet_lp_balance: Decimal,
+    block_no: Optional[int],
+    pool_tokens: Tuple[PoolToken, PoolToken],
+    pool_state_results: Sequence[Any],
+) -> V2LiquiditySnapshot:
+    return snapshots_from_pool_state(
+        chain, pool_address, [wallet_lp_balance], block_no, pool_tokens, pool_state_results
+    )[0]
+
+
 def get_underlying_balances_from_lp_balance(
     chain: str, pool_address: str, wallet_lp_balance: Decimal, block_no: Optional[int]
 ) -> V2LiquiditySnapshot:
@@ -71,52 +169,144 @@ def get_underlying_balances_from_lp_balance(
     2. Use these results to find your % share of the pool liquidity
     3. Find the total underlying balances of the pool - `balances()` on the pool contract
     4. Apply your LP share to the total underlying balances to get your claim on the underlying
+
+    A missing block is pinned to the chain's head, so all the calls read the same state
     """
+    block_no = pin_block_no(chain, block_no)
+    logger.debug(
+        "calculating underlying balances for %s LP Tokens in pool %s",
+        wallet_lp_balance,
+        pool_string(chain, pool_address, block_no),
+    )
+    pool_tokens = get_pool_tokens(chain, pool_address)
 
-    def pool_str() -> str:
-        return pool_string(chain, pool_address, block_no)
+    logger.debug("getting total LP supply and reserves for %s", pool_string(chain, pool_address, block_no))
+    pool_state_results = contract_calls_at_block(chain, pool_state_calls(pool_address), block_no)
+    return snapshot_from_pool_state(
+        chain, pool_address, wallet_lp_balance, block_no, pool_tokens, pool_state_results
+    )
 
-    logger.debug("calculating underlying balances for %s LP Tokens in pool %s", wallet_lp_balance, pool_str())
-    token0 = get_pool_token_info(chain, pool_address, 0)
-    token1 = get_pool_token_info(chain, pool_address, 1)
 
-    logger.debug("getting total LP supply for %s", pool_str())
-    pool_total_supply_result = contract_call_at_block(
-        chain=chain,
-        interface_address=pool_address,
-        implementation_address=pool_address,
-        fn_name='totalSupply',
-        fn_args=[],
-        block_no=block_no,
+def pin_v2_spec_blocks(v2_specs: Sequence[V2PositionSpec]) -> List[V2PositionSpec]:
+    """
+    Pin the specs without a block to their chain's head, resolved once per chain
+    """
+    head_blocks: Dict[str, int] = {}
+    pinned_specs = []
+    for v2_spec in v2_specs:
+        if v2_spec.block_no is None:
+            if v2_spec.chain not in head_blocks:
+                head_blocks[v2_spec.chain] = pin_block_no(v2_spec.chain, None)
+            v2_spec = replace(v2_spec, block_no=head_blocks[v2_spec.chain])
+        pinned_specs.append(v2_spec)
+    return pinned_specs
+
+
+def group_v2_specs(v2_specs: Sequence[V2PositionSpec]) -> Dict[Tuple[str, str, int], List[int]]:
+    """
+    Group the indexes of V2 position specs by the chain, pool and block they read
+
+    The specs' blocks have to be pinned already.
+    """
+    spec_indices_by_group: Dict[Tuple[str, str, int], List[int]] = {}
+    for i, v2_spec in enumerate(v2_specs):
+        assert v2_spec.block_no is not None
+        group = (v2_spec.chain, to_checksum_address(v2_spec.pool_address), v2_spec.block_no)
+        spec_indices_by_group.setdefault(group, []).append(i)
+    return spec_indices_by_group
+
+
+def get_underlying_balances_for_group(
+    v2_specs: Sequence[V2PositionSpec], group: Tuple[str, str, int], spec_indices: Sequence[int]
+) -> List[V2LiquiditySnapshot]:
+    """
+    The snapshots of the specs at `spec_indices`, which all read the same chain, pool and block, from one
+    batch of calls
+    """
+    chain, pool_address, block_no = group
+    wallet_addresses = [
+        v2_specs[i].wallet_address for i in spec_indices if v2_specs[i].wallet_address is not None
+    ]
+    logger.debug(
+        "evaluating %s positions with %s wallets in V2 pool %s",
+        len(spec_indices),
+        len(wallet_addresses),
+        pool_string(chain, pool_address, block_no),
     )
-    pool_total_supply = Decimal(pool_total_supply_result) / E18
-    logger.info("total LP supply of %s for %s", pool_total_supply, pool_str())
+    pool_tokens = get_pool_tokens(chain, pool_address)
+    results = contract_calls_at_block(
+        chain,
+        pool_state_calls(pool_address)
+        + [ContractCall(pool_address, pool_address, 'balanceOf', [wallet]) for wallet in wallet_addresses],
+        block_no,
+    )
+    pool_state_results, wallet_balance_results = results[:2], iter(results[2:])
+
+    wallet_lp_balances = [
+        lp_balance if lp_balance is not None else Decimal(next(wallet_balance_results)) / E18
+        for lp_balance in (v2_specs[i].lp_balance for i in spec_indices)
+    ]
+    return snapshots_from_pool_state(
+        chain, pool_address, wallet_lp_balances, block_no, pool_tokens, pool_state_results
+    )
+
+
+def get_underlying_balances_for_specs(v2_specs: Sequence[V2PositionSpec]) -> List[V2LiquiditySnapshot]:
+    """
+    Batched equivalent of evaluating each V2 position spec on its own, returning the snapshots in spec order
+
+    Specs are grouped by chain, pool and block. Each group costs one batch of calls, the pool's total supply
+    and reserves along with the `balanceOf` of every wallet in the group, however many positions it holds.
+    The pool tokens come from the metadata registry, so they are only looked up once per pool. Specs without
+    a block are pinned to their chain's head first.
+    """
+    if any(v2_spec.block_no is None for v2_spec in v2_specs):
+        v2_specs = pin_v2_spec_blocks(v2_specs)
+
+    snapshots: List[Optional[V2LiquiditySnapshot]] = [None] * len(v2_specs)
+    for group, spec_indices in group_v2_specs(v2_specs).items():
+        group_snapshots = get_underlying_balances_for_group(v2_specs, group, spec_indices)
+        for i, snapshot in zip(spec_indices, group_snapshots):
+            snapshots[i] = snapshot
+
+    return [snapshot for snapshot in snapshots if snapshot is not None]
+
 
-    logger.debug("getting reserves for %s", pool_str())
-    reserves_result = contract_call_at_block(
+async def async_get_underlying_balances_from_address(
+    chain: str, pool_address: str, wallet_address: str, block_no: Optional[int] = None
+) -> V2LiquiditySnapshot:
+    """
+    Async equivalent of `get_underlying_balances_from_address`
+    """
+    block_no = await async_pin_block_no(chain, block_no)
+    logger.debug(
+        "requesting underlying LP balances for wallet %s in V2 pool %s",
+        wallet_address,
+        pool_string(chain, pool_address, block_no),
+    )
+    wallet_lp_balance_result = await async_contract_call_at_block(
         chain=chain,
         interface_address=pool_address,
         implementation_address=pool_address,
-        fn_name='getReserves',
-        fn_args=[],
+        fn_name='balanceOf',
+        fn_args=[wallet_address],
         block_no=block_no,
     )
-    token0_reserves = Decimal(reserves_result[0]) / Decimal(10**token0.decimals)
-    token1_reserves = Decimal(reserves_result[1]) / Decimal(10**token1.decimals)
-    logger.info(
-        "reserves of token0 - %s and token1 - %s for %s", token0_reserves, token1_reserves, pool_str()
+    wallet_lp_balance = Decimal(wallet_lp_balance_result) / E18
+    return await async_get_underlying_balances_from_lp_balance(
+        chain, pool_address, wallet_lp_balance, block_no
     )
 
-    wallet_share_of_lp = wallet_lp_balance / pool_total_supply
-    token0_underlying_lp = token0_reserves * wallet_share_of_lp
-    token1_underlying_lp = token1_reserves * wallet_share_of_lp
-    logger.info(
-        "LP Share - %s | token 0 underlying - %s | token 1 underlying - %s",
-        wallet_share_of_lp,
-        token0_underlying_lp,
-        token1_underlying_lp,
-    )
 
-    return V2LiquiditySnapshot(
-        chain, block_no, wallet_lp_balance, token0, token0_underlying_lp, token1, token1_underlying_lp
+async def async_get_underlying_balances_from_lp_balance(
+    chain: str, pool_address: str, wallet_lp_balance: Decimal, block_no: Optional[int]
+) -> V2LiquiditySnapshot:
+    """
+    Async equivalent of `get_underlying_balances_from_lp_balance`
+    """
+    block_no = await async_pin_block_no(chain, block_no)
+    pool_tokens = await asyncio.to_thread(get_pool_tokens, chain, pool_address)
+    pool_state_results = await async_contract_calls_at_block(chain, pool_state_calls(pool_address), block_no)
+    return snapshot_from_pool_state(
+        chain, pool_address, wallet_lp_balance, block_no, pool_tokens, pool_state_results
     )
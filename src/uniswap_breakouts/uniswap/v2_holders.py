@@ -0,0 +1,87 @@
+import logging
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from uniswap_breakouts.constants.abis import V2_PAIR_EVENTS_ABI
+from uniswap_breakouts.uniswap.pool_metadata import get_pool_creation_block, get_pool_tokens
+from uniswap_breakouts.uniswap.v2 import pool_state_calls, pool_state_values, pool_string
+from uniswap_breakouts.utils.batch_calls import contract_calls_at_block
+from uniswap_breakouts.utils.logs import find_event_abi, get_decoded_logs
+from uniswap_breakouts.utils.web3_utils import pin_block_no
+
+logger = logging.getLogger(__name__)
+
+TRANSFER_EVENT_ABI = find_event_abi(V2_PAIR_EVENTS_ABI, 'Transfer')
+ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
+# LP tokens a V2 pool mints to the zero address on its first mint, they are locked forever
+MINIMUM_LIQUIDITY = 1000
+
+
+def get_lp_holder_balances(chain: str, pool_address: str, from_block: int, to_block: int) -> Dict[str, int]:
+    """
+    Rebuild the LP token balance of every holder from the pool's Transfer events between two blocks
+
+    `from_block` has to be at or before the pool's creation for the balances to be complete. Mints come from
+    the zero address and burns go to it, so it is not a holder itself, and the minimum liquidity a pool locks
+    when it is first minted is left out. Balances are in the LP token's smallest unit, and only holders with a
+    balance left at `to_block` are returned.
+    """
+    balances: Dict[str, int] = {}
+    transfers = get_decoded_logs(chain, pool_address, [TRANSFER_EVENT_ABI], from_block, to_block)
+    for transfer in transfers:
+        value = transfer.args['value']
+        if transfer.args['from'] != ZERO_ADDRESS:
+            balances[transfer.args['from']] = balances.get(transfer.args['from'], 0) - value
+        if transfer.args['to'] != ZERO_ADDRESS:
+            balances[transfer.args['to']] = balances.get(transfer.args['to'], 0) + value
+
+    logger.debug(
+        "replayed %s transfers for %s - %s from block %s to %s",
+        len(transfers),
+        chain,
+        pool_address,
+        from_block,
+        to_block,
+    )
+    return {holder: balance for holder, balance in balances.items() if balance != 0}
+
+
+def get_lp_holder_breakdown(
+    chain: str, pool_address: str, block_no: Optional[int] = None, from_block: Optional[int] = None
+) -> pd.DataFrame:
+    """
+    Get the underlying balances of every LP holder of a V2 pool, largest holder first
+
+    Holders are found from the pool's Transfer events since its creation, or since `from_block` when it is
+    given, so no holder has to be known up front. The pool state is read once, and every holder's share and
+    underlyings are computed with whole-column operations, the same math as
+    `get_underlying_balances_from_lp_balance` in float64.
+    """
+    block_no = pin_block_no(chain, block_no)
+    if from_block is None:
+        from_block = get_pool_creation_block(chain, pool_address, block_no)
+
+    pool_tokens = get_pool_tokens(chain, pool_address)
+    pool_state_results = contract_calls_at_block(chain, pool_state_calls(pool_address), block_no)
+    pool_total_supply, token0_reserves, token1_reserves = pool_state_values(pool_tokens, pool_state_results)
+
+    holder_balances = get_lp_holder_balances(chain, pool_address, from_block, block_no)
+    holders = sorted(holder_balances, key=holder_balances.__getitem__, reverse=True)
+    # balances are summed exactly as python ints, before they are converted
+    lp_balances = np.array([holder_balances[holder] for holder in holders], dtype=object)
+    unaccounted_supply = pool_state_results[0] - sum(lp_balances)
+    if not 0 <= unaccounted_supply <= MINIMUM_LIQUIDITY:
+        logger.warning(
+            "holder balances for %s are %s short of the total supply, transfers before block %s are missing",
+            pool_string(chain, pool_address, block_no),
+            unaccounted_supply,
+            from_block,
+        )
+
+    holders_df = pd.DataFrame({'holder': holders, 'lp_balance': lp_balances.astype(np.float64) / 10.0**18})
+    holders_df['lp_share'] = holders_df['lp_balance'] / float(pool_total_supply)
+    holders_df['token0_underlying'] = holders_df['lp_share'] * float(token0_reserves)
+    holders_df['token1_underlying'] = holders_df['lp_share'] * float(token1_reserves)
+    return holders_df
@@ -0,0 +1,122 @@
+from decimal import Decimal
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from uniswap_breakouts.constants.abis import V2_PAIR_EVENTS_ABI
+from uniswap_breakouts.uniswap.pool_metadata import get_pool_tokens
+from uniswap_breakouts.uniswap.v2 import pool_state_calls, pool_string
+from uniswap_breakouts.utils.batch_calls import contract_calls_at_block
+from uniswap_breakouts.utils.logs import DecodedLog, find_event_abi, get_decoded_logs, get_sample_blocks
+
+logger = logging.getLogger(__name__)
+
+SERIES_EVENT_ABIS = [find_event_abi(V2_PAIR_EVENTS_ABI, event) for event in ('Sync', 'Transfer')]
+ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
+
+
+def apply_pool_log(pool_state: Tuple[int, int, int], log: DecodedLog) -> Tuple[int, int, int]:
+    """
+    Apply a Sync or Transfer event to a pool's (total supply, reserve0, reserve1)
+
+    Every change to the reserves ends in a Sync with the new reserves. LP tokens are minted from and burned to
+    the zero address, transfers between holders leave the total supply as it is.
+    """
+    total_supply, reserve0, reserve1 = pool_state
+    if log.event == 'Sync':
+        return total_supply, log.args['reserve0'], log.args['reserve1']
+    if log.event == 'Transfer':
+        if log.args['from'] == ZERO_ADDRESS:
+            return total_supply + log.args['value'], reserve0, reserve1
+        if log.args['to'] == ZERO_ADDRESS:
+            return total_supply - log.args['value'], reserve0, reserve1
+        return pool_state
+    raise ValueError(f"can not apply {log.event} event to a V2 pool state")
+
+
+def get_pool_state_changes(chain: str, pool_address: str, from_block: int, to_block: int) -> pd.DataFrame:
+    """
+    The pool's total supply and reserves at the end of `from_block` and of every later block that changed them
+
+    The state is read once at `from_block`, everything after comes from the pool's Sync and Transfer events.
+    Values are decimal adjusted float64.
+    """
+    token0, token1 = get_pool_tokens(chain, pool_address)
+    logger.debug("seeding pool state series for %s", pool_string(chain, pool_address, from_block))
+    total_supply, reserves = contract_calls_at_block(chain, pool_state_calls(pool_address), from_block)
+    pool_state = (int(total_supply), int(reserves[0]), int(reserves[1]))
+
+    blocks = [from_block]
+    pool_states: List[Tuple[int, int, int]] = [pool_state]
+    for log in get_decoded_logs(chain, pool_address, SERIES_EVENT_ABIS, from_block + 1, to_block):
+        pool_state = apply_pool_log(pool_state, log)
+        # only the state at the end of each block is kept
+        if log.block_number == blocks[-1]:
+            pool_states[-1] = pool_state
+        else:
+            blocks.append(log.block_number)
+            pool_states.append(pool_state)
+
+    # uint112 reserves do not fit in int64, they are converted from python ints
+    total_supplies, reserves0, reserves1 = (
+        np.array(values, dtype=object).astype(np.float64) for values in zip(*pool_states)
+    )
+    logger.debug(
+        "found %s pool state changes for %s - %s from block %s to %s",
+        len(blocks) - 1,
+        chain,
+        pool_address,
+        from_block,
+        to_block,
+    )
+    return pd.DataFrame(
+        {
+            'block': np.array(blocks, dtype=np.int64),
+            'total_supply': total_supplies / 10.0**18,
+            'token0_reserves': reserves0 / 10.0**token0.decimals,
+            'token1_reserves': reserves1 / 10.0**token1.decimals,
+        }
+    )
+
+
+def get_pool_state_series(
+    chain: str, pool_address: str, from_block: int, to_block: int, blocks: Optional[Sequence[int]] = None
+) -> pd.DataFrame:
+    """
+    The pool's total supply and reserves at every block between two blocks, both inclusive, or at each of
+    `blocks` when they are given
+
+    A handful of `eth_getLogs` requests replace the `totalSupply` and `getReserves` calls at every block, and
+    each block takes the last state change at or before it.
+    """
+    sample_blocks = get_sample_blocks(from_block, to_block, blocks)
+
+    changes_df = get_pool_state_changes(chain, pool_address, from_block, to_block)
+    rows = np.searchsorted(changes_df['block'].to_numpy(), sample_blocks, side='right') - 1
+    series_df = changes_df.iloc[rows].reset_index(drop=True)
+    series_df['block'] = sample_blocks
+    return series_df
+
+
+# pylint: disable=too-many-arguments
+# the pool, the position and the blocks to evaluate it at
+def get_underlying_balances_series(
+    chain: str,
+    pool_address: str,
+    wallet_lp_balance: Decimal,
+    from_block: int,
+    to_block: int,
+    blocks: Optional[Sequence[int]] = None,
+) -> pd.DataFrame:
+    """
+    Time series equivalent of `v2.get_underlying_balances_from_lp_balance`, for a fixed LP balance
+
+    The shares and underlyings are whole-column float64 operations over the pool state series.
+    """
+    series_df = get_pool_state_series(chain, pool_address, from_block, to_block, blocks)
+    series_df['lp_share'] = float(wallet_lp_balance) / series_df['total_supply']
+    series_df['token0_underlying'] = series_df['token0_reserves'] * series_df['lp_share']
+    series_df['token1_underlying'] = series_df['token1_reserves'] * series_df['lp_share']
+    return series_df
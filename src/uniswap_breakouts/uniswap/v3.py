@@ -1,13 +1,23 @@
+import asyncio
 from dataclasses import dataclass
 from decimal import Decimal
 import logging
-from typing import Optional, Tuple
+from typing import Any, Optional, Sequence, Tuple, Union
 
 from dataclasses_json import DataClassJsonMixin
+import numpy as np
 
 from uniswap_breakouts.constants.abis import V3_POOL_CONTRACT_ABI
-from uniswap_breakouts.uniswap.uniswap_utils import PoolToken, get_pool_token_info
-from uniswap_breakouts.utils.web3_utils import contract_call_at_block
+from uniswap_breakouts.uniswap.pool_state import V3PoolState, get_v3_pool_state
+from uniswap_breakouts.uniswap.uniswap_utils import PoolToken
+from uniswap_breakouts.uniswap.v3_math import (
+    get_amounts_for_liquidity,
+    get_sqrt_ratio_at_tick,
+    sqrt_ratio_x96_to_price,
+)
+from uniswap_breakouts.utils.async_web3_utils import async_contract_calls_at_block, async_pin_block_no
+from uniswap_breakouts.utils.batch_calls import contract_calls_at_block
+from uniswap_breakouts.utils.web3_utils import ContractCall, contract_call_at_block, pin_block_no
 
 logger = logging.getLogger(__name__)
 
@@ -39,7 +49,8 @@ def q64_96_to_decimal(q64_96_number: int) -> Decimal:
 
 
 def tick_to_price(tick_index: int) -> Decimal:
-    return Decimal('1.0001') ** tick_index
+    # squaring the contract's own sqrt ratio keeps prices consistent with the integer position math
+    return sqrt_ratio_x96_to_price(get_sqrt_ratio_at_tick(tick_index))
 
 
 def price_outside_below(tick_lower: Decimal, tick_upper: Decimal, liquidity: Decimal) -> Decimal:
@@ -54,7 +65,7 @@ def price_inbetween(
     price: Decimal, tick_lower: Decimal, tick_upper: Decimal, liquidity: Decimal
 ) -> Tuple[Decimal, Decimal]:
     token0_position_virtual = (
-        liquidity * (tick_upper.sqrt() - price.sqrt()) / (price.sqrt() * tick_lower.sqrt())
+        liquidity * (tick_upper.sqrt() - price.sqrt()) / (price.sqrt() * tick_upper.sqrt())
     )
     token1_position_virtual = liquidity * (price.sqrt() - tick_lower.sqrt())
     return token0_position_virtual, token1_position_virtual
@@ -77,6 +88,40 @@ def get_virtual_underlyings_from_range(
     return token0_position_virtual, token1_position_virtual
 
 
+def get_virtual_underlyings_from_ranges(
+    ratio: Union[float, np.ndarray],
+    lower_ratios: np.ndarray,
+    upper_ratios: np.ndarray,
+    liquidities: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized `get_virtual_underlyings_from_range` for many ranges at once, in float64
+
+    Every range is evaluated with whole-array operations, and each range takes the branch of the scalar
+    function that matches where the current ratio sits relative to it. The ratio can also be an array the
+    length of the ranges, to evaluate one range at many prices.
+    """
+    sqrt_ratio = np.sqrt(ratio)
+    sqrt_lower = np.sqrt(lower_ratios)
+    sqrt_upper = np.sqrt(upper_ratios)
+
+    price_above = ratio > upper_ratios
+    price_below = ratio < lower_ratios
+    conditions = [price_above, price_below]
+
+    token0_position_virtual = np.select(
+        conditions,
+        [0.0, liquidities * (sqrt_upper - sqrt_lower) / (sqrt_lower * sqrt_upper)],
+        default=liquidities * (sqrt_upper - sqrt_ratio) / (sqrt_ratio * sqrt_upper),
+    )
+    token1_position_virtual = np.select(
+        conditions,
+        [liquidities * (sqrt_upper - sqrt_lower), 0.0],
+        default=liquidities * (sqrt_ratio - sqrt_lower),
+    )
+    return token0_position_virtual, token1_position_virtual
+
+
 def get_price_info_for_pool(chain: str, pool_address: str, block_no: Optional[int]) -> Tuple:
     pool_info_result = contract_call_at_block(
         chain=chain,
@@ -91,52 +136,37 @@ def get_price_info_for_pool(chain: str, pool_address: str, block_no: Optional[in
     return pool_info_result
 
 
+def position_call(nft_address: str, nft_impl_address: str, nft_id: int) -> ContractCall:
+    return ContractCall(nft_address, nft_impl_address, 'positions', [nft_id])
+
+
 # pylint: disable=too-many-arguments,too-many-locals
 # this is a complex calculation, but I think it's better to keep it all in one function for understanding
-def get_underlying_balances(
-    chain: str,
-    pool_address: str,
-    nft_address: str,
-    nft_impl_address: str,
-    nft_id: int,
-    block_no: Optional[int] = None,
+def snapshot_from_position_state(
+    pool_state: V3PoolState, nft_id: int, positions_info_result: Sequence[Any]
 ) -> V3LiquiditySnapshot:
     """
-    Get the underlying token balances for a single Uniswap v3 position
+    Calculate the underlying token balances of a position from the pool price and the position's range
 
-    see https://atiselsts.github.io/pdfs/uniswap-v3-liquidity-math.pdf.
-    We use the contract calls to get the necessary inputs into the above formulas for
-    calculating the underlying positions of the liquidity range
+    This is the pure math shared by the sync and async breakdowns, `positions_info_result` is the result of
+    the position manager's `positions` call for the position. The amounts are calculated with the pool's own
+    integer math, so they are exactly what burning the position's liquidity would return.
     """
+    chain, block_no = pool_state.chain, pool_state.block
 
     def position_string() -> str:
-        return pool_position_string(chain, pool_address, nft_id, block_no)
+        return pool_position_string(chain, pool_state.pool_address, nft_id, block_no)
 
-    logger.debug("requesting underlying LP balances for V3 position %s", position_string())
-    token0 = get_pool_token_info(chain, pool_address, 0, V3_POOL_CONTRACT_ABI)
-    token1 = get_pool_token_info(chain, pool_address, 1, V3_POOL_CONTRACT_ABI)
+    token0, token1 = pool_state.tokens
 
     # the ratio that Uniswap records is a virtual ratio. We will need to adjust by the
     # relative decimals of the tokens to get the actual balances later
     decimal_adjustment = Decimal(10 ** (token0.decimals - token1.decimals))
 
-    logger.debug("getting pool price for %s", position_string())
-    pool_info_result = get_price_info_for_pool(chain, pool_address, block_no)
-
-    sqrt_price_x96 = pool_info_result[0]
+    sqrt_price_x96, current_tick = pool_state.sqrt_price_x96, pool_state.tick
     price = q64_96_to_decimal(sqrt_price_x96) ** Decimal(2)
     logger.info("price of %s for pool %s", price, position_string())
 
-    logger.debug("requesting position details for %s", position_string())
-    positions_info_result = contract_call_at_block(
-        chain=chain,
-        interface_address=nft_address,
-        implementation_address=nft_impl_address,
-        fn_name='positions',
-        fn_args=[nft_id],
-        block_no=block_no,
-    )
-
     tick_lower = positions_info_result[5]
     lower_tick_price = tick_to_price(tick_lower)
     tick_upper = positions_info_result[6]
@@ -150,8 +180,8 @@ def get_underlying_balances(
         position_string(),
     )
 
-    token0_position_virtual, token1_position_virtual = get_virtual_underlyings_from_range(
-        price, lower_tick_price, upper_tick_price, liquidity
+    token0_position_virtual, token1_position_virtual = get_amounts_for_liquidity(
+        current_tick, sqrt_price_x96, tick_lower, tick_upper, liquidity
     )
 
     token0_position = token0_position_virtual / (Decimal(10) ** Decimal(token0.decimals))
@@ -176,3 +206,55 @@ def get_underlying_balances(
         num_token1_underlying=token1_position,
     )
     return snapshot
+
+
+def get_underlying_balances(
+    chain: str,
+    pool_address: str,
+    nft_address: str,
+    nft_impl_address: str,
+    nft_id: int,
+    block_no: Optional[int] = None,
+) -> V3LiquiditySnapshot:
+    """
+    Get the underlying token balances for a single Uniswap v3 position
+
+    see https://atiselsts.github.io/pdfs/uniswap-v3-liquidity-math.pdf.
+    We use the contract calls to get the necessary inputs into the above formulas for
+    calculating the underlying positions of the liquidity range. A missing block is pinned to the chain's
+    head so the pool price and the position are read from the same block. The pool's price comes from the
+    shared pool state, so positions in the same pool and block only read the pool once.
+    """
+    block_no = pin_block_no(chain, block_no)
+    position_str = pool_position_string(chain, pool_address, nft_id, block_no)
+    logger.debug("requesting underlying LP balances for V3 position %s", position_str)
+    pool_state = get_v3_pool_state(chain, pool_address, block_no)
+
+    logger.debug("getting position details for %s", position_str)
+    (positions_info_result,) = contract_calls_at_block(
+        chain, [position_call(nft_address, nft_impl_address, nft_id)], block_no
+    )
+    return snapshot_from_position_state(pool_state, nft_id, positions_info_result)
+
+
+async def async_get_underlying_balances(
+    chain: str,
+    pool_address: str,
+    nft_address: str,
+    nft_impl_address: str,
+    nft_id: int,
+    block_no: Optional[int] = None,
+) -> V3LiquiditySnapshot:
+    """
+    Async equivalent of `get_underlying_balances`
+    """
+    block_no = await async_pin_block_no(chain, block_no)
+    logger.debug(
+        "requesting underlying LP balances for V3 position %s",
+        pool_position_string(chain, pool_address, nft_id, block_no),
+    )
+    pool_state = await asyncio.to_thread(get_v3_pool_state, chain, pool_address, block_no)
+    (positions_info_result,) = await async_contract_calls_at_block(
+        chain, [position_call(nft_address, nft_impl_address, nft_id)], block_no
+    )
+    return snapshot_from_position_state(pool_state, nft_id, positions_info_result)
@@ -0,0 +1,253 @@
+import bisect
+from dataclasses import dataclass
+from decimal import Decimal
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Union
+
+import numpy as np
+
+from uniswap_breakouts.constants.abis import V3_POOL_CONTRACT_ABI
+from uniswap_breakouts.uniswap.v3 import get_virtual_underlyings_from_ranges
+from uniswap_breakouts.uniswap.v3_math import Q96, get_sqrt_ratios_at_ticks
+from uniswap_breakouts.uniswap.v3_ticks import (
+    V3TickLiquiditySnapshot,
+    get_spaced_tick_bounds,
+    get_tick_liquidity_info_for_pool,
+)
+from uniswap_breakouts.utils.logs import DecodedLog, find_event_abi, get_decoded_logs
+
+logger = logging.getLogger(__name__)
+
+DEPTH_MATRIX_EVENT_ABIS = [find_event_abi(V3_POOL_CONTRACT_ABI, event) for event in ('Mint', 'Burn', 'Swap')]
+DEPTH_MATRIX_COLUMNS = ('liquidity', 'token0_underlying', 'token1_underlying')
+DEPTH_MATRIX_METADATA_FILE = 'metadata.json'
+
+
+@dataclass(frozen=True)
+class V3DepthMatrix:
+    """
+    Liquidity and underlying tokens of every tick in a fixed range of ticks, at many blocks
+
+    Each value array is laid out as (block, tick), with one row per entry of `blocks` and one column per entry
+    of `ticks`. Underlyings are decimal adjusted. When the matrix is opened from disk the arrays are memory
+    mapped, so slicing them only reads the blocks and ticks that are sliced.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    # the pool, both axes and one array per value
+    chain: str
+    pool_address: str
+    tick_spacing: int
+    blocks: np.ndarray
+    ticks: np.ndarray
+    liquidity: np.ndarray
+    token0_underlying: np.ndarray
+    token1_underlying: np.ndarray
+
+    def block_rows(self, from_block: int, to_block: int) -> slice:
+        """
+        The rows of the blocks between `from_block` and `to_block`, both inclusive
+        """
+        return slice(
+            int(np.searchsorted(self.blocks, from_block, side='left')),
+            int(np.searchsorted(self.blocks, to_block, side='right')),
+        )
+
+    def tick_columns(self, tick_lower: int, tick_upper: int) -> slice:
+        """
+        The columns of the ticks between `tick_lower` and `tick_upper`, both inclusive
+        """
+        return slice(
+            int(np.searchsorted(self.ticks, tick_lower, side='left')),
+            int(np.searchsorted(self.ticks, tick_upper, side='right')),
+        )
+
+
+class DepthMatrixState:
+    """
+    The liquidity in a fixed range of ticks and the pool's price, advanced one pool event at a time
+
+    Liquidity is kept per tick in the range rather than as liquidity net around the active tick, so a mint or
+    burn only has to know which ticks of the range its position covers. This stays exact however far the
+    price moves from the range, without knowing about any ticks outside of it.
+    """
+
+    def __init__(self, snapshot: V3TickLiquiditySnapshot, ticks: np.ndarray):
+        self.ticks = ticks
+        self.sqrt_price_x96 = snapshot.sqrt_price_x96
+        self.ratios_lower = (np.array(get_sqrt_ratios_at_ticks(ticks), dtype=np.float64) / Q96) ** 2
+        self.ratios_upper = (
+            np.array(get_sqrt_ratios_at_ticks(ticks + snapshot.tick_spacing), dtype=np.float64) / Q96
+        ) ** 2
+        self.token0_scale = 10.0**snapshot.token0.decimals
+        self.token1_scale = 10.0**snapshot.token1.decimals
+
+        # liquidity in each tick relative to the active tick, from the liquidity net of the ticks between them
+        cumulative_liquidity_net = np.concatenate(
+            [[0], np.cumsum(snapshot.ticks.liquidity_net.astype(object))]
+        ).tolist()
+
+        def liquidity_net_to(tick: int) -> int:
+            return cumulative_liquidity_net[int(np.searchsorted(snapshot.ticks.ticks, tick, side='right'))]
+
+        active_tick_lower = (snapshot.active_tick // snapshot.tick_spacing) * snapshot.tick_spacing
+        active_liquidity_net = liquidity_net_to(active_tick_lower)
+        # python ints, liquidity does not fit in int64
+        self.liquidity = np.array(
+            [
+                snapshot.active_liquidity + liquidity_net_to(int(tick)) - active_liquidity_net
+                for tick in ticks
+            ],
+            dtype=object,
+        )
+
+    def apply_log(self, log: DecodedLog) -> None:
+        if log.event in ('Mint', 'Burn'):
+            liquidity_delta = log.args['amount'] if log.event == 'Mint' else -log.args['amount']
+            in_position = (self.ticks >= log.args['tickLower']) & (self.ticks < log.args['tickUpper'])
+            self.liquidity[in_position] += liquidity_delta
+        elif log.event == 'Swap':
+            self.sqrt_price_x96 = log.args['sqrtPriceX96']
+        else:
+            raise ValueError(f"can not apply {log.event} event to a depth matrix")
+
+    def row_values(self) -> Dict[str, np.ndarray]:
+        """
+        The current liquidity and decimal adjusted underlyings of every tick, in float64
+        """
+        liquidity = self.liquidity.astype(np.float64)
+        token0_virtual, token1_virtual = get_virtual_underlyings_from_ranges(
+            (self.sqrt_price_x96 / Q96) ** 2, self.ratios_lower, self.ratios_upper, liquidity
+        )
+        return {
+            'liquidity': liquidity,
+            'token0_underlying': token0_virtual / self.token0_scale,
+            'token1_underlying': token1_virtual / self.token1_scale,
+        }
+
+
+def get_depth_matrix_ticks(snapshot: V3TickLiquiditySnapshot, depth: Decimal) -> np.ndarray:
+    tick_lower, tick_upper = get_spaced_tick_bounds(snapshot.active_tick, snapshot.tick_spacing, depth)
+    return np.arange(tick_lower, tick_upper + 1, snapshot.tick_spacing, dtype=np.int64)
+
+
+def create_depth_matrix_arrays(
+    out_dir: Union[str, Path], n_blocks: int, n_ticks: int
+) -> Dict[str, np.memmap]:
+    out_path = Path(out_dir)
+    out_path.mkdir(parents=True, exist_ok=True)
+    return {
+        column: np.lib.format.open_memmap(
+            out_path / f'{column}.npy', mode='w+', dtype=np.float64, shape=(n_blocks, n_ticks)
+        )
+        for column in DEPTH_MATRIX_COLUMNS
+    }
+
+
+# pylint: disable=too-many-arguments
+# the sweep needs the seed, both axes and the arrays to fill
+def fill_depth_matrix_rows(
+    snapshot: V3TickLiquiditySnapshot,
+    pool_address: str,
+    blocks: Sequence[int],
+    ticks: np.ndarray,
+    arrays: Dict[str, np.memmap],
+) -> None:
+    """
+    Fill one row of every array per block, by sweeping the pool's events from the snapshot's block onwards
+
+    The events of the whole range are requested in one go, so `get_logs` can grow its chunks over quiet
+    stretches, and are then applied in order up to each row's block.
+    """
+    state = DepthMatrixState(snapshot, ticks)
+
+    def write_row(row: int) -> None:
+        for column, values in state.row_values().items():
+            arrays[column][row] = values
+
+    write_row(0)
+    logs: List[DecodedLog] = get_decoded_logs(
+        snapshot.chain, pool_address, DEPTH_MATRIX_EVENT_ABIS, blocks[0] + 1, blocks[-1]
+    )
+    log_blocks = [log.block_number for log in logs]
+    applied = 0
+    for row in range(1, len(blocks)):
+        # apply everything up to and including the row's block, then record the state
+        next_applied = bisect.bisect_right(log_blocks, blocks[row])
+        for log in logs[applied:next_applied]:
+            state.apply_log(log)
+        applied = next_applied
+        write_row(row)
+
+
+def write_depth_matrix_metadata(out_dir: Union[str, Path], metadata: Dict[str, Any]) -> None:
+    with open(Path(out_dir) / DEPTH_MATRIX_METADATA_FILE, 'w', encoding='utf-8') as metadata_file:
+        json.dump(metadata, metadata_file)
+
+
+def build_depth_matrix(
+    chain: str,
+    pool_address: str,
+    tick_lens_address: str,
+    depth: Decimal,
+    blocks: Sequence[int],
+    out_dir: Union[str, Path],
+) -> V3DepthMatrix:
+    """
+    Build the liquidity depth matrix of a pool at every block in `blocks`, and store it in `out_dir`
+
+    The ticks of the matrix are those within +/- `depth` in price of the active tick at the first block.
+    Only one snapshot is taken, at the first block, and every later row is found by applying the pool's Mint,
+    Burn and Swap events to it. Rows are written straight into memory mapped `.npy` files, one per value,
+    so the matrix never has to fit in memory.
+    """
+    blocks = sorted(set(blocks))
+    if not blocks:
+        raise ValueError("a depth matrix needs at least one block")
+
+    snapshot = get_tick_liquidity_info_for_pool(chain, pool_address, tick_lens_address, depth, blocks[0])
+    ticks = get_depth_matrix_ticks(snapshot, depth)
+    logger.info(
+        "building %s x %s depth matrix for %s - %s in %s",
+        len(blocks),
+        len(ticks),
+        chain,
+        pool_address,
+        out_dir,
+    )
+
+    arrays = create_depth_matrix_arrays(out_dir, len(blocks), len(ticks))
+    fill_depth_matrix_rows(snapshot, pool_address, blocks, ticks, arrays)
+    for array in arrays.values():
+        array.flush()
+    np.save(Path(out_dir) / 'blocks.npy', np.array(blocks, dtype=np.int64))
+    np.save(Path(out_dir) / 'ticks.npy', ticks)
+    write_depth_matrix_metadata(
+        out_dir, {'chain': chain, 'pool_address': pool_address, 'tick_spacing': snapshot.tick_spacing}
+    )
+    return open_depth_matrix(out_dir)
+
+
+def open_depth_matrix(out_dir: Union[str, Path]) -> V3DepthMatrix:
+    """
+    Open a stored depth matrix without reading its values, which are memory mapped read only
+    """
+    out_path = Path(out_dir)
+    with open(out_path / DEPTH_MATRIX_METADATA_FILE, encoding='utf-8') as metadata_file:
+        metadata = json.load(metadata_file)
+
+    def load_values(column: str) -> np.ndarray:
+        return np.load(out_path / f'{column}.npy', mmap_mode='r')
+
+    return V3DepthMatrix(
+        chain=metadata['chain'],
+        pool_address=metadata['pool_address'],
+        tick_spacing=metadata['tick_spacing'],
+        blocks=np.load(out_path / 'blocks.npy'),
+        ticks=np.load(out_path / 'ticks.npy'),
+        liquidity=load_values('liquidity'),
+        token0_underlying=load_values('token0_underlying'),
+        token1_underlying=load_values('token1_underlying'),
+    )
@@ -0,0 +1,142 @@
+from decimal import Decimal
+import functools
+from typing import Iterable, List, Tuple
+
+# integer ports of the Uniswap V3 TickMath, SqrtPriceMath and FullMath libraries. Python ints do not overflow,
+# so the 256 bit intermediate products of the solidity code are exact here and the results match the
+# contracts bit for bit, including their rounding
+
+MIN_TICK = -887272
+MAX_TICK = 887272
+MIN_SQRT_RATIO = 4295128739
+MAX_SQRT_RATIO = 1461446703485210103287273052203988822378723970342
+
+Q96 = 2**96
+Q192 = 2**192
+MAX_UINT256 = 2**256 - 1
+
+# sqrt(1.0001) ** -(2 ** i) as Q128.128 numbers, for every bit i of the absolute tick
+TICK_MULTIPLIERS = (
+    0xFFFCB933BD6FAD37AA2D162D1A594001,
+    0xFFF97272373D413259A46990580E213A,
+    0xFFF2E50F5F656932EF12357CF3C7FDCC,
+    0xFFE5CACA7E10E4E61C3624EAA0941CD0,
+    0xFFCB9843D60F6159C9DB58835C926644,
+    0xFF973B41FA98C081472E6896DFB254C0,
+    0xFF2EA16466C96A3843EC78B326B52861,
+    0xFE5DEE046A99A2A811C461F1969C3053,
+    0xFCBE86C7900A88AEDCFFC83B479AA3A4,
+    0xF987A7253AC413176F2B074CF7815E54,
+    0xF3392B0822B70005940C7A398E4B70F3,
+    0xE7159475A2C29B7443B29C7FA6E889D9,
+    0xD097F3BDFD2022B8845AD8F792AA5825,
+    0xA9F746462D870FDF8A65DC1F90E061E5,
+    0x70D869A156D2A1B890BB3DF62BAF32F7,
+    0x31BE135F97D08FD981231505542FCFA6,
+    0x9AA508B5B7A84E1C677DE54F3E99BC9,
+    0x5D6AF8DEDB81196699C329225EE604,
+    0x2216E584F5FA1EA926041BEDFE98,
+    0x48A170391F7DC42444E8FA2,
+)
+
+# the per-tick table of sqrt ratios is bounded, a wide tick profile touches a few thousand ticks
+SQRT_RATIO_TABLE_SIZE = 2**16
+
+
+@functools.lru_cache(maxsize=SQRT_RATIO_TABLE_SIZE)
+def get_sqrt_ratio_at_tick(tick: int) -> int:
+    """
+    sqrt(1.0001 ** tick) as a Q64.96 number, exactly as `TickMath.getSqrtRatioAtTick` computes it
+
+    Results are kept in a bounded per-tick table, since the same ticks come up again and again across
+    positions and tick profiles on a pool.
+    """
+    if not MIN_TICK <= tick <= MAX_TICK:
+        raise ValueError(f"tick {tick} is outside of the range [{MIN_TICK}, {MAX_TICK}]")
+
+    abs_tick = abs(tick)
+    ratio = 0x100000000000000000000000000000000
+    for bit, multiplier in enumerate(TICK_MULTIPLIERS):
+        if abs_tick & (1 << bit):
+            ratio = (ratio * multiplier) >> 128
+
+    if tick > 0:
+        ratio = MAX_UINT256 // ratio
+
+    # round up when going from Q128.128 to Q64.96, so the ratio at a tick is never below the true value
+    return (ratio >> 32) + (0 if ratio % (1 << 32) == 0 else 1)
+
+
+def get_sqrt_ratios_at_ticks(ticks: Iterable[int]) -> List[int]:
+    return [get_sqrt_ratio_at_tick(int(tick)) for tick in ticks]
+
+
+def sqrt_ratio_x96_to_price(sqrt_ratio_x96: int) -> Decimal:
+    return Decimal(sqrt_ratio_x96 * sqrt_ratio_x96) / Decimal(Q192)
+
+
+def mul_div(a: int, b: int, denominator: int) -> int:
+    return (a * b) // denominator
+
+
+def mul_div_rounding_up(a: int, b: int, denominator: int) -> int:
+    return -((-a * b) // denominator)
+
+
+def div_rounding_up(a: int, b: int) -> int:
+    return -(-a // b)
+
+
+def get_amount0_delta(sqrt_ratio_a_x96: int, sqrt_ratio_b_x96: int, liquidity: int, round_up: bool) -> int:
+    """
+    The amount of token0 between two sqrt ratios for a given liquidity, as `SqrtPriceMath.getAmount0Delta`
+    """
+    sqrt_ratio_a_x96, sqrt_ratio_b_x96 = sorted((sqrt_ratio_a_x96, sqrt_ratio_b_x96))
+    if sqrt_ratio_a_x96 <= 0:
+        raise ValueError("sqrt ratio must be positive")
+
+    numerator1 = liquidity << 96
+    numerator2 = sqrt_ratio_b_x96 - sqrt_ratio_a_x96
+    if round_up:
+        return div_rounding_up(
+            mul_div_rounding_up(numerator1, numerator2, sqrt_ratio_b_x96), sqrt_ratio_a_x96
+        )
+    return mul_div(numerator1, numerator2, sqrt_ratio_b_x96) // sqrt_ratio_a_x96
+
+
+def get_amount1_delta(sqrt_ratio_a_x96: int, sqrt_ratio_b_x96: int, liquidity: int, round_up: bool) -> int:
+    """
+    The amount of token1 between two sqrt ratios for a given liquidity, as `SqrtPriceMath.getAmount1Delta`
+    """
+    sqrt_ratio_a_x96, sqrt_ratio_b_x96 = sorted((sqrt_ratio_a_x96, sqrt_ratio_b_x96))
+    if round_up:
+        return mul_div_rounding_up(liquidity, sqrt_ratio_b_x96 - sqrt_ratio_a_x96, Q96)
+    return mul_div(liquidity, sqrt_ratio_b_x96 - sqrt_ratio_a_x96, Q96)
+
+
+def get_amounts_for_liquidity(
+    current_tick: int, sqrt_price_x96: int, tick_lower: int, tick_upper: int, liquidity: int
+) -> Tuple[int, int]:
+    """
+    The token amounts a position's liquidity is worth, in the tokens' smallest units
+
+    This follows the branches of `UniswapV3Pool._modifyPosition` when liquidity is removed, so the amounts
+    are exactly what burning the liquidity would return, rounded down in the pool's favour. A negative
+    liquidity gives the negated amounts.
+    """
+    sign = -1 if liquidity < 0 else 1
+    liquidity = abs(liquidity)
+    sqrt_ratio_lower_x96 = get_sqrt_ratio_at_tick(tick_lower)
+    sqrt_ratio_upper_x96 = get_sqrt_ratio_at_tick(tick_upper)
+
+    if current_tick < tick_lower:
+        amount0 = get_amount0_delta(sqrt_ratio_lower_x96, sqrt_ratio_upper_x96, liquidity, False)
+        amount1 = 0
+    elif current_tick < tick_upper:
+        amount0 = get_amount0_delta(sqrt_price_x96, sqrt_ratio_upper_x96, liquidity, False)
+        amount1 = get_amount1_delta(sqrt_ratio_lower_x96, sqrt_price_x96, liquidity, False)
+    else:
+        amount0 = 0
+        amount1 = get_amount1_delta(sqrt_ratio_lower_x96, sqrt_ratio_upper_x96, liquidity, False)
+
+    return sign * amount0, sign * amount1
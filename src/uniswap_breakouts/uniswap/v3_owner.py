@@ -0,0 +1,94 @@
+import logging
+from typing import List, Optional, Tuple
+
+from uniswap_breakouts.config.datatypes import V3PositionSpec
+from uniswap_breakouts.constants.abis import V3_FACTORY_CONTRACT_ABI
+from uniswap_breakouts.uniswap.pool_state import get_v3_pool_state, prewarm_v3_pool_states
+from uniswap_breakouts.uniswap.v3 import V3LiquiditySnapshot, snapshot_from_position_state
+from uniswap_breakouts.utils.batch_calls import contract_calls_at_block
+from uniswap_breakouts.utils.web3_utils import ContractCall, contract_call_at_block, pin_block_no
+
+logger = logging.getLogger(__name__)
+
+
+def get_owner_token_ids(chain: str, wallet_address: str, nft_address: str, block_no: int) -> List[int]:
+    """
+    Enumerate the position token ids a wallet holds, with `balanceOf` and one batch of `tokenOfOwnerByIndex`
+    """
+    num_positions = contract_call_at_block(
+        chain=chain,
+        interface_address=nft_address,
+        implementation_address=nft_address,
+        fn_name='balanceOf',
+        fn_args=[wallet_address],
+        block_no=block_no,
+    )
+    logger.debug("wallet %s holds %s positions in %s - %s", wallet_address, num_positions, chain, nft_address)
+    token_ids = contract_calls_at_block(
+        chain,
+        [
+            ContractCall(nft_address, nft_address, 'tokenOfOwnerByIndex', [wallet_address, i])
+            for i in range(num_positions)
+        ],
+        block_no,
+    )
+    return [int(token_id) for token_id in token_ids]
+
+
+def get_position_pools(
+    chain: str, factory_address: str, positions_results: List[list], block_no: int
+) -> List[str]:
+    """
+    Find the pool of each position from its tokens and fee, with one `getPool` call per distinct pool
+    """
+    pool_keys = sorted({(result[2], result[3], result[4]) for result in positions_results})
+    pool_addresses = contract_calls_at_block(
+        chain,
+        [
+            ContractCall(factory_address, factory_address, 'getPool', list(pool_key), V3_FACTORY_CONTRACT_ABI)
+            for pool_key in pool_keys
+        ],
+        block_no,
+    )
+    pools_by_key = dict(zip(pool_keys, pool_addresses))
+    return [pools_by_key[(result[2], result[3], result[4])] for result in positions_results]
+
+
+def get_owner_underlying_balances(
+    chain: str, wallet_address: str, nft_address: str, block_no: Optional[int] = None
+) -> List[Tuple[V3PositionSpec, V3LiquiditySnapshot]]:
+    """
+    Get the underlying token balances of every V3 position a wallet holds in a position manager
+
+    Each position comes back with the spec that would evaluate it on its own. Rather than the calls of one
+    `get_underlying_balances` per position, the whole wallet costs a handful of batches: the token ids, every
+    position's `positions` result, the pool of each distinct token pair and fee, and the state of each pool
+    not already in the shared pool state cache.
+    """
+    block_no = pin_block_no(chain, block_no)
+    token_ids = get_owner_token_ids(chain, wallet_address, nft_address, block_no)
+    if not token_ids:
+        return []
+
+    # the position manager knows the factory its pools were deployed by
+    factory_address, *positions_results = contract_calls_at_block(
+        chain,
+        [ContractCall(nft_address, nft_address, 'factory', [])]
+        + [ContractCall(nft_address, nft_address, 'positions', [token_id]) for token_id in token_ids],
+        block_no,
+    )
+    pool_addresses = get_position_pools(chain, factory_address, positions_results, block_no)
+
+    distinct_pools = sorted(set(pool_addresses))
+    logger.debug("wallet %s has positions in %s pools on %s", wallet_address, len(distinct_pools), chain)
+    prewarm_v3_pool_states(chain, distinct_pools, block_no)
+
+    return [
+        (
+            V3PositionSpec(chain, pool_address, nft_address, token_id, block_no),
+            snapshot_from_position_state(
+                get_v3_pool_state(chain, pool_address, block_no), token_id, positions_result
+            ),
+        )
+        for token_id, pool_address, positions_result in zip(token_ids, pool_addresses, positions_results)
+    ]
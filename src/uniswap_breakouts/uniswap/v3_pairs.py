@@ -0,0 +1,178 @@
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import logging
+import math
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from uniswap_breakouts.config.load import get_chain_resource
+from uniswap_breakouts.constants.abis import V3_FACTORY_CONTRACT_ABI
+from uniswap_breakouts.constants.uni_v3 import UNISWAP_V3_FACTORY_ADDRESS, V3_FEE_TIERS
+from uniswap_breakouts.uniswap.v3 import get_virtual_underlyings_from_ranges
+from uniswap_breakouts.uniswap.v3_math import Q96, get_sqrt_ratios_at_ticks
+from uniswap_breakouts.uniswap.v3_ticks import (
+    V3TickLiquiditySnapshot,
+    get_spaced_tick_bounds,
+    get_tick_liquidity_info_for_pool,
+    make_tick_liquidity_df,
+)
+from uniswap_breakouts.utils.batch_calls import contract_calls_at_block
+from uniswap_breakouts.utils.web3_utils import ContractCall, pin_block_no
+
+logger = logging.getLogger(__name__)
+
+
+def get_v3_factory_address(chain: str) -> str:
+    chain_config = get_chain_resource(chain)
+    if chain_config.v3_factory_address is not None:
+        return chain_config.v3_factory_address
+    return UNISWAP_V3_FACTORY_ADDRESS
+
+
+def get_pair_pools(
+    chain: str,
+    token_a: str,
+    token_b: str,
+    fee_tiers: Sequence[int] = V3_FEE_TIERS,
+    block_no: Optional[int] = None,
+) -> Dict[int, str]:
+    """
+    Find the pool of a token pair in each fee tier, from a single batch of factory `getPool` calls
+
+    The factory sorts the tokens itself, so they can be given in either order. Tiers without a pool are left
+    out of the result.
+    """
+    factory_address = get_v3_factory_address(chain)
+    pool_addresses = contract_calls_at_block(
+        chain,
+        [
+            ContractCall(
+                factory_address, factory_address, 'getPool', [token_a, token_b, fee], V3_FACTORY_CONTRACT_ABI
+            )
+            for fee in fee_tiers
+        ],
+        block_no,
+    )
+    # the factory returns the zero address for tiers that have no pool
+    pools = {
+        fee: pool_address
+        for fee, pool_address in zip(fee_tiers, pool_addresses)
+        if int(pool_address, 16) != 0
+    }
+    logger.debug("found pools for %s/%s on %s: %s", token_a, token_b, chain, pools)
+    return pools
+
+
+def get_pair_tick_liquidity_snapshots(
+    chain: str,
+    pool_addresses: Dict[int, str],
+    tick_lens_address: str,
+    depth: Decimal,
+    block_no: Optional[int] = None,
+) -> Dict[int, V3TickLiquiditySnapshot]:
+    """
+    Snapshot the tick liquidity of every pool of a pair at once, all at the same block
+
+    Each pool's calls run on their own thread, so the pools cost about as long as the slowest of them rather
+    than the sum. Pools that were created but never initialized have no price and are left out.
+    """
+    block_no = pin_block_no(chain, block_no)
+    with ThreadPoolExecutor(max_workers=max(len(pool_addresses), 1), thread_name_prefix=chain) as executor:
+        futures = {
+            fee: executor.submit(
+                get_tick_liquidity_info_for_pool, chain, pool_address, tick_lens_address, depth, block_no
+            )
+            for fee, pool_address in pool_addresses.items()
+        }
+        snapshots = {fee: future.result() for fee, future in futures.items()}
+
+    for fee, snapshot in list(snapshots.items()):
+        if snapshot.sqrt_price_x96 == 0:
+            logger.warning("skipping uninitialized pool %s - %s", chain, pool_addresses[fee])
+            del snapshots[fee]
+    return snapshots
+
+
+def resample_liquidity(
+    tick_df: pd.DataFrame, snapshot: V3TickLiquiditySnapshot, grid_ticks: np.ndarray
+) -> np.ndarray:
+    """
+    The liquidity of a pool's tick liquidity dataframe at each tick of a finer grid, in float64
+
+    A grid tick lies in exactly one of the pool's ranges and takes its liquidity, so the rows are found by
+    index without any join.
+    """
+    rows = (grid_ticks - int(tick_df['tick'].iloc[0])) // snapshot.tick_spacing
+    return tick_df['liquidity'].to_numpy(dtype=np.float64)[rows]
+
+
+def get_pair_grid_ticks(
+    snapshots: Dict[int, V3TickLiquiditySnapshot], depth: Decimal, grid_spacing: int
+) -> np.ndarray:
+    """
+    The lower ticks of the grid ranges that every pool's profile within +/- `depth` reaches
+    """
+    tick_bounds = [
+        get_spaced_tick_bounds(snapshot.active_tick, snapshot.tick_spacing, depth)
+        for snapshot in snapshots.values()
+    ]
+    grid_lower = max(tick_lower for tick_lower, _ in tick_bounds)
+    grid_upper = min(
+        tick_upper + snapshot.tick_spacing
+        for snapshot, (_, tick_upper) in zip(snapshots.values(), tick_bounds)
+    )
+    if grid_lower >= grid_upper:
+        raise ValueError(f"the pools' profiles within depth {depth} do not overlap")
+    return np.arange(grid_lower, grid_upper, grid_spacing, dtype=np.int64)
+
+
+def make_pair_liquidity_df(snapshots: Dict[int, V3TickLiquiditySnapshot], depth: Decimal) -> pd.DataFrame:
+    """
+    Merge the tick liquidity of a pair's pools onto one grid of ticks, within +/- `depth` of each pool's price
+
+    The grid's spacing is the greatest common divisor of the pools' tick spacings, so every range of every
+    pool is a whole number of grid ranges, and it covers the prices all of the pools' profiles reach. Each
+    pool's liquidity is kept in its own `liquidity_<fee>` column next to the total. Underlyings are worked out
+    per pool at that pool's own price before they are summed, since the pools' prices differ slightly.
+    """
+    if not snapshots:
+        raise ValueError("no pools to merge")
+    first_snapshot = next(iter(snapshots.values()))
+    for snapshot in snapshots.values():
+        if snapshot.token0.address != first_snapshot.token0.address:
+            raise ValueError("pools to merge must all be pools of the same token pair")
+
+    grid_spacing = math.gcd(*(snapshot.tick_spacing for snapshot in snapshots.values()))
+    grid_ticks = get_pair_grid_ticks(snapshots, depth, grid_spacing)
+    ratios_lower = (np.array(get_sqrt_ratios_at_ticks(grid_ticks), dtype=np.float64) / Q96) ** 2
+    ratios_upper = (
+        np.array(get_sqrt_ratios_at_ticks(grid_ticks + grid_spacing), dtype=np.float64) / Q96
+    ) ** 2
+    decimal_adjustment = 10.0 ** (first_snapshot.token0.decimals - first_snapshot.token1.decimals)
+
+    pair_df = pd.DataFrame(
+        {
+            'tick': grid_ticks,
+            'tick_upper': grid_ticks + grid_spacing,
+            'ratio': ratios_lower * decimal_adjustment,
+            'ratio_upper': ratios_upper * decimal_adjustment,
+        }
+    )
+    # the totals are summed in place as each pool is resampled onto the grid
+    for column in ('liquidity', 'token0_underlying_virtual', 'token1_underlying_virtual'):
+        pair_df[column] = 0.0
+    for fee, snapshot in sorted(snapshots.items()):
+        pool_liquidity = resample_liquidity(make_tick_liquidity_df(snapshot, depth), snapshot, grid_ticks)
+        pool_token0_virtual, pool_token1_virtual = get_virtual_underlyings_from_ranges(
+            float(snapshot.virtual_ratio), ratios_lower, ratios_upper, pool_liquidity
+        )
+        pair_df[f'liquidity_{fee}'] = pool_liquidity
+        pair_df['liquidity'] += pool_liquidity
+        pair_df['token0_underlying_virtual'] += pool_token0_virtual
+        pair_df['token1_underlying_virtual'] += pool_token1_virtual
+
+    pair_df['token0_underlying'] = pair_df['token0_underlying_virtual'] / 10.0**first_snapshot.token0.decimals
+    pair_df['token1_underlying'] = pair_df['token1_underlying_virtual'] / 10.0**first_snapshot.token1.decimals
+    return pair_df
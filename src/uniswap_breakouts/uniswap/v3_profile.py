@@ -0,0 +1,175 @@
+import bisect
+from decimal import Decimal
+import logging
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from uniswap_breakouts.constants.abis import V3_POOL_CONTRACT_ABI
+from uniswap_breakouts.constants.uni_v3 import TICK_BITMAP_ARRAY_LENGTH
+from uniswap_breakouts.uniswap.v3 import q64_96_to_decimal
+from uniswap_breakouts.uniswap.v3_ticks import (
+    TickArrays,
+    V3TickLiquiditySnapshot,
+    get_spaced_tick_bounds,
+    get_tick_liquidity_info_for_pool,
+    get_word_indexes,
+    make_tick_liquidity_df,
+)
+from uniswap_breakouts.utils.logs import DecodedLog, find_event_abi, get_decoded_logs
+from uniswap_breakouts.utils.web3_utils import get_block_number
+
+logger = logging.getLogger(__name__)
+
+PROFILE_EVENT_ABIS = [find_event_abi(V3_POOL_CONTRACT_ABI, event) for event in ('Mint', 'Burn', 'Swap')]
+
+
+class V3LiquidityProfile:
+    """
+    A pool's tick liquidity profile that is kept up to date from the pool's events
+
+    The profile is seeded from a tick lens snapshot, then advanced by applying the pool's Mint, Burn and Swap
+    events in order. Mints and burns change the liquidity net of their range's ticks, and the active liquidity
+    when the range holds the current price. Swaps move the price and report the active tick and liquidity
+    they leave behind. Advancing costs one `eth_getLogs` request per few thousand blocks, rather than the
+    full set of bitmap and tick lens calls a new snapshot needs.
+
+    Only the bitmap words fetched for the seed are known in full. Once the price moves far enough that a
+    requested depth reaches outside them, `covers` is false and the profile should be seeded again.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    # the profile carries the same pool state as a snapshot, along with its tick structures
+
+    def __init__(self, pool_address: str, snapshot: V3TickLiquiditySnapshot, depth: Decimal):
+        if snapshot.block is None:
+            raise ValueError("a liquidity profile must be seeded from a snapshot at a known block")
+        self.pool_address = pool_address
+        self.chain = snapshot.chain
+        self.block: int = snapshot.block
+        self.sqrt_price_x96 = snapshot.sqrt_price_x96
+        self.active_tick = snapshot.active_tick
+        self.active_liquidity = snapshot.active_liquidity
+        self.token0 = snapshot.token0
+        self.token1 = snapshot.token1
+        self.tick_spacing = snapshot.tick_spacing
+
+        # initialized ticks are kept sorted, with their liquidity in a dict alongside
+        self.liquidity_net: Dict[int, int] = dict(
+            zip(snapshot.ticks.ticks.tolist(), snapshot.ticks.liquidity_net.tolist())
+        )
+        self.liquidity_gross: Dict[int, int] = dict(
+            zip(snapshot.ticks.ticks.tolist(), snapshot.ticks.liquidity_gross.tolist())
+        )
+        self.ticks: List[int] = sorted(self.liquidity_net)
+
+        # the seed covers whole bitmap words
+        word_indexes = get_word_indexes(snapshot.active_tick, snapshot.tick_spacing, depth)
+        ticks_per_word = TICK_BITMAP_ARRAY_LENGTH * snapshot.tick_spacing
+        self.covered_tick_lower = min(word_indexes) * ticks_per_word
+        self.covered_tick_upper = (max(word_indexes) + 1) * ticks_per_word - snapshot.tick_spacing
+
+    # pylint: disable=too-many-arguments
+    # the arguments needed to take the seed snapshot
+    @classmethod
+    def from_pool(
+        cls,
+        chain: str,
+        pool_address: str,
+        tick_lens_address: str,
+        depth: Decimal,
+        block_no: Optional[int] = None,
+    ) -> 'V3LiquidityProfile':
+        snapshot = get_tick_liquidity_info_for_pool(chain, pool_address, tick_lens_address, depth, block_no)
+        return cls(pool_address, snapshot, depth)
+
+    def covers(self, depth: Decimal) -> bool:
+        tick_lower, tick_upper = get_spaced_tick_bounds(self.active_tick, self.tick_spacing, depth)
+        return self.covered_tick_lower <= tick_lower and tick_upper <= self.covered_tick_upper
+
+    def update_tick(self, tick: int, liquidity_net_delta: int, liquidity_gross_delta: int) -> None:
+        if tick not in self.liquidity_net:
+            bisect.insort(self.ticks, tick)
+            self.liquidity_net[tick] = 0
+            self.liquidity_gross[tick] = 0
+        self.liquidity_net[tick] += liquidity_net_delta
+        self.liquidity_gross[tick] += liquidity_gross_delta
+
+        # a tick with no liquidity referencing it is cleared from the pool's bitmap
+        if self.liquidity_gross[tick] <= 0:
+            self.ticks.pop(bisect.bisect_left(self.ticks, tick))
+            del self.liquidity_net[tick]
+            del self.liquidity_gross[tick]
+
+    def apply_liquidity_change(self, tick_lower: int, tick_upper: int, liquidity_delta: int) -> None:
+        """
+        Apply a change to a position's liquidity, positive for a mint and negative for a burn
+        """
+        if liquidity_delta == 0:
+            return
+        # both ticks reference the position's liquidity in their gross, the net flips sign at the upper tick
+        self.update_tick(tick_lower, liquidity_delta, liquidity_delta)
+        self.update_tick(tick_upper, -liquidity_delta, liquidity_delta)
+        if tick_lower <= self.active_tick < tick_upper:
+            self.active_liquidity += liquidity_delta
+
+    def apply_swap(self, sqrt_price_x96: int, active_liquidity: int, active_tick: int) -> None:
+        self.sqrt_price_x96 = sqrt_price_x96
+        self.active_liquidity = active_liquidity
+        self.active_tick = active_tick
+
+    def apply_log(self, log: DecodedLog) -> None:
+        if log.event == 'Mint':
+            self.apply_liquidity_change(log.args['tickLower'], log.args['tickUpper'], log.args['amount'])
+        elif log.event == 'Burn':
+            self.apply_liquidity_change(log.args['tickLower'], log.args['tickUpper'], -log.args['amount'])
+        elif log.event == 'Swap':
+            self.apply_swap(log.args['sqrtPriceX96'], log.args['liquidity'], log.args['tick'])
+        else:
+            raise ValueError(f"can not apply {log.event} event to a liquidity profile")
+
+    def advance(self, block_no: Optional[int] = None) -> None:
+        """
+        Bring the profile up to `block_no`, or to the chain's head when no block is given
+        """
+        if block_no is None:
+            block_no = get_block_number(self.chain)
+        if block_no < self.block:
+            raise ValueError(f"can not advance a profile at block {self.block} back to block {block_no}")
+
+        logs = get_decoded_logs(self.chain, self.pool_address, PROFILE_EVENT_ABIS, self.block + 1, block_no)
+        for log in logs:
+            self.apply_log(log)
+        logger.debug(
+            "advanced liquidity profile for %s - %s from block %s to %s with %s events",
+            self.chain,
+            self.pool_address,
+            self.block,
+            block_no,
+            len(logs),
+        )
+        self.block = block_no
+
+    def to_snapshot(self) -> V3TickLiquiditySnapshot:
+        return V3TickLiquiditySnapshot(
+            chain=self.chain,
+            block=self.block,
+            virtual_ratio=q64_96_to_decimal(self.sqrt_price_x96) ** Decimal(2),
+            sqrt_price_x96=self.sqrt_price_x96,
+            active_tick=self.active_tick,
+            active_liquidity=self.active_liquidity,
+            token0=self.token0,
+            token1=self.token1,
+            tick_spacing=self.tick_spacing,
+            ticks=TickArrays.from_tick_infos(
+                (tick, self.liquidity_net[tick], self.liquidity_gross[tick]) for tick in self.ticks
+            ),
+        )
+
+    def make_tick_liquidity_df(self, depth: Decimal, exact: bool = False) -> pd.DataFrame:
+        if not self.covers(depth):
+            raise ValueError(
+                f"depth {depth} around tick {self.active_tick} reaches outside the ticks the profile was "
+                f"seeded with, [{self.covered_tick_lower}, {self.covered_tick_upper}]"
+            )
+        return make_tick_liquidity_df(self.to_snapshot(), depth, exact)
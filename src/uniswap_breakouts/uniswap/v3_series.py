@@ -0,0 +1,156 @@
+import logging
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from uniswap_breakouts.constants.abis import V3_POOL_CONTRACT_ABI, V3_POSITION_MANAGER_EVENTS_ABI
+from uniswap_breakouts.uniswap.pool_state import V3PoolState, get_v3_pool_state
+from uniswap_breakouts.uniswap.v3 import (
+    get_virtual_underlyings_from_ranges,
+    pool_position_string,
+    position_call,
+)
+from uniswap_breakouts.uniswap.v3_math import Q96, get_sqrt_ratio_at_tick
+from uniswap_breakouts.utils.batch_calls import contract_calls_at_block
+from uniswap_breakouts.utils.logs import find_event_abi, get_decoded_logs, get_sample_blocks
+
+logger = logging.getLogger(__name__)
+
+SWAP_EVENT_ABI = find_event_abi(V3_POOL_CONTRACT_ABI, 'Swap')
+POSITION_EVENT_ABIS = [
+    find_event_abi(V3_POSITION_MANAGER_EVENTS_ABI, event)
+    for event in ('IncreaseLiquidity', 'DecreaseLiquidity')
+]
+
+
+def to_float_array(values: Sequence[int]) -> np.ndarray:
+    # uint160 prices and uint128 liquidities do not fit in int64, they are converted from python ints
+    return np.array(values, dtype=object).astype(np.float64)
+
+
+def get_pool_price_changes(pool_state: V3PoolState, to_block: int) -> pd.DataFrame:
+    """
+    The pool's tick and virtual ratio at the end of the pool state's block and of every later block that
+    swapped in the pool
+
+    Only swaps move a V3 pool's price, and each Swap event carries the price and tick the swap left the pool
+    at, so everything after the pool state comes from the pool's Swap events.
+    """
+    swaps = get_decoded_logs(
+        pool_state.chain, pool_state.pool_address, [SWAP_EVENT_ABI], pool_state.block + 1, to_block
+    )
+    logger.debug(
+        "found %s swaps for %s - %s from block %s to %s",
+        len(swaps),
+        pool_state.chain,
+        pool_state.pool_address,
+        pool_state.block,
+        to_block,
+    )
+    price_df = pd.DataFrame(
+        {
+            'block': np.array([pool_state.block] + [swap.block_number for swap in swaps], dtype=np.int64),
+            'tick': np.array([pool_state.tick] + [swap.args['tick'] for swap in swaps], dtype=np.int64),
+            'ratio': (
+                to_float_array([pool_state.sqrt_price_x96] + [swap.args['sqrtPriceX96'] for swap in swaps])
+                / Q96
+            )
+            ** 2,
+        }
+    )
+    # only the price at the end of each block is kept
+    return price_df.drop_duplicates('block', keep='last').reset_index(drop=True)
+
+
+# pylint: disable=too-many-arguments
+# the position, its liquidity at the first block and the blocks to replay
+def get_position_liquidity_changes(
+    chain: str, nft_address: str, nft_id: int, liquidity: int, from_block: int, to_block: int
+) -> pd.DataFrame:
+    """
+    The position's liquidity at the end of `from_block` and of every later block that changed it
+
+    Liquidity only changes through the position manager's IncreaseLiquidity and DecreaseLiquidity events,
+    which are requested for this token id alone.
+    """
+    position_logs = get_decoded_logs(
+        chain, nft_address, POSITION_EVENT_ABIS, from_block + 1, to_block, [f'0x{nft_id:064x}']
+    )
+    blocks = [from_block]
+    liquidities = [liquidity]
+    for log in position_logs:
+        liquidity_delta = log.args['liquidity']
+        liquidities.append(
+            liquidities[-1] + (liquidity_delta if log.event == 'IncreaseLiquidity' else -liquidity_delta)
+        )
+        blocks.append(log.block_number)
+
+    liquidity_df = pd.DataFrame(
+        {'block': np.array(blocks, dtype=np.int64), 'liquidity': to_float_array(liquidities)}
+    )
+    return liquidity_df.drop_duplicates('block', keep='last').reset_index(drop=True)
+
+
+def resample_changes(changes_df: pd.DataFrame, sample_blocks: np.ndarray) -> pd.DataFrame:
+    """
+    The last change at or before each sample block, the first change has to be at or before all of them
+    """
+    rows = np.searchsorted(changes_df['block'].to_numpy(), sample_blocks, side='right') - 1
+    return changes_df.iloc[rows].reset_index(drop=True)
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+# the pool, the position and the blocks to evaluate it at
+def get_underlying_balances_series(
+    chain: str,
+    pool_address: str,
+    nft_address: str,
+    nft_id: int,
+    from_block: int,
+    to_block: int,
+    blocks: Optional[Sequence[int]] = None,
+) -> pd.DataFrame:
+    """
+    Time series equivalent of `v3.get_underlying_balances`, at every block between two blocks, both inclusive,
+    or at each of `blocks` when they are given
+
+    The pool and the position are read once at `from_block`, so the position has to exist by then. After
+    that the price comes from the pool's Swap events and the liquidity from the position's events, and the
+    underlyings at every block are whole-column float64 operations with `get_virtual_underlyings_from_ranges`,
+    rather than the `slot0` and `positions` calls at every block.
+    """
+    sample_blocks = get_sample_blocks(from_block, to_block, blocks)
+
+    logger.debug(
+        "seeding position series for %s", pool_position_string(chain, pool_address, nft_id, from_block)
+    )
+    pool_state = get_v3_pool_state(chain, pool_address, from_block)
+    (positions_info_result,) = contract_calls_at_block(
+        chain, [position_call(nft_address, nft_address, nft_id)], from_block
+    )
+    tick_lower, tick_upper, liquidity = positions_info_result[5:8]
+
+    series_df = resample_changes(get_pool_price_changes(pool_state, to_block), sample_blocks)
+    series_df['block'] = sample_blocks
+    series_df['liquidity'] = resample_changes(
+        get_position_liquidity_changes(chain, nft_address, nft_id, liquidity, from_block, to_block),
+        sample_blocks,
+    )['liquidity']
+
+    # the range is fixed for the life of the position
+    lower_ratio, upper_ratio = (
+        (get_sqrt_ratio_at_tick(tick) / Q96) ** 2 for tick in (tick_lower, tick_upper)
+    )
+    token0_virtual, token1_virtual = get_virtual_underlyings_from_ranges(
+        series_df['ratio'].to_numpy(),
+        np.full(len(series_df), lower_ratio),
+        np.full(len(series_df), upper_ratio),
+        series_df['liquidity'].to_numpy(),
+    )
+
+    token0, token1 = pool_state.tokens
+    series_df['ratio'] *= 10.0 ** (token0.decimals - token1.decimals)
+    series_df['token0_underlying'] = token0_virtual / 10.0**token0.decimals
+    series_df['token1_underlying'] = token1_virtual / 10.0**token1.decimals
+    return series_df
@@ -0,0 +1,228 @@
+from dataclasses import dataclass
+import logging
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+from uniswap_breakouts.uniswap.v3_ticks import V3TickLiquiditySnapshot
+
+logger = logging.getLogger(__name__)
+
+# pool fees are denominated in hundredths of a bip
+FEE_DENOMINATOR = 1_000_000
+
+
+@dataclass(frozen=True)
+class SwapSegments:
+    """
+    The price ranges a swap passes through in order, as float64 sqrt prices and liquidities
+
+    The first segment runs from the current price to the edge of the active range, each following one is a
+    whole range of the tick profile. Amounts are in the tokens' smallest units, and the cumulative amounts are
+    what a swap to the end of each segment takes in and gives out, before fees.
+    """
+
+    zero_for_one: bool
+    sqrt_price_starts: np.ndarray
+    sqrt_price_ends: np.ndarray
+    liquidities: np.ndarray
+    cumulative_amounts_in: np.ndarray
+    cumulative_amounts_out: np.ndarray
+
+
+def get_swap_segments(
+    tick_df: pd.DataFrame, snapshot: V3TickLiquiditySnapshot, zero_for_one: bool
+) -> SwapSegments:
+    """
+    Order the ranges of a tick liquidity dataframe in the direction a swap moves the price
+
+    Selling token0 for token1 pushes the price down through the ranges below the active tick, selling token1
+    pushes it up through the ranges above.
+    """
+    ticks = tick_df['tick'].to_numpy(dtype=np.int64)
+    sqrt_price_lowers = np.sqrt(tick_df['virtual_ratio'].to_numpy(dtype=np.float64))
+    sqrt_price_uppers = np.sqrt(tick_df['virtual_ratio_upper'].to_numpy(dtype=np.float64))
+    liquidities = tick_df['liquidity'].to_numpy(dtype=np.float64)
+    sqrt_price = np.sqrt(float(snapshot.virtual_ratio))
+
+    active_index = int(np.searchsorted(ticks, snapshot.active_tick, side='right')) - 1
+    if active_index < 0 or snapshot.active_tick >= ticks[active_index] + snapshot.tick_spacing:
+        raise ValueError(f"active tick {snapshot.active_tick} is not in the tick liquidity dataframe")
+
+    if zero_for_one:
+        sqrt_price_starts = np.concatenate([[sqrt_price], sqrt_price_lowers[active_index:0:-1]])
+        sqrt_price_ends = sqrt_price_lowers[active_index::-1]
+        liquidities = liquidities[active_index::-1]
+        amounts_in = liquidities * (1 / sqrt_price_ends - 1 / sqrt_price_starts)
+        amounts_out = liquidities * (sqrt_price_starts - sqrt_price_ends)
+    else:
+        sqrt_price_starts = np.concatenate([[sqrt_price], sqrt_price_uppers[active_index:-1]])
+        sqrt_price_ends = sqrt_price_uppers[active_index:]
+        liquidities = liquidities[active_index:]
+        amounts_in = liquidities * (sqrt_price_ends - sqrt_price_starts)
+        amounts_out = liquidities * (1 / sqrt_price_starts - 1 / sqrt_price_ends)
+
+    return SwapSegments(
+        zero_for_one,
+        sqrt_price_starts,
+        sqrt_price_ends,
+        liquidities,
+        np.cumsum(amounts_in),
+        np.cumsum(amounts_out),
+    )
+
+
+def segment_prefixes(segments: SwapSegments, segment_indexes: np.ndarray):
+    """
+    The amounts in and out of a swap to the start of each given segment, along with the segment's start and
+    liquidity. Indexes past the last segment are clipped, callers mask them out.
+    """
+    clipped_indexes = np.minimum(segment_indexes, len(segments.liquidities) - 1)
+    amounts_in_before = np.concatenate([[0.0], segments.cumulative_amounts_in])[clipped_indexes]
+    amounts_out_before = np.concatenate([[0.0], segments.cumulative_amounts_out])[clipped_indexes]
+    return (
+        amounts_in_before,
+        amounts_out_before,
+        segments.sqrt_price_starts[clipped_indexes],
+        segments.liquidities[clipped_indexes],
+    )
+
+
+def swap_through_segments(segments: SwapSegments, amounts_in: np.ndarray) -> pd.DataFrame:
+    """
+    Swap every amount in through the segments at once, returning the amount out and sqrt price after each one
+    """
+    segment_indexes = np.searchsorted(segments.cumulative_amounts_in, amounts_in, side='left')
+    amounts_in_before, amounts_out_before, sqrt_price_starts, liquidities = segment_prefixes(
+        segments, segment_indexes
+    )
+    remaining_amounts_in = amounts_in - amounts_in_before
+
+    # an amount ending exactly on a segment boundary can land on an empty range, the price stays where it is
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if segments.zero_for_one:
+            sqrt_prices_after = 1 / (1 / sqrt_price_starts + remaining_amounts_in / liquidities)
+            amounts_out = amounts_out_before + liquidities * (sqrt_price_starts - sqrt_prices_after)
+        else:
+            sqrt_prices_after = sqrt_price_starts + remaining_amounts_in / liquidities
+            amounts_out = amounts_out_before + liquidities * (1 / sqrt_price_starts - 1 / sqrt_prices_after)
+    empty_range = liquidities == 0
+    sqrt_prices_after = np.where(empty_range, sqrt_price_starts, sqrt_prices_after)
+    amounts_out = np.where(empty_range, amounts_out_before, amounts_out)
+
+    # swaps larger than the liquidity in the profile can not be priced from it
+    beyond_profile = segment_indexes >= len(segments.liquidities)
+    return pd.DataFrame(
+        {
+            'amount_out': np.where(beyond_profile, np.nan, amounts_out),
+            'sqrt_price_after': np.where(beyond_profile, np.nan, sqrt_prices_after),
+        }
+    )
+
+
+def swap_to_sqrt_prices(segments: SwapSegments, target_sqrt_prices: np.ndarray) -> pd.DataFrame:
+    """
+    Find the amounts in and out of swaps that move the price to each target at once
+    """
+    if segments.zero_for_one:
+        # segment ends fall as the price moves down
+        segment_indexes = np.searchsorted(-segments.sqrt_price_ends, -target_sqrt_prices, side='left')
+    else:
+        segment_indexes = np.searchsorted(segments.sqrt_price_ends, target_sqrt_prices, side='left')
+    amounts_in_before, amounts_out_before, sqrt_price_starts, liquidities = segment_prefixes(
+        segments, segment_indexes
+    )
+
+    if segments.zero_for_one:
+        amounts_in = amounts_in_before + liquidities * (1 / target_sqrt_prices - 1 / sqrt_price_starts)
+        amounts_out = amounts_out_before + liquidities * (sqrt_price_starts - target_sqrt_prices)
+    else:
+        amounts_in = amounts_in_before + liquidities * (target_sqrt_prices - sqrt_price_starts)
+        amounts_out = amounts_out_before + liquidities * (1 / sqrt_price_starts - 1 / target_sqrt_prices)
+
+    beyond_profile = segment_indexes >= len(segments.liquidities)
+    return pd.DataFrame(
+        {
+            'amount_in': np.where(beyond_profile, np.nan, amounts_in),
+            'amount_out': np.where(beyond_profile, np.nan, amounts_out),
+        }
+    )
+
+
+# pylint: disable=too-many-arguments
+# the profile, the swaps to simulate and the pool's fee
+def simulate_swaps(
+    tick_df: pd.DataFrame,
+    snapshot: V3TickLiquiditySnapshot,
+    amounts_in: Sequence[float],
+    zero_for_one: bool,
+    fee: int = 0,
+) -> pd.DataFrame:
+    """
+    Simulate swaps of many sizes against a tick liquidity dataframe, without any calls to the pool or a quoter
+
+    `amounts_in` are in whole tokens, of token0 when `zero_for_one` is set and of token1 otherwise, and `fee`
+    is the pool's fee in hundredths of a bip. The results are the whole token amounts out, the pool's ratio
+    after each swap and its price impact. Swaps too large for the liquidity in the dataframe come out as NaN,
+    a deeper profile is needed to price them.
+
+    Amounts are found in float64 by walking the ranges with cumulative sums, the same approach the pool takes
+    one range at a time, so they agree with the pool to float precision.
+    """
+    token_in, token_out = (
+        (snapshot.token0, snapshot.token1) if zero_for_one else (snapshot.token1, snapshot.token0)
+    )
+    amounts_in_array = np.asarray(amounts_in, dtype=np.float64)
+    amounts_in_after_fee = amounts_in_array * 10.0**token_in.decimals * (1 - fee / FEE_DENOMINATOR)
+
+    segments = get_swap_segments(tick_df, snapshot, zero_for_one)
+    swaps_df = swap_through_segments(segments, amounts_in_after_fee)
+
+    return pd.DataFrame(
+        {
+            'amount_in': amounts_in_array,
+            'amount_out': swaps_df['amount_out'] / 10.0**token_out.decimals,
+            'ratio_after': swaps_df['sqrt_price_after'] ** 2
+            * 10.0 ** (snapshot.token0.decimals - snapshot.token1.decimals),
+            'price_impact': swaps_df['sqrt_price_after'] ** 2 / float(snapshot.virtual_ratio) - 1,
+        }
+    )
+
+
+def get_price_impact_ladder(
+    tick_df: pd.DataFrame, snapshot: V3TickLiquiditySnapshot, price_impacts: Sequence[float], fee: int = 0
+) -> pd.DataFrame:
+    """
+    Find the swap sizes that move the pool's price by each of `price_impacts`, given as fractions
+
+    Negative impacts are reached by selling token0 and positive ones by selling token1. The amounts in
+    include the pool's fee, and all amounts are in whole tokens.
+    """
+    impacts = np.asarray(price_impacts, dtype=np.float64)
+    if np.any(impacts <= -1):
+        raise ValueError("price impacts must be greater than -100%")
+
+    target_sqrt_prices = np.sqrt(float(snapshot.virtual_ratio) * (1 + impacts))
+    token0_scale = 10.0**snapshot.token0.decimals
+    token1_scale = 10.0**snapshot.token1.decimals
+
+    ladder_df = pd.DataFrame(
+        {
+            'price_impact': impacts,
+            'token_in': np.where(impacts < 0, snapshot.token0.symbol, snapshot.token1.symbol),
+            'amount_in': np.nan,
+            'amount_out': np.nan,
+        }
+    )
+    for zero_for_one, rows in ((True, impacts < 0), (False, impacts >= 0)):
+        if not rows.any():
+            continue
+        segments = get_swap_segments(tick_df, snapshot, zero_for_one)
+        swaps_df = swap_to_sqrt_prices(segments, target_sqrt_prices[rows])
+        scale_in, scale_out = (token0_scale, token1_scale) if zero_for_one else (token1_scale, token0_scale)
+        ladder_df.loc[rows, 'amount_in'] = (
+            swaps_df['amount_in'].to_numpy() / (1 - fee / FEE_DENOMINATOR) / scale_in
+        )
+        ladder_df.loc[rows, 'amount_out'] = swaps_df['amount_out'].to_numpy() / scale_out
+    return ladder_df
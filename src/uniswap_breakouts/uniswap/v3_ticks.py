@@ -1,35 +1,91 @@
 import typing
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from decimal import Decimal
 import logging
 import math
-from typing import Optional, List
+from typing import Any, Dict, Iterable, Optional, List, Sequence, Tuple, Union
 
-from dataclasses_json import DataClassJsonMixin
+from dataclasses_json import DataClassJsonMixin, config
 import pandas as pd
 import numpy as np
 
 from uniswap_breakouts.constants.abis import V3_POOL_CONTRACT_ABI
 from uniswap_breakouts.constants.uni_v3 import TICK_BITMAP_ARRAY_LENGTH
-from uniswap_breakouts.uniswap.uniswap_utils import PoolToken, get_pool_token_info
+from uniswap_breakouts.uniswap.pool_state import get_v3_pool_state
+from uniswap_breakouts.uniswap.uniswap_utils import PoolToken
 from uniswap_breakouts.uniswap.v3 import (
     q64_96_to_decimal,
     tick_to_price,
-    get_virtual_underlyings_from_range,
-    get_price_info_for_pool,
+    get_virtual_underlyings_from_ranges,
 )
-from uniswap_breakouts.utils.web3_utils import contract_call_at_block
+from uniswap_breakouts.uniswap.v3_math import (
+    MAX_TICK,
+    MIN_TICK,
+    Q96,
+    get_amounts_for_liquidity,
+    get_sqrt_ratios_at_ticks,
+)
+from uniswap_breakouts.utils.batch_calls import contract_calls_at_block
+from uniswap_breakouts.utils.web3_utils import ContractCall, pin_block_no
 
 logger = logging.getLogger(__name__)
 
-BPS_PER_100 = 10000
+# the price ratio between adjacent ticks is 1.0001
+TICK_LOG_BASE = math.log(1.0001)
+
+
+INT64_MIN = -(2**63)
+INT64_MAX = 2**63 - 1
+
+
+def to_int_array(values: Union[Sequence[int], np.ndarray]) -> np.ndarray:
+    """
+    Store integers as int64, falling back to python ints only when a value does not fit
+
+    Liquidity is a 128 bit integer on chain, but real pools' liquidity fits in 64 bits almost always.
+    """
+    if all(INT64_MIN <= value <= INT64_MAX for value in values):
+        return np.array(values, dtype=np.int64)
+    return np.array(values, dtype=object)
 
 
 @dataclass(frozen=True)
-class TickLiquidityInfo:
-    tick: int
-    liquidity_net: int
-    liquidity_gross: int
+class TickArrays:
+    """
+    The initialized ticks of a pool in ascending order, with their liquidity net and gross as parallel arrays
+    """
+
+    ticks: np.ndarray
+    liquidity_net: np.ndarray
+    liquidity_gross: np.ndarray
+
+    @classmethod
+    def from_tick_infos(cls, tick_infos: Iterable[Sequence[int]]) -> 'TickArrays':
+        """
+        Build the arrays from `(tick, liquidityNet, liquidityGross)` rows, as the tick lens returns them
+        """
+        rows = sorted((int(tick), int(net), int(gross)) for tick, net, gross in tick_infos)
+        return cls(
+            np.array([row[0] for row in rows], dtype=np.int64),
+            to_int_array([row[1] for row in rows]),
+            to_int_array([row[2] for row in rows]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.ticks)
+
+    def to_dict(self) -> Dict[str, List[int]]:
+        return {
+            'ticks': self.ticks.tolist(),
+            'liquidity_net': self.liquidity_net.tolist(),
+            'liquidity_gross': self.liquidity_gross.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, tick_arrays: Dict[str, Any]) -> 'TickArrays':
+        return cls.from_tick_infos(
+            zip(tick_arrays['ticks'], tick_arrays['liquidity_net'], tick_arrays['liquidity_gross'])
+        )
 
 
 @dataclass(frozen=True)
@@ -39,18 +95,84 @@ class V3TickLiquiditySnapshot(DataClassJsonMixin):
     chain: str
     block: Optional[int]
     virtual_ratio: Decimal
+    sqrt_price_x96: int
     active_tick: int
     active_liquidity: int
     token0: PoolToken
     token1: PoolToken
     tick_spacing: int
-    ticks: List[TickLiquidityInfo]
+    ticks: TickArrays = field(metadata=config(encoder=TickArrays.to_dict, decoder=TickArrays.from_dict))
 
 
 def pool_string(chain: str, pool_address: str, block_no: Optional[int]) -> str:
     return f"{chain} - {pool_address}" + (f" at block {block_no}" if block_no is not None else "")
 
 
+def get_tick_bounds(active_tick: int, depth: Decimal) -> Tuple[int, int]:
+    """
+    Find the ticks bounding a price range of +/- `depth` around the active tick
+
+    A tick is a power of 1.0001 in price, so the bounds are the active tick offset by the log base 1.0001 of
+    the price moves, rounded outwards and clamped to the ticks the pool supports.
+    """
+    depth_float = float(depth)
+    if depth_float >= 1:
+        tick_lower = MIN_TICK
+    else:
+        tick_lower = math.floor(active_tick + math.log(1 - depth_float) / TICK_LOG_BASE)
+    tick_upper = math.ceil(active_tick + math.log(1 + depth_float) / TICK_LOG_BASE)
+    return max(tick_lower, MIN_TICK), min(tick_upper, MAX_TICK)
+
+
+def get_spaced_tick_bounds(active_tick: int, tick_spacing: int, depth: Decimal) -> Tuple[int, int]:
+    """
+    The lowest and highest spaced ticks whose ranges overlap the price range of +/- `depth`
+
+    Both are kept to ticks a pool can use, so the lower bound is at or above `MIN_TICK` and the range above
+    the upper bound still ends at or below `MAX_TICK`.
+    """
+    tick_lower, tick_upper = get_tick_bounds(active_tick, depth)
+    min_spaced_tick = -(-MIN_TICK // tick_spacing) * tick_spacing
+    max_spaced_tick = ((MAX_TICK - tick_spacing) // tick_spacing) * tick_spacing
+    return (
+        max((tick_lower // tick_spacing) * tick_spacing, min_spaced_tick),
+        min((tick_upper // tick_spacing) * tick_spacing, max_spaced_tick),
+    )
+
+
+def get_word_indexes(active_tick: int, tick_spacing: int, depth: Decimal) -> List[int]:
+    """
+    Find the indexes of the bitmap words covering the ticks within the requested depth, in descending order
+    """
+    # concentrated liquidity bands can only start and stop at ticks divisible by the pool's `tick_spacing`
+    # the bitmap only indexes 'spaced' ticks, a word in the bitmap indexes 256 of them
+    tick_lower, tick_upper = get_spaced_tick_bounds(active_tick, tick_spacing, depth)
+    word_index_lower = (tick_lower // tick_spacing) // TICK_BITMAP_ARRAY_LENGTH
+    word_index_upper = (tick_upper // tick_spacing) // TICK_BITMAP_ARRAY_LENGTH
+
+    # iterate backwards since the ticks come in descending order from the contract within a word
+    return list(range(word_index_upper, word_index_lower - 1, -1))
+
+
+def get_populated_word_indexes(
+    chain: str, pool_address: str, word_indexes: List[int], block_no: Optional[int] = None
+) -> List[int]:
+    """
+    Read the pool's `tickBitmap` for every word in one batch, and keep only the words with initialized ticks
+
+    A set bit in a word marks an initialized tick, so a word of zero has nothing for the tick lens to return.
+    """
+    bitmaps = contract_calls_at_block(
+        chain,
+        [
+            ContractCall(pool_address, pool_address, 'tickBitmap', [word_index], V3_POOL_CONTRACT_ABI)
+            for word_index in word_indexes
+        ],
+        block_no,
+    )
+    return [word_index for word_index, bitmap in zip(word_indexes, bitmaps) if bitmap != 0]
+
+
 def get_initialized_tick_info(  # pylint: disable=too-many-arguments
     chain: str,
     pool_address: str,
@@ -59,14 +181,15 @@ def get_initialized_tick_info(  # pylint: disable=too-many-arguments
     tick_spacing: int,
     depth: Decimal,
     block_no: Optional[int] = None,
-) -> List[TickLiquidityInfo]:
+) -> TickArrays:
     """
     Request liquidity information on ticks around the current tick from the tick lens
 
     The tick lens contract offers one function, getPopulatedTicksInWord, which returns all the initialized
-    ticks in a bitmap word, along with information about their liquidity. We first find the bitmap word of the
-    active tick, then request the ticks above and below that word, depending on the depth of book we are
-    interested in.
+    ticks in a bitmap word, along with information about their liquidity. We first find the ticks bounding the
+    price range we are interested in, then the bitmap words covering those ticks.
+    Most of those words are empty on thinly traded pools, so the pool's bitmap words are read first and the
+    tick lens is only asked about the words with initialized ticks.
 
     See the Uniswap V3 book for more information on the bitmap structure.
 
@@ -74,82 +197,55 @@ def get_initialized_tick_info(  # pylint: disable=too-many-arguments
     difference in `liquidity` between the tick and the previous tick. We know the `liquidity` in the active
     tick, so we can derive the liquidity in all surrounding ticks using 'liquidityNet' later.
     """
+    word_indexes = get_word_indexes(active_tick, tick_spacing, depth)
+    populated_word_indexes = get_populated_word_indexes(chain, pool_address, word_indexes, block_no)
+    logger.debug(
+        "%s of %s bitmap words have initialized ticks on %s - %s",
+        len(populated_word_indexes),
+        len(word_indexes),
+        chain,
+        pool_address,
+    )
 
-    # concentrated liquidity bands can only start and stop at ticks divisible by the pool's `tick_spacing`
-    # the bitmap only indexes 'spaced' ticks, we find the index of the adjacent spaced tick by int division
-    bitmap_current_tick_index = active_tick // tick_spacing
-    bitmap_current_tick_word_index = bitmap_current_tick_index // TICK_BITMAP_ARRAY_LENGTH
-
-    # each tick basically equates to 1bp, a word in the bitmap will index 256 ticks and only includes spaced
-    # ticks. This approximation works ok for small numbers. We round up to ensure we get everything we need
-    word_depth = math.ceil(depth * BPS_PER_100 / (TICK_BITMAP_ARRAY_LENGTH * tick_spacing))
-
-    initialized_tick_list: List[TickLiquidityInfo] = []
-    # iterate backwards since the ticks come in descending order from the contract within a word
-    for i in range(
-        bitmap_current_tick_word_index + word_depth, bitmap_current_tick_word_index - (word_depth + 1), -1
-    ):
-        initialized_ticks_in_word_response = contract_call_at_block(
-            chain=chain,
-            interface_address=tick_lens_address,
-            implementation_address=tick_lens_address,
-            fn_name='getPopulatedTicksInWord',
-            fn_args=[pool_address, i],
-            block_no=block_no,
-            abi=None,
-        )
-        initialized_ticks_in_word = [
-            TickLiquidityInfo(*tick_info) for tick_info in initialized_ticks_in_word_response
-        ]
-        initialized_tick_list.extend(initialized_ticks_in_word)
+    initialized_ticks_in_word_responses = contract_calls_at_block(
+        chain,
+        [
+            ContractCall(tick_lens_address, tick_lens_address, 'getPopulatedTicksInWord', [pool_address, i])
+            for i in populated_word_indexes
+        ],
+        block_no,
+    )
 
-    return initialized_tick_list
+    return TickArrays.from_tick_infos(
+        tick_info
+        for initialized_ticks_in_word_response in initialized_ticks_in_word_responses
+        for tick_info in initialized_ticks_in_word_response
+    )
 
 
 def get_tick_liquidity_info_for_pool(
     chain: str, pool_address: str, tick_lens_address: str, depth: Decimal, block_no: Optional[int] = None
 ) -> V3TickLiquiditySnapshot:
+    # the price, active liquidity and ticks all have to come from the same block to line up
+    block_no = pin_block_no(chain, block_no)
+
     def pool_str() -> str:
         return pool_string(chain, pool_address, block_no)
 
     logger.debug("requesting pool tick liquidity info for pool %s", pool_str())
-    token0 = get_pool_token_info(chain, pool_address, 0, V3_POOL_CONTRACT_ABI)
-    token1 = get_pool_token_info(chain, pool_address, 1, V3_POOL_CONTRACT_ABI)
-
-    logger.debug("getting pool price information for pool %s", pool_str())
-    pool_info_result = get_price_info_for_pool(chain, pool_address, block_no)
+    # the price, active liquidity, tick spacing and tokens are shared with any position in the same pool
+    pool_state = get_v3_pool_state(chain, pool_address, block_no)
+    token0, token1 = pool_state.tokens
+    tick_spacing = pool_state.tick_spacing
+    active_liquidity = pool_state.liquidity
 
     # We calculate the virtual ratio here, which means it is not yet adjusted to the
     # tokens decimals. This is because the virtual ratio is used in downstream calculations
     # and the decimal-adjusted ratio is necessary for display
-    sqrt_price_x96 = int(pool_info_result[0])
+    sqrt_price_x96 = pool_state.sqrt_price_x96
     virtual_ratio = q64_96_to_decimal(sqrt_price_x96) ** Decimal(2)
 
-    active_tick = int(pool_info_result[1])
-
-    logger.debug("getting active liquidity for pool %s", pool_str())
-    active_liquidity = contract_call_at_block(
-        chain=chain,
-        interface_address=pool_address,
-        implementation_address=pool_address,
-        fn_name='liquidity',
-        fn_args=[],
-        block_no=block_no,
-        abi=V3_POOL_CONTRACT_ABI,
-    )
-    assert isinstance(active_liquidity, int)
-
-    logger.debug("getting tick spacing for pool %s", pool_str())
-    tick_spacing = contract_call_at_block(
-        chain=chain,
-        interface_address=pool_address,
-        implementation_address=pool_address,
-        fn_name='tickSpacing',
-        fn_args=[],
-        block_no=block_no,
-        abi=V3_POOL_CONTRACT_ABI,
-    )
-    assert isinstance(tick_spacing, int)
+    active_tick = pool_state.tick
 
     logger.debug("getting initialized ticks around the current range for pool %s", pool_str())
     ticks = get_initialized_tick_info(
@@ -160,6 +256,7 @@ def get_tick_liquidity_info_for_pool(
         chain=chain,
         block=block_no,
         virtual_ratio=virtual_ratio,
+        sqrt_price_x96=sqrt_price_x96,
         active_tick=active_tick,
         active_liquidity=active_liquidity,
         token0=token0,
@@ -170,27 +267,7 @@ def get_tick_liquidity_info_for_pool(
 
 
 @typing.no_type_check  # mypy and pandas/Decimal is weird. The function works and its just for users
-def make_tick_liquidity_df(snapshot: V3TickLiquiditySnapshot, depth: Decimal) -> pd.DataFrame:
-    # reverse order of ticks since we want to cumulatively sum in increasing order
-    logger.debug("calculating liquidity metrics")
-    tick_df = pd.DataFrame(reversed([vars(tick) for tick in snapshot.ticks]))  # type: ignore
-
-    # fill in missing ticks so the dataframe is not sparse
-    all_ticks = pd.DataFrame(
-        {'tick': np.arange(tick_df['tick'].min(), tick_df['tick'].max(), snapshot.tick_spacing)}
-    )
-    tick_df = pd.merge_ordered(tick_df, all_ticks, how='outer', on='tick').fillna(0)
-
-    # "liquidity_net" represents the difference in liquidity between adjacent ticks. We take a cumulative
-    # sum to get the shape of the liquidity profile. We know the liquidity of the active tick, so we use that
-    # to adjust the shape of the liquidity to the correct value
-    tick_df['liquidity_shape'] = tick_df['liquidity_net'].cumsum()
-    active_tick_lower = (snapshot.active_tick // snapshot.tick_spacing) * snapshot.tick_spacing
-    net_active_liquidity = tick_df.loc[tick_df['tick'] == active_tick_lower]['liquidity_shape'].values[0]
-    liquidity_adjustment = snapshot.active_liquidity - net_active_liquidity
-    tick_df['liquidity'] = tick_df['liquidity_shape'] + liquidity_adjustment
-
-    # set up for underlying calculations
+def add_exact_underlyings(tick_df: pd.DataFrame, snapshot: V3TickLiquiditySnapshot) -> None:
     decimal_adjustment = Decimal(10) ** Decimal(snapshot.token0.decimals - snapshot.token1.decimals)
     tick_df['tick_upper'] = tick_df['tick'] + snapshot.tick_spacing
     tick_df['virtual_ratio'] = tick_df['tick'].apply(tick_to_price)
@@ -198,28 +275,97 @@ def make_tick_liquidity_df(snapshot: V3TickLiquiditySnapshot, depth: Decimal) ->
     tick_df['ratio'] = tick_df['virtual_ratio'] * decimal_adjustment
     tick_df['ratio_upper'] = tick_df['virtual_ratio_upper'] * decimal_adjustment
 
-    # Apply the underlying token range function from the v3 module on each tick. We basically treat each tick
-    # treat each tick as its own range position
-    tick_df[['token0_underlying_virtual', 'token1_underlying_virtual']] = tick_df.apply(
-        lambda row: pd.Series(
-            get_virtual_underlyings_from_range(
-                snapshot.virtual_ratio, row['virtual_ratio'], row['virtual_ratio_upper'], row['liquidity']
-            )
-        ),
-        axis=1,
+    # We treat each tick as its own range position, and find its amounts with the pool's integer math
+    tick_amounts = [
+        get_amounts_for_liquidity(
+            snapshot.active_tick, snapshot.sqrt_price_x96, int(tick), int(tick_upper), int(liquidity)
+        )
+        for tick, tick_upper, liquidity in zip(tick_df['tick'], tick_df['tick_upper'], tick_df['liquidity'])
+    ]
+    tick_df['token0_underlying_virtual'] = [token0_amount for token0_amount, _ in tick_amounts]
+    tick_df['token1_underlying_virtual'] = [token1_amount for _, token1_amount in tick_amounts]
+
+    tick_df['token0_underlying'] = tick_df['token0_underlying_virtual'].apply(
+        lambda amount: Decimal(amount) / Decimal(10) ** Decimal(snapshot.token0.decimals)
+    )
+    tick_df['token1_underlying'] = tick_df['token1_underlying_virtual'].apply(
+        lambda amount: Decimal(amount) / Decimal(10) ** Decimal(snapshot.token1.decimals)
     )
 
-    tick_df['token0_underlying'] = tick_df['token0_underlying_virtual'] / Decimal(10) ** Decimal(
-        snapshot.token0.decimals
+
+def add_vectorized_underlyings(tick_df: pd.DataFrame, snapshot: V3TickLiquiditySnapshot) -> None:
+    decimal_adjustment = 10.0 ** (snapshot.token0.decimals - snapshot.token1.decimals)
+    tick_df['tick_upper'] = tick_df['tick'] + snapshot.tick_spacing
+    # prices come from the same per-tick sqrt ratio table as the exact mode
+    sqrt_ratios = np.array(get_sqrt_ratios_at_ticks(tick_df['tick']), dtype=np.float64) / Q96
+    sqrt_ratios_upper = np.array(get_sqrt_ratios_at_ticks(tick_df['tick_upper']), dtype=np.float64) / Q96
+    tick_df['virtual_ratio'] = sqrt_ratios**2
+    tick_df['virtual_ratio_upper'] = sqrt_ratios_upper**2
+    tick_df['ratio'] = tick_df['virtual_ratio'] * decimal_adjustment
+    tick_df['ratio_upper'] = tick_df['virtual_ratio_upper'] * decimal_adjustment
+
+    # every tick is treated as its own range position, all at once
+    token0_underlying_virtual, token1_underlying_virtual = get_virtual_underlyings_from_ranges(
+        float(snapshot.virtual_ratio),
+        tick_df['virtual_ratio'].to_numpy(),
+        tick_df['virtual_ratio_upper'].to_numpy(),
+        tick_df['liquidity'].to_numpy(dtype=np.float64),
     )
-    tick_df['token1_underlying'] = tick_df['token1_underlying_virtual'] / Decimal(10) ** Decimal(
-        snapshot.token1.decimals
+    tick_df['token0_underlying_virtual'] = token0_underlying_virtual
+    tick_df['token1_underlying_virtual'] = token1_underlying_virtual
+
+    tick_df['token0_underlying'] = tick_df['token0_underlying_virtual'] / 10.0**snapshot.token0.decimals
+    tick_df['token1_underlying'] = tick_df['token1_underlying_virtual'] / 10.0**snapshot.token1.decimals
+
+
+@typing.no_type_check  # mypy and pandas/Decimal is weird. The function works and its just for users
+def make_tick_liquidity_df(
+    snapshot: V3TickLiquiditySnapshot, depth: Decimal, exact: bool = False
+) -> pd.DataFrame:
+    """
+    Build a dataframe of the liquidity and underlying tokens in every tick within a price range of +/- `depth`
+    around the active tick
+
+    By default prices and underlyings are calculated in float64 with whole-column numpy operations, which
+    stays fast for pools with thousands of ticks. With `exact` set the underlyings are calculated per tick
+    with the pool's integer math instead, which is slower but matches the contracts exactly.
+    """
+    # only the ticks within the requested price range are processed, these are the same bounds the ticks were
+    # fetched with
+    tick_lower, tick_upper = get_spaced_tick_bounds(snapshot.active_tick, snapshot.tick_spacing, depth)
+
+    logger.debug("calculating liquidity metrics")
+    # the dataframe has a row for every spaced tick in the range, the initialized ticks are placed into their
+    # rows by index so the dataframe is not sparse
+    all_ticks = np.arange(tick_lower, tick_upper + 1, snapshot.tick_spacing)
+    in_range = (snapshot.ticks.ticks >= tick_lower) & (snapshot.ticks.ticks <= tick_upper)
+    rows = (snapshot.ticks.ticks[in_range] - tick_lower) // snapshot.tick_spacing
+    # liquidity is summed as python ints so it stays exact, and is stored as int64 where it fits
+    liquidity_net = np.zeros(len(all_ticks), dtype=object)
+    liquidity_gross = np.zeros(len(all_ticks), dtype=object)
+    liquidity_net[rows] = snapshot.ticks.liquidity_net[in_range]
+    liquidity_gross[rows] = snapshot.ticks.liquidity_gross[in_range]
+
+    # "liquidity_net" represents the difference in liquidity between adjacent ticks. We take a cumulative
+    # sum relative to the active tick to get the shape of the liquidity profile. We know the liquidity of the
+    # active tick, so we use that to get the liquidity in every other tick
+    cumulative_liquidity_net = np.cumsum(liquidity_net)
+    active_row = (snapshot.active_tick // snapshot.tick_spacing) - (tick_lower // snapshot.tick_spacing)
+    liquidity_shape = cumulative_liquidity_net - cumulative_liquidity_net[active_row]
+
+    tick_df = pd.DataFrame(
+        {
+            'tick': all_ticks,
+            'liquidity_net': to_int_array(liquidity_net),
+            'liquidity_gross': to_int_array(liquidity_gross),
+            'liquidity_shape': to_int_array(liquidity_shape),
+            'liquidity': to_int_array(liquidity_shape + snapshot.active_liquidity),
+        }
     )
 
-    # Trim df to requested depth
-    depth_in_ticks = snapshot.active_tick * depth
-    tick_df_trimmed = tick_df.loc[
-        (tick_df["tick"] > (snapshot.active_tick - depth_in_ticks))
-        & (tick_df["tick"] < (snapshot.active_tick + depth_in_ticks))
-    ]
-    return tick_df_trimmed
+    if exact:
+        add_exact_underlyings(tick_df, snapshot)
+    else:
+        add_vectorized_underlyings(tick_df, snapshot)
+
+    return tick_df
@@ -0,0 +1,239 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Sequence
+
+from web3 import AsyncHTTPProvider, AsyncWeb3
+from web3.exceptions import ContractLogicError
+from web3.types import TxParams
+
+from uniswap_breakouts.config.load import get_chain_resource
+from uniswap_breakouts.utils.batch_calls import (
+    cache_results,
+    check_results,
+    get_cached_results,
+    merge_results,
+)
+from uniswap_breakouts.utils.call_cache import cache_call, call_cache_enabled, get_cached_call
+from uniswap_breakouts.utils.multicall import (
+    Aggregate3Request,
+    MulticallUnavailableError,
+    build_aggregate3_requests,
+    check_multicall_deployed,
+    decode_aggregate3_response,
+    get_multicall_address,
+    should_split_aggregate3_request,
+    split_aggregate3_request,
+)
+from uniswap_breakouts.utils.rate_limit import async_call_with_retries
+from uniswap_breakouts.utils.web3_utils import (
+    ContractCall,
+    ContractCallResult,
+    FunctionAbi,
+    decode_contract_call_result,
+    decode_function_result,
+    encode_function_call,
+    get_function_abi,
+    to_checksum_address,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# one async provider per chain, so every coroutine on a chain shares the provider's connection pool
+async_w3_providers: Dict[str, AsyncWeb3] = {}
+
+
+def get_async_w3_provider(chain: str) -> AsyncWeb3:
+    if chain not in async_w3_providers:
+        rpc_url = get_chain_resource(chain).rpc_url
+        # retries are left to the chain's rate limiter, which also backs off when throttled
+        async_w3_providers[chain] = AsyncWeb3(AsyncHTTPProvider(rpc_url, exception_retry_configuration=None))
+    return async_w3_providers[chain]
+
+
+async def async_get_function_abi(chain: str, call: ContractCall) -> FunctionAbi:
+    """
+    Resolve the function abi for a call without blocking the event loop
+
+    Calls without an explicit abi may need their abi requested from the block scanner, which goes through
+    the blocking scanner helpers, so those are resolved in a worker thread. Later lookups hit the function
+    abi cache.
+    """
+    if call.abi is None:
+        return await asyncio.to_thread(get_function_abi, chain, call)
+    return get_function_abi(chain, call)
+
+
+async def async_eth_call_at_block(
+    chain: str, to_address: str, calldata: bytes, block_no: Optional[int] = None
+) -> bytes:
+    w3_provider = get_async_w3_provider(chain)
+    transaction: TxParams = {'to': to_checksum_address(to_address), 'data': calldata}
+    if block_no is None:
+        return bytes(await async_call_with_retries(chain, 'rpc', lambda: w3_provider.eth.call(transaction)))
+    return bytes(
+        await async_call_with_retries(
+            chain, 'rpc', lambda: w3_provider.eth.call(transaction, block_identifier=block_no)
+        )
+    )
+
+
+async def async_get_block_number(chain: str) -> int:
+    w3_provider = get_async_w3_provider(chain)
+    return int(await async_call_with_retries(chain, 'rpc', lambda: w3_provider.eth.block_number))
+
+
+async def async_pin_block_no(chain: str, block_no: Optional[int]) -> int:
+    """
+    Async equivalent of `web3_utils.pin_block_no`
+    """
+    if block_no is None:
+        block_no = await async_get_block_number(chain)
+        logger.info("pinned latest block on %s to %s for async calls", chain, block_no)
+    return block_no
+
+
+async def async_cached_eth_call_at_block(
+    chain: str, to_address: str, calldata: bytes, block_no: Optional[int] = None
+) -> bytes:
+    """
+    Async equivalent of `web3_utils.cached_eth_call_at_block`
+    """
+    return_data = get_cached_call(chain, to_address, calldata, block_no)
+    if return_data is not None:
+        logger.debug("async contract call served from call cache")
+        return return_data
+
+    return_data = await async_eth_call_at_block(chain, to_address, calldata, block_no)
+    cache_call(chain, to_address, calldata, block_no, return_data)
+    return return_data
+
+
+# this is the number of arguments necessary to make a contract call
+# pylint: disable=too-many-arguments
+async def async_contract_call_at_block(
+    chain: str,
+    interface_address: str,
+    implementation_address: str,
+    fn_name: str,
+    fn_args: list,
+    block_no: Optional[int] = None,
+    abi=None,
+):
+    """
+    Async equivalent of `web3_utils.contract_call_at_block`, sharing its abi handling and call cache
+    """
+    logger.debug(
+        "making async contract call: %s %s %s %s at block %s",
+        chain,
+        interface_address,
+        fn_name,
+        fn_args,
+        block_no,
+    )
+    fn_abi = await async_get_function_abi(
+        chain, ContractCall(interface_address, implementation_address, fn_name, fn_args, abi)
+    )
+    calldata = encode_function_call(fn_abi, fn_args)
+
+    return_data = await async_cached_eth_call_at_block(chain, interface_address, calldata, block_no)
+    res = decode_function_result(fn_abi, return_data)
+    logger.debug("async contract call yielded result: %s", res)
+    return res
+
+
+async def async_send_aggregate3_request(
+    chain: str, request: Aggregate3Request, block_no: Optional[int]
+) -> List[ContractCallResult]:
+    try:
+        # the aggregate call itself is never cached, the batching layer caches the individual calls
+        aggregate_return_data = await async_eth_call_at_block(
+            chain, get_multicall_address(chain), request.calldata, block_no
+        )
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        if not should_split_aggregate3_request(chain, request, exc):
+            raise
+        half_results = await asyncio.gather(
+            *[
+                async_send_aggregate3_request(chain, half_request, block_no)
+                for half_request in split_aggregate3_request(chain, request)
+            ]
+        )
+        return [result for results in half_results for result in results]
+    return decode_aggregate3_response(chain, request, aggregate_return_data, block_no)
+
+
+async def async_aggregate3_at_block(
+    chain: str, calls: Sequence[ContractCall], block_no: Optional[int] = None
+) -> List[ContractCallResult]:
+    check_multicall_deployed(chain, block_no)
+    requests = build_aggregate3_requests(chain, calls)
+    logger.debug("sending %s calls in %s multicall chunks on %s", len(calls), len(requests), chain)
+    request_results = await asyncio.gather(
+        *[async_send_aggregate3_request(chain, request, block_no) for request in requests]
+    )
+    return [result for results in request_results for result in results]
+
+
+async def async_individual_call_at_block(
+    chain: str, call: ContractCall, block_no: Optional[int] = None
+) -> ContractCallResult:
+    fn_abi = get_function_abi(chain, call)
+    try:
+        return_data = await async_eth_call_at_block(
+            chain, call.interface_address, encode_function_call(fn_abi, call.fn_args), block_no
+        )
+    except ContractLogicError as exc:
+        return ContractCallResult(call, False, error=str(exc))
+    return decode_contract_call_result(call, fn_abi, return_data)
+
+
+async def async_send_contract_calls_at_block(
+    chain: str, calls: Sequence[ContractCall], block_no: Optional[int] = None
+) -> List[ContractCallResult]:
+    if not calls:
+        return []
+    batch_mode = get_chain_resource(chain).batch_mode
+    logger.debug(
+        "sending %s async batched contract calls on %s with batch mode %s", len(calls), chain, batch_mode
+    )
+    if batch_mode == 'multicall':
+        try:
+            return await async_aggregate3_at_block(chain, calls, block_no)
+        except MulticallUnavailableError:
+            logger.debug(
+                "multicall unavailable on %s at block %s, sending calls individually", chain, block_no
+            )
+    # without multicall the calls go out as concurrent individual requests, which is also how they are sent
+    # for rpc batch mode since the requests overlap on the provider's connection pool anyway
+    return list(
+        await asyncio.gather(*[async_individual_call_at_block(chain, call, block_no) for call in calls])
+    )
+
+
+async def async_try_contract_calls_at_block(
+    chain: str, calls: Sequence[ContractCall], block_no: Optional[int] = None
+) -> List[ContractCallResult]:
+    """
+    Async equivalent of `batch_calls.try_contract_calls_at_block`, with the same ordering and caching
+    """
+    # resolve every abi up front so nothing below has to block on the block scanner
+    await asyncio.gather(*[async_get_function_abi(chain, call) for call in calls])
+
+    if not call_cache_enabled(block_no):
+        return await async_send_contract_calls_at_block(chain, calls, block_no)
+
+    cached_results = get_cached_results(chain, calls, block_no)
+    uncached_calls = [call for call, result in zip(calls, cached_results) if result is None]
+    logger.debug(
+        "%s of %s batched calls served from call cache", len(calls) - len(uncached_calls), len(calls)
+    )
+    sent_results = await async_send_contract_calls_at_block(chain, uncached_calls, block_no)
+    cache_results(chain, sent_results, block_no)
+    return merge_results(cached_results, sent_results)
+
+
+async def async_contract_calls_at_block(
+    chain: str, calls: Sequence[ContractCall], block_no: Optional[int] = None
+) -> List[Any]:
+    return check_results(await async_try_contract_calls_at_block(chain, calls, block_no))
@@ -0,0 +1,136 @@
+import logging
+from typing import Any, List, Optional, Sequence
+
+from web3.exceptions import ContractLogicError
+
+from uniswap_breakouts.config.load import get_chain_resource
+from uniswap_breakouts.utils.call_cache import cache_call, call_cache_enabled, get_cached_call
+from uniswap_breakouts.utils.multicall import MulticallUnavailableError, aggregate3_at_block
+from uniswap_breakouts.utils.rpc_batch import eth_call_batch_at_block
+from uniswap_breakouts.utils.web3_utils import (
+    ContractCall,
+    ContractCallError,
+    ContractCallResult,
+    decode_contract_call_result,
+    encode_function_call,
+    eth_call_at_block,
+    get_function_abi,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def individual_calls_at_block(
+    chain: str, calls: Sequence[ContractCall], block_no: Optional[int] = None
+) -> List[ContractCallResult]:
+    results: List[ContractCallResult] = []
+    for call in calls:
+        fn_abi = get_function_abi(chain, call)
+        try:
+            return_data = eth_call_at_block(
+                chain, call.interface_address, encode_function_call(fn_abi, call.fn_args), block_no
+            )
+        except ContractLogicError as exc:
+            results.append(ContractCallResult(call, False, error=str(exc)))
+            continue
+        results.append(decode_contract_call_result(call, fn_abi, bytes(return_data)))
+    return results
+
+
+def send_contract_calls_at_block(
+    chain: str, calls: Sequence[ContractCall], block_no: Optional[int] = None
+) -> List[ContractCallResult]:
+    if not calls:
+        return []
+    batch_mode = get_chain_resource(chain).batch_mode
+    logger.debug("sending %s batched contract calls on %s with batch mode %s", len(calls), chain, batch_mode)
+    if batch_mode == 'multicall':
+        try:
+            return aggregate3_at_block(chain, calls, block_no)
+        except MulticallUnavailableError:
+            # blocks before the multicall contract was deployed fall back to plain eth_calls
+            logger.debug(
+                "multicall unavailable on %s at block %s, sending calls individually", chain, block_no
+            )
+            return individual_calls_at_block(chain, calls, block_no)
+    if batch_mode == 'rpc':
+        return eth_call_batch_at_block(chain, calls, block_no)
+    return individual_calls_at_block(chain, calls, block_no)
+
+
+def get_cached_results(
+    chain: str, calls: Sequence[ContractCall], block_no: Optional[int]
+) -> List[Optional[ContractCallResult]]:
+    results: List[Optional[ContractCallResult]] = []
+    for call in calls:
+        fn_abi = get_function_abi(chain, call)
+        calldata = encode_function_call(fn_abi, call.fn_args)
+        cached_return_data = get_cached_call(chain, call.interface_address, calldata, block_no)
+        results.append(
+            None
+            if cached_return_data is None
+            else decode_contract_call_result(call, fn_abi, cached_return_data)
+        )
+    return results
+
+
+def cache_results(chain: str, results: Sequence[ContractCallResult], block_no: Optional[int]) -> None:
+    for result in results:
+        if result.success and result.return_data is not None:
+            fn_abi = get_function_abi(chain, result.call)
+            calldata = encode_function_call(fn_abi, result.call.fn_args)
+            cache_call(chain, result.call.interface_address, calldata, block_no, result.return_data)
+
+
+def merge_results(
+    cached_results: List[Optional[ContractCallResult]], sent_results: Sequence[ContractCallResult]
+) -> List[ContractCallResult]:
+    sent_results_iter = iter(sent_results)
+    return [next(sent_results_iter) if result is None else result for result in cached_results]
+
+
+def try_contract_calls_at_block(
+    chain: str, calls: Sequence[ContractCall], block_no: Optional[int] = None
+) -> List[ContractCallResult]:
+    """
+    Make a batch of independent contract calls that share a chain and block
+
+    Results come back in the same order as the calls. A failing call does not raise, its result is
+    marked unsuccessful and carries the error instead. How the calls are sent depends on the `batch_mode`
+    of the chain's resource config.
+
+    When call caching is on, calls at an explicit block are served from the call cache where possible and
+    only the remaining calls are sent. Successful results are added to the cache.
+    """
+    if not call_cache_enabled(block_no):
+        return send_contract_calls_at_block(chain, calls, block_no)
+
+    cached_results = get_cached_results(chain, calls, block_no)
+    uncached_calls = [call for call, result in zip(calls, cached_results) if result is None]
+    logger.debug(
+        "%s of %s batched calls served from call cache", len(calls) - len(uncached_calls), len(calls)
+    )
+    sent_results = send_contract_calls_at_block(chain, uncached_calls, block_no)
+    cache_results(chain, sent_results, block_no)
+    return merge_results(cached_results, sent_results)
+
+
+def check_results(results: Sequence[ContractCallResult]) -> List[Any]:
+    failures = [result for result in results if not result.success]
+    if failures:
+        failure_str = "; ".join(
+            f"{result.call.fn_name} on {result.call.interface_address}: {result.error}" for result in failures
+        )
+        raise ContractCallError(f"{len(failures)} of {len(results)} batched calls failed - {failure_str}")
+    return [result.value for result in results]
+
+
+def contract_calls_at_block(
+    chain: str, calls: Sequence[ContractCall], block_no: Optional[int] = None
+) -> List[Any]:
+    """
+    Batched equivalent of `contract_call_at_block`, returning the decoded value of each call in order
+
+    Raises a ContractCallError naming every failed call if any call in the batch fails
+    """
+    return check_results(try_contract_calls_at_block(chain, calls, block_no))
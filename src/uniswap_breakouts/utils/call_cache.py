@@ -0,0 +1,76 @@
+from dataclasses import dataclass
+import hashlib
+import logging
+import threading
+from typing import Optional
+
+from uniswap_breakouts.utils.env_utils import get_env_variable
+from uniswap_breakouts.utils.sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+CALL_CACHING = False
+try:
+    call_caching_env_var = get_env_variable("CALL_CACHING")
+    if call_caching_env_var == 'TRUE':
+        logger.info("Block-pinned contract call caching has been Enabled")
+        CALL_CACHING = True
+except ValueError:
+    pass
+
+
+@dataclass
+class CallCacheStats:
+    hits: int = 0
+    misses: int = 0
+
+
+call_cache_stats = CallCacheStats()
+call_cache_store: Optional[SqliteStore] = None
+call_cache_lock = threading.Lock()
+
+
+def call_cache_enabled(block_no: Optional[int]) -> bool:
+    # state at a historical block never changes, but calls without a block read whatever the head is
+    return CALL_CACHING and block_no is not None
+
+
+def get_call_cache_store() -> SqliteStore:
+    global call_cache_store  # pylint: disable=global-statement
+    with call_cache_lock:
+        if call_cache_store is None:
+            cache_path = get_env_variable("CALL_CACHE_PATH")
+            logger.debug("opening contract call cache at %s", cache_path)
+            call_cache_store = SqliteStore(cache_path, 'eth_calls')
+        return call_cache_store
+
+
+def call_cache_key(chain: str, to_address: str, calldata: bytes, block_no: int) -> str:
+    key_material = f"{chain}:{to_address.lower()}:{calldata.hex()}:{block_no}"
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+
+def get_cached_call(chain: str, to_address: str, calldata: bytes, block_no: Optional[int]) -> Optional[bytes]:
+    if block_no is None or not CALL_CACHING:
+        return None
+
+    return_data = get_call_cache_store().get(call_cache_key(chain, to_address, calldata, block_no))
+    with call_cache_lock:
+        if return_data is None:
+            call_cache_stats.misses += 1
+        else:
+            call_cache_stats.hits += 1
+    return return_data
+
+
+def cache_call(
+    chain: str, to_address: str, calldata: bytes, block_no: Optional[int], return_data: bytes
+) -> None:
+    if block_no is None or not CALL_CACHING:
+        return
+    get_call_cache_store().put(call_cache_key(chain, to_address, calldata, block_no), return_data)
+
+
+def get_call_cache_stats() -> CallCacheStats:
+    return call_cache_stats
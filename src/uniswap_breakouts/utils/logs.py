@@ -0,0 +1,219 @@
+from dataclasses import dataclass
+import functools
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from eth_abi import decode
+from eth_utils import event_signature_to_log_topic
+from eth_utils.abi import collapse_if_tuple
+import numpy as np
+from web3 import Web3
+from web3._utils.abi import map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3.types import FilterParams, LogReceipt
+
+from uniswap_breakouts.utils.rate_limit import call_with_retries, error_status_code, is_throttle_error
+from uniswap_breakouts.utils.web3_utils import get_w3_provider, to_checksum_address
+
+logger = logging.getLogger(__name__)
+
+# most providers cap the block range of a single eth_getLogs request somewhere between 1k and 10k blocks
+LOG_BLOCK_RANGE = 2000
+# sparse ranges are requested in growing chunks up to this many blocks
+MAX_LOG_BLOCK_RANGE = 100_000
+# chunks grow while they return fewer logs than half of this, well under the result caps providers apply
+LOG_COUNT_TARGET = 2500
+# fragments of the errors providers return when a request covers too many blocks or logs
+LOG_RANGE_ERROR_MESSAGES = ('block range', 'range is too', 'too many', 'more than', 'exceed', 'response size')
+
+
+@dataclass(frozen=True)
+class EventAbi:
+    fragment: dict
+    topic: bytes
+    indexed_names: Tuple[str, ...]
+    indexed_types: Tuple[str, ...]
+    data_names: Tuple[str, ...]
+    data_types: Tuple[str, ...]
+
+    @property
+    def name(self) -> str:
+        return self.fragment['name']
+
+    @classmethod
+    def from_fragment(cls, fragment: dict) -> 'EventAbi':
+        types = tuple(collapse_if_tuple(param) for param in fragment['inputs'])
+        topic = event_signature_to_log_topic(f"{fragment['name']}({','.join(types)})")
+        params = list(zip(fragment['inputs'], types))
+        indexed_params = [(param['name'], param_type) for param, param_type in params if param['indexed']]
+        data_params = [(param['name'], param_type) for param, param_type in params if not param['indexed']]
+        return cls(
+            fragment,
+            topic,
+            tuple(name for name, _ in indexed_params),
+            tuple(param_type for _, param_type in indexed_params),
+            tuple(name for name, _ in data_params),
+            tuple(param_type for _, param_type in data_params),
+        )
+
+
+@dataclass(frozen=True)
+class DecodedLog:
+    event: str
+    address: str
+    block_number: int
+    log_index: int
+    args: Dict[str, Any]
+
+
+def find_event_abi(abi: Any, event_name: str) -> EventAbi:
+    candidates = [
+        fragment for fragment in abi if fragment.get('type') == 'event' and fragment.get('name') == event_name
+    ]
+    if len(candidates) != 1:
+        raise ValueError(f"expected exactly one abi entry for event {event_name}, found {len(candidates)}")
+    return EventAbi.from_fragment(candidates[0])
+
+
+def decode_log(event_abi: EventAbi, log: LogReceipt) -> DecodedLog:
+    """
+    Decode a raw log the same way web3 contract events do, with addresses checksummed
+
+    Indexed parameters are read from the topics after the event topic, everything else from the log data.
+    """
+    indexed_values = [
+        decode([param_type], bytes(topic))[0]
+        for param_type, topic in zip(event_abi.indexed_types, log['topics'][1:])
+    ]
+    data_values = decode(event_abi.data_types, bytes(log['data']))
+
+    args = dict(
+        zip(
+            event_abi.indexed_names,
+            map_abi_data(BASE_RETURN_NORMALIZERS, event_abi.indexed_types, indexed_values),
+        )
+    )
+    args.update(
+        zip(event_abi.data_names, map_abi_data(BASE_RETURN_NORMALIZERS, event_abi.data_types, data_values))
+    )
+    return DecodedLog(
+        event_abi.name,
+        to_checksum_address(log['address']),
+        int(log['blockNumber']),
+        int(log['logIndex']),
+        args,
+    )
+
+
+def is_log_range_error(exc: BaseException) -> bool:
+    if is_throttle_error(exc):
+        return False
+    return error_status_code(exc) == 413 or any(
+        message in str(exc).lower() for message in LOG_RANGE_ERROR_MESSAGES
+    )
+
+
+def get_logs(
+    chain: str, address: str, topics: Sequence[Any], from_block: int, to_block: int
+) -> List[LogReceipt]:
+    """
+    Request the logs an address emitted between two blocks, both inclusive
+
+    The range is split into chunks, since providers cap the block range and the number of logs a single
+    request may cover. Chunks start at `LOG_BLOCK_RANGE` blocks and double while they come back sparse, so
+    quiet contracts are scanned in a few requests. A request the provider rejects as too large is retried
+    with half the range, and the chunks never grow back past a range that was rejected.
+    """
+    w3_provider = get_w3_provider(chain)
+    logs: List[LogReceipt] = []
+    block_range = LOG_BLOCK_RANGE
+    max_block_range = MAX_LOG_BLOCK_RANGE
+    chunk_start = from_block
+    while chunk_start <= to_block:
+        chunk_end = min(chunk_start + block_range - 1, to_block)
+        filter_params: FilterParams = {
+            'address': Web3.to_checksum_address(address),
+            'topics': list(topics),
+            'fromBlock': chunk_start,
+            'toBlock': chunk_end,
+        }
+        logger.debug("requesting logs on %s: %s", chain, filter_params)
+        try:
+            chunk_logs = call_with_retries(
+                chain, 'rpc', functools.partial(w3_provider.eth.get_logs, filter_params)
+            )
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            if block_range == 1 or not is_log_range_error(exc):
+                raise
+            max_block_range = block_range = block_range // 2
+            logger.info(
+                "log request on %s was too large, retrying with %s blocks: %s", chain, block_range, exc
+            )
+            continue
+
+        logs.extend(chunk_logs)
+        chunk_start = chunk_end + 1
+        if len(chunk_logs) < LOG_COUNT_TARGET // 2:
+            block_range = min(block_range * 2, max_block_range)
+    return logs
+
+
+# pylint: disable=too-many-arguments
+# the contract, the events and the blocks to search, plus the indexed values to filter on
+def get_decoded_logs(
+    chain: str,
+    address: str,
+    event_abis: Sequence[EventAbi],
+    from_block: int,
+    to_block: int,
+    indexed_topics: Sequence[Any] = (),
+) -> List[DecodedLog]:
+    """
+    Get every log of the given events an address emitted between two blocks, decoded and in chain order
+
+    `indexed_topics` filter on the events' indexed parameters in order, with None matching any value, so the
+    provider only returns the logs that are needed from a busy contract.
+    """
+    if from_block > to_block:
+        return []
+
+    event_abis_by_topic = {event_abi.topic: event_abi for event_abi in event_abis}
+    # a list in the first topic position matches any of the events
+    logs = get_logs(
+        chain,
+        address,
+        [[f'0x{topic.hex()}' for topic in event_abis_by_topic], *indexed_topics],
+        from_block,
+        to_block,
+    )
+
+    decoded_logs = [
+        decode_log(event_abis_by_topic[bytes(log['topics'][0])], log)
+        for log in logs
+        # logs from blocks that were reorged out are flagged as removed
+        if not log.get('removed', False)
+    ]
+    logger.debug(
+        "decoded %s logs on %s - %s from block %s to %s",
+        len(decoded_logs),
+        chain,
+        address,
+        from_block,
+        to_block,
+    )
+    return sorted(decoded_logs, key=lambda decoded_log: (decoded_log.block_number, decoded_log.log_index))
+
+
+def get_sample_blocks(from_block: int, to_block: int, blocks: Optional[Sequence[int]] = None) -> np.ndarray:
+    """
+    Every block between two blocks, both inclusive, or `blocks` in order when they are given, for series
+    rebuilt from the logs in that range
+    """
+    sample_blocks = (
+        np.arange(from_block, to_block + 1, dtype=np.int64)
+        if blocks is None
+        else np.array(sorted(blocks), dtype=np.int64)
+    )
+    if len(sample_blocks) and (sample_blocks[0] < from_block or sample_blocks[-1] > to_block):
+        raise ValueError(f"blocks must be between {from_block} and {to_block}")
+    return sample_blocks
@@ -0,0 +1,221 @@
+from dataclasses import dataclass
+import logging
+import math
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from uniswap_breakouts.config.load import get_chain_resource
+from uniswap_breakouts.constants.abis import MULTICALL3_ABI
+from uniswap_breakouts.constants.w3 import MULTICALL3_ADDRESS
+from uniswap_breakouts.utils.web3_utils import (
+    ContractCall,
+    ContractCallError,
+    ContractCallResult,
+    FunctionAbi,
+    decode_contract_call_result,
+    decode_function_result,
+    decode_revert_reason,
+    encode_function_call,
+    eth_call_at_block,
+    get_function_abi,
+    to_checksum_address,
+)
+
+logger = logging.getLogger(__name__)
+
+# the cost of the calls in one aggregate3 call, which keeps it well under the gas cap most nodes apply to
+# eth_call. A simple read like `decimals` or `slot0` costs 1
+MULTICALL_CHUNK_COST = 100
+# calls that do far more work than a simple read, by function name
+MULTICALL_CALL_COSTS = {'getPopulatedTicksInWord': 10}
+# fragments of the errors nodes return when an eth_call runs out of gas
+OUT_OF_GAS_ERROR_MESSAGES = ('out of gas', 'gas required exceeds', 'gas limit')
+
+# the highest block on each chain the multicall contract was found missing at, latest is infinitely high
+multicall_missing_blocks: Dict[str, float] = {}
+multicall_missing_blocks_lock = threading.Lock()
+
+
+class MulticallUnavailableError(ContractCallError):
+    pass
+
+
+def get_multicall_address(chain: str) -> str:
+    chain_config = get_chain_resource(chain)
+    if chain_config.multicall_address is not None:
+        return chain_config.multicall_address
+    return MULTICALL3_ADDRESS
+
+
+def block_height(block_no: Optional[int]) -> float:
+    return math.inf if block_no is None else block_no
+
+
+def multicall_deployed_at_block(chain: str, block_no: Optional[int]) -> bool:
+    """
+    Whether the multicall contract can be used at a block, as far as is known
+
+    A contract missing at a block was not deployed yet, so it is missing at every earlier block as well.
+    """
+    with multicall_missing_blocks_lock:
+        missing_block = multicall_missing_blocks.get(chain)
+    return missing_block is None or block_height(block_no) > missing_block
+
+
+def record_multicall_missing(chain: str, block_no: Optional[int]) -> None:
+    with multicall_missing_blocks_lock:
+        multicall_missing_blocks[chain] = max(
+            multicall_missing_blocks.get(chain, -math.inf), block_height(block_no)
+        )
+
+
+def check_multicall_deployed(chain: str, block_no: Optional[int]) -> None:
+    if not multicall_deployed_at_block(chain, block_no):
+        raise MulticallUnavailableError(f"multicall contract is not deployed on {chain} at block {block_no}")
+
+
+def is_out_of_gas_error(exc: BaseException) -> bool:
+    return any(message in str(exc).lower() for message in OUT_OF_GAS_ERROR_MESSAGES)
+
+
+def decode_aggregate3_results(
+    calls: Sequence[ContractCall],
+    fn_abis: Sequence[FunctionAbi],
+    aggregate_result: Sequence[Tuple[bool, bytes]],
+) -> List[ContractCallResult]:
+    results: List[ContractCallResult] = []
+    for call, fn_abi, (success, return_data) in zip(calls, fn_abis, aggregate_result):
+        if not success:
+            results.append(ContractCallResult(call, False, error=decode_revert_reason(return_data)))
+        else:
+            results.append(decode_contract_call_result(call, fn_abi, return_data))
+    return results
+
+
+@dataclass(frozen=True)
+class Aggregate3Request:
+    calls: Sequence[ContractCall]
+    fn_abis: Sequence[FunctionAbi]
+    calldata: bytes
+
+
+def get_aggregate3_abi(chain: str) -> FunctionAbi:
+    multicall_address = get_multicall_address(chain)
+    return get_function_abi(
+        chain, ContractCall(multicall_address, multicall_address, 'aggregate3', [[]], MULTICALL3_ABI)
+    )
+
+
+def build_aggregate3_request(
+    chain: str, calls: Sequence[ContractCall], fn_abis: Sequence[FunctionAbi]
+) -> Aggregate3Request:
+    aggregate_args = [
+        (
+            to_checksum_address(call.interface_address),
+            True,
+            encode_function_call(fn_abi, call.fn_args),
+        )
+        for call, fn_abi in zip(calls, fn_abis)
+    ]
+    calldata = encode_function_call(get_aggregate3_abi(chain), [aggregate_args])
+    return Aggregate3Request(calls, fn_abis, calldata)
+
+
+def build_aggregate3_requests(chain: str, calls: Sequence[ContractCall]) -> List[Aggregate3Request]:
+    """
+    Split calls into aggregate3 requests, each holding calls up to `MULTICALL_CHUNK_COST`
+
+    A call costs 1 unless it is in `MULTICALL_CALL_COSTS`, so fewer heavy calls go into a request than
+    light ones.
+    """
+    fn_abis = [get_function_abi(chain, call) for call in calls]
+
+    requests: List[Aggregate3Request] = []
+    chunk_start, chunk_cost = 0, 0
+    for i, call in enumerate(calls):
+        call_cost = MULTICALL_CALL_COSTS.get(call.fn_name, 1)
+        if i > chunk_start and chunk_cost + call_cost > MULTICALL_CHUNK_COST:
+            requests.append(build_aggregate3_request(chain, calls[chunk_start:i], fn_abis[chunk_start:i]))
+            chunk_start, chunk_cost = i, 0
+        chunk_cost += call_cost
+    if chunk_start < len(calls):
+        requests.append(build_aggregate3_request(chain, calls[chunk_start:], fn_abis[chunk_start:]))
+    return requests
+
+
+def should_split_aggregate3_request(chain: str, request: Aggregate3Request, exc: BaseException) -> bool:
+    # a single call that runs out of gas would fail the same way on its own
+    if len(request.calls) == 1 or not is_out_of_gas_error(exc):
+        return False
+    logger.info(
+        "multicall of %s calls on %s ran out of gas, splitting it: %s", len(request.calls), chain, exc
+    )
+    return True
+
+
+def split_aggregate3_request(chain: str, request: Aggregate3Request) -> List[Aggregate3Request]:
+    middle = len(request.calls) // 2
+    return [
+        build_aggregate3_request(chain, request.calls[:middle], request.fn_abis[:middle]),
+        build_aggregate3_request(chain, request.calls[middle:], request.fn_abis[middle:]),
+    ]
+
+
+def decode_aggregate3_response(
+    chain: str, request: Aggregate3Request, aggregate_return_data: bytes, block_no: Optional[int]
+) -> List[ContractCallResult]:
+    """
+    Decode an aggregate3 call's return data into the results of its calls
+
+    aggregate3 always returns an encoded array, so no return data at all means there was no contract to
+    call. That is recorded for the chain and block and raised as a MulticallUnavailableError.
+    """
+    if not aggregate_return_data:
+        record_multicall_missing(chain, block_no)
+        raise MulticallUnavailableError(f"multicall contract is not deployed on {chain} at block {block_no}")
+    aggregate_result = decode_function_result(get_aggregate3_abi(chain), aggregate_return_data)
+    return decode_aggregate3_results(request.calls, request.fn_abis, aggregate_result)
+
+
+def send_aggregate3_request(
+    chain: str, request: Aggregate3Request, block_no: Optional[int]
+) -> List[ContractCallResult]:
+    logger.debug(
+        "sending %s calls through multicall on %s%s",
+        len(request.calls),
+        chain,
+        f" at block {block_no}" if block_no is not None else "",
+    )
+    try:
+        # the aggregate call itself is never cached, the batching layer caches the individual calls
+        aggregate_return_data = eth_call_at_block(
+            chain, get_multicall_address(chain), request.calldata, block_no
+        )
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        if not should_split_aggregate3_request(chain, request, exc):
+            raise
+        return [
+            result
+            for half_request in split_aggregate3_request(chain, request)
+            for result in send_aggregate3_request(chain, half_request, block_no)
+        ]
+    return decode_aggregate3_response(chain, request, bytes(aggregate_return_data), block_no)
+
+
+def aggregate3_at_block(
+    chain: str, calls: Sequence[ContractCall], block_no: Optional[int] = None
+) -> List[ContractCallResult]:
+    """
+    Make many contract calls in a single `eth_call` through the Multicall3 `aggregate3` endpoint
+
+    Every call is sent with `allowFailure` set, so one reverting call does not take down the rest of
+    the batch. Each result is decoded with the abi of its own call, and failures are reported per call
+    with the revert reason when one is available. A request the node runs out of gas on is split in half
+    and sent again. Blocks before the multicall contract was deployed raise a MulticallUnavailableError.
+    """
+    check_multicall_deployed(chain, block_no)
+    return [
+        result
+        for request in build_aggregate3_requests(chain, calls)
+        for result in send_aggregate3_request(chain, request, block_no)
+    ]
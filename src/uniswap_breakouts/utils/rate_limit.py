@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+import aiohttp
+import requests
+from web3.exceptions import ContractLogicError, Web3RPCError
+
+from uniswap_breakouts.config.load import get_chain_resource
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# block scanners allow about 5 requests per second on their free tiers
+DEFAULT_SCANNER_RATE_LIMIT = 5.0
+DEFAULT_RPC_RATE_LIMIT = 25.0
+
+# additive increase, multiplicative decrease: after being throttled the rate halves, then recovers by a small
+# fraction of the configured limit with every successful request
+RATE_DECREASE_FACTOR = 0.5
+RATE_INCREASE_FRACTION = 0.02
+MIN_RATE_FRACTION = 0.05
+
+MAX_RETRIES = 5
+RETRY_BASE_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 30.0
+
+# json-rpc error codes providers use to signal rate limiting
+RATE_LIMIT_ERROR_CODES = (-32005, -32029, 429)
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class ScannerRateLimitError(ValueError):
+    pass
+
+
+class RateLimiter:
+    """
+    A token bucket whose refill rate adapts to the errors it sees
+
+    `reserve` takes a token and returns how long the caller must wait before sending its request, so the
+    same limiter can be shared by threads that sleep and coroutines that await. Tokens are allowed to go
+    negative, which queues callers behind each other rather than letting them race for the next token.
+    """
+
+    def __init__(self, name: str, max_rate: float):
+        if max_rate <= 0:
+            raise ValueError(f"rate limit for {name} must be positive, got {max_rate}")
+        self.name = name
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self._capacity = max(1.0, max_rate)
+        self._tokens = self._capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def min_rate(self) -> float:
+        return self.max_rate * MIN_RATE_FRACTION
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def reserve(self) -> float:
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_INCREASE_FRACTION)
+
+    def record_throttle(self) -> None:
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE_FACTOR)
+            self._tokens = min(self._tokens, 0.0)
+            logger.info("%s throttled, reducing request rate to %.2f/s", self.name, self.rate)
+
+
+rate_limiters: Dict[Tuple[str, str], RateLimiter] = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(chain: str, endpoint: str) -> RateLimiter:
+    """
+    Get the shared limiter for a chain's `rpc` or `scanner` endpoint
+
+    Limits come from the chain's resource config, falling back on defaults that suit free tier providers
+    """
+    with rate_limiters_lock:
+        if (chain, endpoint) not in rate_limiters:
+            chain_config = get_chain_resource(chain)
+            if endpoint == 'scanner':
+                max_rate = chain_config.scanner_rate_limit or DEFAULT_SCANNER_RATE_LIMIT
+            else:
+                max_rate = chain_config.rpc_rate_limit or DEFAULT_RPC_RATE_LIMIT
+            rate_limiters[(chain, endpoint)] = RateLimiter(f"{chain} {endpoint}", max_rate)
+        return rate_limiters[(chain, endpoint)]
+
+
+def error_status_code(exc: BaseException) -> Optional[int]:
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status
+    return None
+
+
+def is_throttle_error(exc: BaseException) -> bool:
+    if isinstance(exc, ScannerRateLimitError) or error_status_code(exc) == 429:
+        return True
+    if isinstance(exc, Web3RPCError) and not isinstance(exc, ContractLogicError):
+        rpc_error: Any = (exc.rpc_response or {}).get('error') or {}
+        error_code = rpc_error.get('code') if isinstance(rpc_error, dict) else None
+        return error_code in RATE_LIMIT_ERROR_CODES or 'rate limit' in str(exc).lower()
+    return False
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    """
+    Throttling, timeouts, dropped connections and server errors are worth retrying. Reverts and client
+    errors would fail the same way again.
+    """
+    if is_throttle_error(exc):
+        return True
+    if isinstance(
+        exc,
+        (
+            requests.Timeout,
+            requests.ConnectionError,
+            asyncio.TimeoutError,
+            aiohttp.ClientConnectionError,
+        ),
+    ):
+        return True
+    return error_status_code(exc) in RETRYABLE_STATUS_CODES
+
+
+def retry_delay(exc: BaseException, attempt: int) -> float:
+    # providers sometimes say how long to back off for, otherwise back off exponentially with full jitter
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        retry_after = exc.response.headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            return min(RETRY_MAX_BACKOFF, float(retry_after))
+    return random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BASE_BACKOFF * 2**attempt))
+
+
+def record_failure(limiter: RateLimiter, exc: Exception, attempt: int) -> float:
+    if is_throttle_error(exc):
+        limiter.record_throttle()
+    delay = retry_delay(exc, attempt)
+    logger.warning(
+        "request to %s failed on attempt %s of %s, retrying in %.2fs: %s",
+        limiter.name,
+        attempt + 1,
+        MAX_RETRIES + 1,
+        delay,
+        exc,
+    )
+    return delay
+
+
+def call_with_retries(chain: str, endpoint: str, request_fn: Callable[[], T]) -> T:
+    """
+    Make a request through the chain endpoint's rate limiter, retrying transient failures
+
+    Retries back off exponentially with jitter, and throttling responses also slow down the limiter shared
+    by every other request to the endpoint. The last error is raised once the retries run out.
+    """
+    limiter = get_rate_limiter(chain, endpoint)
+    for attempt in range(MAX_RETRIES):
+        time.sleep(limiter.reserve())
+        try:
+            result = request_fn()
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            if not is_retryable_error(exc):
+                raise
+            time.sleep(record_failure(limiter, exc, attempt))
+            continue
+        limiter.record_success()
+        return result
+
+    # the last attempt raises whatever error it hits
+    time.sleep(limiter.reserve())
+    return request_fn()
+
+
+async def async_call_with_retries(chain: str, endpoint: str, request_fn: Callable[[], Awaitable[T]]) -> T:
+    """
+    Async equivalent of `call_with_retries`, sharing the same limiters
+    """
+    limiter = get_rate_limiter(chain, endpoint)
+    for attempt in range(MAX_RETRIES):
+        await asyncio.sleep(limiter.reserve())
+        try:
+            result = await request_fn()
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            if not is_retryable_error(exc):
+                raise
+            await asyncio.sleep(record_failure(limiter, exc, attempt))
+            continue
+        limiter.record_success()
+        return result
+
+    # the last attempt raises whatever error it hits
+    await asyncio.sleep(limiter.reserve())
+    return await request_fn()
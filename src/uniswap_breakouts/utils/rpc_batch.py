@@ -0,0 +1,122 @@
+import functools
+import logging
+from typing import Any, List, Optional, Sequence
+
+import requests
+from web3.exceptions import Web3RPCError
+
+from uniswap_breakouts.config.load import get_chain_resource
+from uniswap_breakouts.utils.rate_limit import RATE_LIMIT_ERROR_CODES, call_with_retries
+from uniswap_breakouts.utils.web3_utils import (
+    ContractCall,
+    ContractCallError,
+    ContractCallResult,
+    FunctionAbi,
+    decode_contract_call_result,
+    encode_function_call,
+    get_function_abi,
+    get_rpc_session,
+    to_checksum_address,
+)
+
+logger = logging.getLogger(__name__)
+
+# most providers cap the number of requests in one JSON-RPC batch somewhere between 100 and 1000
+RPC_BATCH_CHUNK_SIZE = 100
+RPC_BATCH_TIMEOUT = 30
+
+
+def build_eth_call_request(
+    request_id: int, call: ContractCall, fn_abi: FunctionAbi, block_identifier: str
+) -> dict:
+    transaction = {
+        'to': to_checksum_address(call.interface_address),
+        'data': '0x' + encode_function_call(fn_abi, call.fn_args).hex(),
+    }
+    return {
+        'jsonrpc': '2.0',
+        'id': request_id,
+        'method': 'eth_call',
+        'params': [transaction, block_identifier],
+    }
+
+
+def decode_rpc_batch_response(
+    calls: Sequence[ContractCall], fn_abis: Sequence[FunctionAbi], batch_response: List[dict]
+) -> List[ContractCallResult]:
+    # responses in a batch may come back in any order, so we match them to their request by id
+    responses_by_id = {rpc_response.get('id'): rpc_response for rpc_response in batch_response}
+
+    results: List[ContractCallResult] = []
+    for request_id, (call, fn_abi) in enumerate(zip(calls, fn_abis)):
+        rpc_response = responses_by_id.get(request_id)
+        if rpc_response is None:
+            results.append(ContractCallResult(call, False, error="no response in json-rpc batch"))
+        elif 'error' in rpc_response:
+            results.append(ContractCallResult(call, False, error=str(rpc_response['error'].get('message'))))
+        else:
+            return_data = bytes.fromhex(rpc_response['result'].removeprefix('0x'))
+            results.append(decode_contract_call_result(call, fn_abi, return_data))
+    return results
+
+
+def is_throttled_rpc_response(rpc_response: Any) -> bool:
+    rpc_error = rpc_response.get('error') if isinstance(rpc_response, dict) else None
+    return isinstance(rpc_error, dict) and rpc_error.get('code') in RATE_LIMIT_ERROR_CODES
+
+
+def post_rpc_batch(session: requests.Session, rpc_url: str, payload: List[dict]) -> Any:
+    """
+    Post a JSON-RPC batch, raising on throttling so the whole batch is retried
+
+    Providers also throttle with a 200 response, either as a single error object for the batch or as errors
+    on some of its items. Those are raised as rpc errors that `call_with_retries` backs off on, rather than
+    failing the calls. Any other error on an item, like a revert, is left to that call's result.
+    """
+    response = session.post(rpc_url, json=payload, timeout=RPC_BATCH_TIMEOUT)
+    response.raise_for_status()
+    batch_response = response.json()
+    rpc_responses = batch_response if isinstance(batch_response, list) else [batch_response]
+    for rpc_response in rpc_responses:
+        if is_throttled_rpc_response(rpc_response):
+            raise Web3RPCError(f"json-rpc batch request throttled: {rpc_response['error']}", rpc_response)
+    return batch_response
+
+
+def eth_call_batch_at_block(
+    chain: str, calls: Sequence[ContractCall], block_no: Optional[int] = None
+) -> List[ContractCallResult]:
+    """
+    Make many contract calls as `eth_call` requests in a single JSON-RPC batch request
+
+    This is the batching option for rpc providers that do not allow contract based multicall. The requests
+    go out in one HTTP POST over the chain's pooled session, and an rpc error on one call is reported on
+    that call's result only. Throttling is the exception, it retries the whole chunk.
+    """
+    rpc_url = get_chain_resource(chain).rpc_url
+    session = get_rpc_session(chain)
+    block_identifier = hex(block_no) if block_no is not None else 'latest'
+    fn_abis = [get_function_abi(chain, call) for call in calls]
+
+    results: List[ContractCallResult] = []
+    for chunk_start in range(0, len(calls), RPC_BATCH_CHUNK_SIZE):
+        chunk_calls = calls[chunk_start : chunk_start + RPC_BATCH_CHUNK_SIZE]
+        chunk_fn_abis = fn_abis[chunk_start : chunk_start + RPC_BATCH_CHUNK_SIZE]
+        logger.debug(
+            "sending %s calls in a json-rpc batch on %s at %s", len(chunk_calls), chain, block_identifier
+        )
+
+        payload = [
+            build_eth_call_request(request_id, call, fn_abi, block_identifier)
+            for request_id, (call, fn_abi) in enumerate(zip(chunk_calls, chunk_fn_abis))
+        ]
+        batch_response = call_with_retries(
+            chain, 'rpc', functools.partial(post_rpc_batch, session, rpc_url, payload)
+        )
+        if not isinstance(batch_response, list):
+            # providers that do not support batching answer with a single error object
+            raise ContractCallError(f"json-rpc batch request rejected by {chain} rpc: {batch_response}")
+
+        results.extend(decode_rpc_batch_response(chunk_calls, chunk_fn_abis, batch_response))
+
+    return results
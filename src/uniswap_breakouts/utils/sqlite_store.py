@@ -0,0 +1,51 @@
+import logging
+import sqlite3
+import threading
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# how long a connection waits on a lock held by another process before giving up
+SQLITE_BUSY_TIMEOUT = 30
+
+
+class SqliteStore:
+    """
+    A small persistent key-value store backed by a single sqlite table
+
+    Every read and write touches only its own key, and each write is committed in its own transaction, so
+    a crash can never leave a partially written store behind. The database runs in WAL mode so several
+    processes can read while one writes. Connections are not shared between threads.
+    """
+
+    def __init__(self, path: str, table: str):
+        self.path = path
+        self.table = table
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value BLOB)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            logger.debug("opening sqlite store at %s", self.path)
+            connection = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._connection().execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key: str, value: bytes) -> None:
+        with self._connection() as connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    def keys(self) -> List[str]:
+        return [row[0] for row in self._connection().execute(f"SELECT key FROM {self.table}")]
+
+    def __len__(self) -> int:
+        return self._connection().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
@@ -1,12 +1,28 @@
-import pickle
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import functools
+import json
 import logging
-from typing import Optional
+import threading
+from typing import Any, Dict, Optional, Sequence, Tuple
 import urllib.parse
 
+from eth_abi import decode, encode
+from eth_abi.exceptions import DecodingError
+from eth_utils import function_signature_to_4byte_selector
+from eth_utils.abi import collapse_if_tuple
 import requests
+from requests.adapters import HTTPAdapter
 from web3 import Web3
+from web3._utils.abi import map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3.types import TxParams
 
+from uniswap_breakouts.utils.call_cache import cache_call, get_cached_call
 from uniswap_breakouts.utils.env_utils import get_env_variable
+from uniswap_breakouts.utils.rate_limit import ScannerRateLimitError, call_with_retries
+from uniswap_breakouts.utils.sqlite_store import SqliteStore
 from uniswap_breakouts.config.load import get_chain_resource
 
 logger = logging.getLogger(__name__)
@@ -22,10 +38,65 @@ except ValueError:
     pass
 
 
+# number of abis kept in memory in front of the persistent abi cache
+ABI_LRU_SIZE = 512
+
+abi_store: Optional[SqliteStore] = None
+
+# number of resolved function abis kept in memory, each one is a single abi fragment with its codec types
+FUNCTION_ABI_CACHE_SIZE = 1024
+CHECKSUM_ADDRESS_CACHE_SIZE = 4096
+
+
+# upper bound on the keep-alive connections held open to a single rpc endpoint
+RPC_CONNECTION_POOL_SIZE = 32
+
+rpc_sessions: Dict[str, requests.Session] = {}
+w3_providers: Dict[str, Web3] = {}
+
+# guards creating the shared sessions, providers and abi store, which may be first needed by several
+# report worker threads at once
+shared_resources_lock = threading.Lock()
+# the abi request in flight for each contract, concurrent misses for the same abi wait on it rather than
+# making their own scanner request, and misses for different abis go out in parallel
+abi_requests: Dict[str, Future] = {}
+abi_requests_lock = threading.Lock()
+function_abis_lock = threading.Lock()
+
+
+def get_rpc_session(chain: str) -> requests.Session:
+    """
+    Get the long-lived HTTP session for a chain's rpc endpoint
+
+    Requests made through the session reuse pooled keep-alive connections, so we only pay for TCP and TLS
+    setup once per connection rather than once per call
+    """
+    with shared_resources_lock:
+        if chain not in rpc_sessions:
+            logger.debug("creating pooled rpc session for %s", chain)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=RPC_CONNECTION_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            rpc_sessions[chain] = session
+        return rpc_sessions[chain]
+
+
 def get_w3_provider(chain: str) -> Web3:
     logger.debug("getting web3 provider for %s", chain)
-    chain_config = get_chain_resource(chain)
-    return Web3(Web3.HTTPProvider(chain_config.rpc_url))
+    if chain not in w3_providers:
+        chain_config = get_chain_resource(chain)
+        session = get_rpc_session(chain)
+        with shared_resources_lock:
+            if chain not in w3_providers:
+                logger.debug("creating web3 provider for %s", chain)
+                # retries are left to the chain's rate limiter, which also backs off when throttled
+                w3_providers[chain] = Web3(
+                    Web3.HTTPProvider(
+                        chain_config.rpc_url, session=session, exception_retry_configuration=None
+                    )
+                )
+    return w3_providers[chain]
 
 
 def construct_scanner_url(chain: str, params: dict) -> str:
@@ -36,49 +107,304 @@ def construct_scanner_url(chain: str, params: dict) -> str:
     return url
 
 
-def extract_json_or_except(response: requests.Response) -> dict:
+def extract_json_or_except(response: requests.Response) -> Any:
+    response.raise_for_status()
     try:
-        return response.json()['result']
+        response_json = response.json()
     except requests.exceptions.JSONDecodeError as exc:
         logger.error("Error decoding json in ABI request response: %s", response.text)
         raise exc
 
+    # scanners answer rate limited requests with a normal response and a message in place of the result
+    result = response_json['result']
+    if response_json.get('status') == '0' and isinstance(result, str) and 'rate limit' in result.lower():
+        raise ScannerRateLimitError(result)
+    return result
+
+
+def get_abi_store() -> SqliteStore:
+    global abi_store  # pylint: disable=global-statement
+    with shared_resources_lock:
+        if abi_store is None:
+            cache_path = get_env_variable("CACHE_PATH")
+            logger.debug("accessing abi cache path at %s", cache_path)
+            abi_store = SqliteStore(cache_path, 'abis')
+        return abi_store
+
+
+def abi_cache_key(chain: str, address: str) -> str:
+    return f"{chain}:{address.lower()}"
+
 
-def get_abi(chain: str, address: str) -> dict:
+def request_abi(chain: str, address: str) -> list:
     abi_request_params = {"module": "contract", "action": "getabi", "address": address}
 
     url = construct_scanner_url(chain, abi_request_params)
     logger.debug("constructed url for abi request: %s", url)
 
-    if CACHING:
-        cache_path = get_env_variable("CACHE_PATH")
-        logger.debug("accessing abi cache path at %s", cache_path)
-        try:
-            with open(cache_path, 'rb') as pickle_file:
-                past_requests = pickle.load(pickle_file)
-                logger.debug("cache loaded successfully")
-        except FileNotFoundError:
-            logger.debug("no cache found at %s, cache will be created", cache_path)
-            past_requests = {}
-        if url in past_requests.keys():
-            abi = past_requests[url]
-            logger.debug("abi found in cache")
-        else:
-            logger.debug("abi not found in cache, requesting from scanner")
-            abi_response = requests.get(url, timeout=10)
-            abi = extract_json_or_except(abi_response)
-            past_requests[url] = abi
-            logger.debug("abi request returned, adding to cache")
-            with open(cache_path, 'wb') as pickle_file:
-                pickle.dump(past_requests, pickle_file)
-    else:
+    abi_result = call_with_retries(
+        chain, 'scanner', lambda: extract_json_or_except(requests.get(url, timeout=10))
+    )
+    # the scanner returns the abi as a json string, or a plain message when the contract is not verified
+    try:
+        return json.loads(abi_result) if isinstance(abi_result, str) else abi_result
+    except json.JSONDecodeError as exc:
+        logger.error("Error decoding abi for %s - %s: %s", chain, address, abi_result)
+        raise ValueError(f"Could not get abi for {chain} - {address}: {abi_result}") from exc
+
+
+def load_abi(chain: str, address: str) -> list:
+    if not CACHING:
         logger.debug("caching is off. requesting from scanner")
-        abi_response = requests.get(url, timeout=10)
-        abi = extract_json_or_except(abi_response)
+        return request_abi(chain, address)
 
+    cache_key = abi_cache_key(chain, address)
+    cached_abi = get_abi_store().get(cache_key)
+    if cached_abi is not None:
+        logger.debug("abi found in cache")
+        return json.loads(cached_abi)
+
+    logger.debug("abi not found in cache, requesting from scanner")
+    abi = request_abi(chain, address)
+    logger.debug("abi request returned, adding to cache")
+    get_abi_store().put(cache_key, json.dumps(abi).encode('utf-8'))
     return abi
 
 
+@functools.lru_cache(maxsize=ABI_LRU_SIZE)
+def get_abi(chain: str, address: str) -> list:
+    """
+    Get the abi for a contract, from memory, the persistent abi cache or the block scanner
+
+    The most recently used abis are held in memory. When caching is on, abis are also kept in a sqlite
+    store keyed by chain and address, so a lookup reads a single row and a miss writes a single row in
+    its own transaction, which keeps the store consistent across crashes and concurrent runs.
+
+    The in-memory LRU is thread safe. Each abi has at most one miss in flight, threads missing on the same
+    abi at once share its result, and misses for different abis do not wait on each other.
+    """
+    cache_key = abi_cache_key(chain, address)
+    with abi_requests_lock:
+        abi_request = abi_requests.get(cache_key)
+        owns_request = abi_request is None
+        if abi_request is None:
+            abi_request = abi_requests[cache_key] = Future()
+    if not owns_request:
+        logger.debug("waiting on the abi request in flight for %s - %s", chain, address)
+        return abi_request.result()
+
+    try:
+        abi = load_abi(chain, address)
+        abi_request.set_result(abi)
+        return abi
+    except BaseException as exc:
+        abi_request.set_exception(exc)
+        raise
+    finally:
+        with abi_requests_lock:
+            del abi_requests[cache_key]
+
+
+@dataclass(frozen=True)
+class ContractCall:
+    interface_address: str
+    implementation_address: str
+    fn_name: str
+    fn_args: Sequence[Any] = ()
+    abi: Optional[Any] = field(default=None, repr=False)
+
+
+@dataclass(frozen=True)
+class ContractCallResult:
+    call: ContractCall
+    success: bool
+    value: Any = None
+    error: Optional[str] = None
+    return_data: Optional[bytes] = field(default=None, repr=False)
+
+
+class ContractCallError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class FunctionAbi:
+    fragment: dict
+    selector: bytes
+    input_types: Tuple[str, ...]
+    output_types: Tuple[str, ...]
+
+    @classmethod
+    def from_fragment(cls, fragment: dict) -> 'FunctionAbi':
+        input_types = tuple(collapse_if_tuple(param) for param in fragment['inputs'])
+        output_types = tuple(collapse_if_tuple(param) for param in fragment.get('outputs', []))
+        selector = function_signature_to_4byte_selector(f"{fragment['name']}({','.join(input_types)})")
+        return cls(fragment, selector, input_types, output_types)
+
+
+# keyed on the identity of the abi object, the cached entry holds a reference to the abi so the id can not
+# be reused by a different abi while the entry is alive. This avoids hashing large abis on every call
+function_abis: 'OrderedDict[Tuple[int, str, int], Tuple[Any, FunctionAbi]]' = OrderedDict()
+
+
+@functools.lru_cache(maxsize=CHECKSUM_ADDRESS_CACHE_SIZE)
+def to_checksum_address(address: str) -> str:
+    return Web3.to_checksum_address(address)
+
+
+def find_function_abi(abi: Any, call: ContractCall) -> FunctionAbi:
+    candidates = [
+        fragment
+        for fragment in abi
+        if fragment.get('type') == 'function'
+        and fragment.get('name') == call.fn_name
+        and len(fragment.get('inputs', [])) == len(call.fn_args)
+    ]
+    if len(candidates) != 1:
+        raise ValueError(
+            f"expected exactly one abi entry for {call.fn_name} with {len(call.fn_args)} arguments "
+            f"on {call.implementation_address}, found {len(candidates)}"
+        )
+    return FunctionAbi.from_fragment(candidates[0])
+
+
+def get_function_abi(chain: str, call: ContractCall) -> FunctionAbi:
+    """
+    Get the abi fragment for the function a call targets, along with its selector and codec types
+
+    Resolving a function from a full contract abi means scanning the abi and hashing the signature, which
+    adds up over thousands of calls against the same large abis. Resolved functions are kept in a bounded
+    LRU so each function is only resolved once per abi.
+    """
+    abi = call.abi if call.abi else get_abi(chain, call.implementation_address)
+    cache_key = (id(abi), call.fn_name, len(call.fn_args))
+    with function_abis_lock:
+        cached_entry = function_abis.get(cache_key)
+        if cached_entry is not None and cached_entry[0] is abi:
+            function_abis.move_to_end(cache_key)
+            return cached_entry[1]
+
+    fn_abi = find_function_abi(abi, call)
+    with function_abis_lock:
+        function_abis[cache_key] = (abi, fn_abi)
+        if len(function_abis) > FUNCTION_ABI_CACHE_SIZE:
+            function_abis.popitem(last=False)
+    return fn_abi
+
+
+def encode_function_call(fn_abi: FunctionAbi, fn_args: Sequence[Any]) -> bytes:
+    return fn_abi.selector + encode(fn_abi.input_types, list(fn_args))
+
+
+def decode_function_result(fn_abi: FunctionAbi, return_data: bytes) -> Any:
+    """
+    Decode the return data of a call the same way web3 contract functions do
+
+    Addresses are checksummed and single outputs are unwrapped, so the result is interchangeable with
+    `contract.functions.<fn_name>(...).call()`
+    """
+    output_data = decode(fn_abi.output_types, return_data)
+    normalized_data = map_abi_data(BASE_RETURN_NORMALIZERS, fn_abi.output_types, output_data)
+    if len(normalized_data) == 1:
+        return normalized_data[0]
+    return normalized_data
+
+
+def decode_contract_call_result(
+    call: ContractCall, fn_abi: FunctionAbi, return_data: bytes
+) -> ContractCallResult:
+    try:
+        value = decode_function_result(fn_abi, return_data)
+    except DecodingError as exc:
+        # a call to an address without code succeeds with empty return data
+        return ContractCallResult(call, False, error=f"could not decode result: {exc}")
+    return ContractCallResult(call, True, value=value, return_data=return_data)
+
+
+def decode_revert_reason(return_data: bytes) -> str:
+    # solidity encodes `revert("reason")` as a call to Error(string)
+    error_selector = function_signature_to_4byte_selector('Error(string)')
+    if return_data[:4] == error_selector:
+        return decode(['string'], return_data[4:])[0]
+    return f"reverted with data 0x{return_data.hex()}" if return_data else "reverted without data"
+
+
+def eth_call_at_block(chain: str, to_address: str, calldata: bytes, block_no: Optional[int] = None) -> bytes:
+    w3_provider = get_w3_provider(chain)
+    transaction: TxParams = {'to': to_checksum_address(to_address), 'data': calldata}
+    if block_no is None:
+        return call_with_retries(chain, 'rpc', lambda: w3_provider.eth.call(transaction))
+    return call_with_retries(
+        chain, 'rpc', lambda: w3_provider.eth.call(transaction, block_identifier=block_no)
+    )
+
+
+def get_block_number(chain: str) -> int:
+    w3_provider = get_w3_provider(chain)
+    return int(call_with_retries(chain, 'rpc', lambda: w3_provider.eth.block_number))
+
+
+def has_code_at_block(chain: str, address: str, block_no: int) -> bool:
+    w3_provider = get_w3_provider(chain)
+    checksum_address = Web3.to_checksum_address(address)
+    code = call_with_retries(chain, 'rpc', lambda: w3_provider.eth.get_code(checksum_address, block_no))
+    return len(code) > 0
+
+
+def find_creation_block(chain: str, address: str, block_no: int) -> int:
+    """
+    Find the block a contract was deployed in, by bisecting on whether it has code at a block
+
+    A contract has code from its deployment onwards, so this takes about log2(`block_no`) `eth_getCode`
+    requests. Reading code at old blocks needs an archive node.
+    """
+    if not has_code_at_block(chain, address, block_no):
+        raise ValueError(f"{chain} - {address} has no code at block {block_no}")
+    lower, upper = 0, block_no
+    while lower < upper:
+        middle = (lower + upper) // 2
+        if has_code_at_block(chain, address, middle):
+            upper = middle
+        else:
+            lower = middle + 1
+    logger.debug("found creation block %s for %s - %s", lower, chain, address)
+    return lower
+
+
+def pin_block_no(chain: str, block_no: Optional[int]) -> int:
+    """
+    Resolve a missing block to the chain's current head
+
+    Calls without a block read whatever head the node has when each call lands, so the calls behind one
+    snapshot could read different blocks, and none of them could be cached. Pinning the head once up front
+    gives every call in the snapshot the same state.
+    """
+    if block_no is not None:
+        return block_no
+    block_no = get_block_number(chain)
+    logger.info("pinned latest block on %s to %s", chain, block_no)
+    return block_no
+
+
+def cached_eth_call_at_block(
+    chain: str, to_address: str, calldata: bytes, block_no: Optional[int] = None
+) -> bytes:
+    """
+    Make a raw `eth_call`, serving it from the block-pinned call cache when possible
+
+    Only calls at an explicit block are cached, since the result of a call at a historical block never
+    changes. Calls against the latest block always go to the node.
+    """
+    return_data = get_cached_call(chain, to_address, calldata, block_no)
+    if return_data is not None:
+        logger.debug("contract call served from call cache")
+        return return_data
+
+    return_data = bytes(eth_call_at_block(chain, to_address, calldata, block_no))
+    cache_call(chain, to_address, calldata, block_no, return_data)
+    return return_data
+
+
 # this is the number of arguments necessary to make a contract call
 # pylint: disable=too-many-arguments
 def contract_call_at_block(
@@ -98,17 +424,13 @@ def contract_call_at_block(
         fn_args,
         f" at block {block_no}" if block_no is not None else "",
     )
-    w3_provider = get_w3_provider(chain)
-
-    if not abi:
-        abi = get_abi(chain, implementation_address)
-    contract = w3_provider.eth.contract(address=Web3.to_checksum_address(interface_address), abi=abi)
+    fn_abi = get_function_abi(
+        chain, ContractCall(interface_address, implementation_address, fn_name, fn_args, abi)
+    )
+    calldata = encode_function_call(fn_abi, fn_args)
 
-    contract_fn = getattr(contract.functions, fn_name)
     logger.debug("making contract call")
-    if block_no is None:
-        res = contract_fn(*fn_args).call()
-    else:
-        res = contract_fn(*fn_args).call(block_identifier=block_no)
+    return_data = cached_eth_call_at_block(chain, interface_address, calldata, block_no)
+    res = decode_function_result(fn_abi, return_data)
     logger.debug("contract call yielded result: %s", res)
     return res
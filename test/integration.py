@@ -1,12 +1,13 @@
 import json
 import os
 from pathlib import Path
-import pickle
 import subprocess
 import sys
 from typing import Dict, Optional, List
 import unittest
 
+from uniswap_breakouts.utils.sqlite_store import SqliteStore
+
 PACKAGE_RUN = ["-m", "uniswap_breakouts"]
 
 
@@ -34,13 +35,14 @@ class WethUsdcPoolsCase(unittest.TestCase):
             Path(__file__).parent / "test_expected_outputs/weth_usdc_expected.json"
         )
         self.out_file_path = str(Path(__file__).parent / "test_outputs/weth_usdc_out.json")
-        self.caching_path = str(Path(__file__).parent / "test_caching_dir/weth_usdc_abi_cache.pkl")
+        self.caching_path = str(Path(__file__).parent / "test_caching_dir/weth_usdc_abi_cache.sqlite")
 
         if os.path.exists(self.out_file_path):
             os.remove(self.out_file_path)
 
-        if os.path.exists(self.caching_path):
-            os.remove(self.caching_path)
+        for cache_file_path in [self.caching_path, self.caching_path + '-wal', self.caching_path + '-shm']:
+            if os.path.exists(cache_file_path):
+                os.remove(cache_file_path)
 
         with open(self.expected_output_path) as expected_file:
             self.expected_output = json.load(expected_file)
@@ -88,11 +90,8 @@ class WethUsdcPoolsCase(unittest.TestCase):
 
         self.assertEqual(actual_output, self.expected_output)
 
-        v2_url = 'https://api.etherscan.io/api?module=contract&action=getabi&address=0xb4e16d0168e52d35cacd2c6185b44281ec28c9dc'
-        v3_url = 'https://api.etherscan.io/api?module=contract&action=getabi&address=0xC36442b4a4522E871399CD717aBDD847Ab11FE88'
+        v2_key = 'ethereum:0xb4e16d0168e52d35cacd2c6185b44281ec28c9dc'
+        v3_key = 'ethereum:0xc36442b4a4522e871399cd717abdd847ab11fe88'
 
-        with open(self.caching_path, 'rb') as pickle_cache:
-            cached_requests = pickle.load(pickle_cache)
-            self.assertEqual(len(cached_requests), 2)
-            for cache_url in cached_requests.keys():
-                self.assertTrue(v2_url in cache_url or v3_url in cache_url)
+        abi_cache = SqliteStore(self.caching_path, 'abis')
+        self.assertEqual(sorted(abi_cache.keys()), [v2_key, v3_key])
@@ -1,11 +1,59 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 import os
 from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Dict
 import unittest
+from unittest import mock
 
+from eth_abi import encode
+import numpy as np
 import pandas as pd
+import requests
+from web3 import Web3
+from web3.exceptions import ContractLogicError
 
-from uniswap_breakouts.uniswap import v3_ticks
+from uniswap_breakouts.config.datatypes import (
+    PositionSpecs,
+    V2PositionSpec,
+    V3OwnerPositionSpec,
+    V3PositionSpec,
+)
+from uniswap_breakouts.constants.abis import TOKEN_CONTRACT_ABI
+from uniswap_breakouts.constants.w3 import MULTICALL3_ADDRESS
+from uniswap_breakouts.report import report_runner
+from uniswap_breakouts.uniswap import (
+    pool_metadata,
+    pool_state,
+    v2,
+    v2_holders,
+    v2_series,
+    v3,
+    v3_depth_matrix,
+    v3_math,
+    v3_owner,
+    v3_pairs,
+    v3_profile,
+    v3_series,
+    v3_swaps,
+    v3_ticks,
+)
+from uniswap_breakouts.uniswap.uniswap_utils import PoolToken
+from uniswap_breakouts.utils import batch_calls, logs, multicall, rate_limit, rpc_batch, web3_utils
+from uniswap_breakouts.utils.multicall import decode_aggregate3_results
+from uniswap_breakouts.utils.rpc_batch import decode_rpc_batch_response
+from uniswap_breakouts.utils.sqlite_store import SqliteStore
+from uniswap_breakouts.utils.web3_utils import (
+    ContractCall,
+    decode_function_result,
+    encode_function_call,
+    get_function_abi,
+)
 
 
 class V3TicksUnitCase(unittest.TestCase):
@@ -30,15 +78,21 @@ class V3TicksUnitCase(unittest.TestCase):
             depth=Decimal(0.025),
         )
 
-        ticks_df = v3_ticks.make_tick_liquidity_df(liquidity_snapshot, depth=Decimal(0.025))
+        ticks_df = v3_ticks.make_tick_liquidity_df(liquidity_snapshot, depth=Decimal(0.025), exact=True)
         ticks_df.to_csv(self.out_file_path)
 
         # write and read to CSV for easy comparison and inspection, and because we plan to store these as CSVs
         actual_ticks_df = pd.read_csv(self.out_file_path, index_col=0)
         expected_ticks_df = pd.read_csv(self.expected_output_path, index_col=0)
 
-        comp = actual_ticks_df.compare(expected_ticks_df)
-        self.assertTrue(comp.empty)
+        # liquidity is summed in float64, so the profile is compared to float precision
+        self.assertEqual(list(actual_ticks_df.columns), list(expected_ticks_df.columns))
+        self.assertEqual(list(actual_ticks_df['tick']), list(range(257580, 258061, 60)))
+        self.assertEqual(list(actual_ticks_df['tick']), list(expected_ticks_df['tick']))
+        for column in expected_ticks_df.columns:
+            np.testing.assert_allclose(
+                actual_ticks_df[column], expected_ticks_df[column], rtol=1e-12, atol=1e3, err_msg=column
+            )
 
         self.assertEqual(liquidity_snapshot.chain, 'ethereum')
         self.assertEqual(liquidity_snapshot.block, 18086348)
@@ -56,3 +110,1051 @@ class V3TicksUnitCase(unittest.TestCase):
         self.assertEqual(liquidity_snapshot.token1.address, '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2')
         self.assertEqual(liquidity_snapshot.token1.symbol, 'WETH')
         self.assertEqual(liquidity_snapshot.token1.decimals, 18)
+
+
+class TickLiquidityDfUnitCase(unittest.TestCase):
+    def test_vectorized_matches_exact(self):
+        # a synthetic wbtc-weth like pool: liquidity is added below the active tick and removed above it
+        tick_spacing = 60
+        active_tick = 257858
+        rng = np.random.default_rng(0)
+        tick_indexes = range(active_tick // tick_spacing - 200, active_tick // tick_spacing + 200, 3)
+        ticks = [
+            (
+                i * tick_spacing,
+                int(rng.integers(1, 10**15)) * (1 if i * tick_spacing <= active_tick else -1),
+                0,
+            )
+            for i in reversed(tick_indexes)
+        ]
+        snapshot = v3_ticks.V3TickLiquiditySnapshot(
+            chain='ethereum',
+            block=18086348,
+            virtual_ratio=Decimal('157787770847.5234530587784276'),
+            sqrt_price_x96=31471413857813655325222428651742846,
+            active_tick=active_tick,
+            active_liquidity=2053104318434531812,
+            token0=PoolToken(0, '0x2260FAC5E5542a773Aa44fBCfeDf7C193bc2C599', 'WBTC', 8),
+            token1=PoolToken(1, '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2', 'WETH', 18),
+            tick_spacing=tick_spacing,
+            ticks=v3_ticks.TickArrays.from_tick_infos(ticks),
+        )
+
+        vectorized_df = v3_ticks.make_tick_liquidity_df(snapshot, depth=Decimal('0.025'))
+        exact_df = v3_ticks.make_tick_liquidity_df(snapshot, depth=Decimal('0.025'), exact=True)
+
+        self.assertEqual(list(vectorized_df.columns), list(exact_df.columns))
+        self.assertEqual(list(vectorized_df.index), list(exact_df.index))
+        self.assertGreater((exact_df['token0_underlying'] > 0).sum(), 0)
+        self.assertGreater((exact_df['token1_underlying'] > 0).sum(), 0)
+        for column in exact_df.columns:
+            np.testing.assert_allclose(
+                vectorized_df[column].astype(float), exact_df[column].astype(float), rtol=1e-8, err_msg=column
+            )
+
+    def test_tick_arrays_fall_back_to_python_ints(self):
+        tick_arrays = v3_ticks.TickArrays.from_tick_infos([(60, -(2**100), 2**100), (-60, 2**100, 2**100)])
+        self.assertEqual(list(tick_arrays.ticks), [-60, 60])
+        self.assertEqual(tick_arrays.liquidity_net.dtype, object)
+        self.assertEqual(list(tick_arrays.liquidity_net), [2**100, -(2**100)])
+        self.assertEqual(v3_ticks.TickArrays.from_tick_infos([(0, 5, 5)]).liquidity_net.dtype, np.int64)
+        self.assertEqual(
+            v3_ticks.TickArrays.from_dict(tick_arrays.to_dict()).to_dict(), tick_arrays.to_dict()
+        )
+
+
+class TickBitmapUnitCase(unittest.TestCase):
+    def test_tick_bounds_follow_price_range(self):
+        tick_lower, tick_upper = v3_ticks.get_tick_bounds(257858, Decimal('0.025'))
+        self.assertLessEqual(1.0001 ** (tick_lower - 257858), 0.975)
+        self.assertGreater(1.0001 ** (tick_lower + 1 - 257858), 0.975)
+        self.assertGreaterEqual(1.0001 ** (tick_upper - 257858), 1.025)
+        self.assertLess(1.0001 ** (tick_upper - 1 - 257858), 1.025)
+        # the bounds depend on the price move only, not on how far the active tick is from zero
+        self.assertEqual(
+            v3_ticks.get_tick_bounds(0, Decimal('0.025')), (tick_lower - 257858, tick_upper - 257858)
+        )
+        self.assertEqual(v3_ticks.get_tick_bounds(0, Decimal(2))[0], v3_math.MIN_TICK)
+        self.assertEqual(v3_ticks.get_spaced_tick_bounds(257858, 60, Decimal('0.025')), (257580, 258060))
+        self.assertEqual(v3_ticks.get_word_indexes(257858, 60, Decimal('0.025')), [16])
+
+    def test_spaced_tick_bounds_stay_within_usable_ticks(self):
+        # a depth of 100% or more reaches the lowest tick, which is not a multiple of the spacing
+        self.assertEqual(v3_ticks.get_spaced_tick_bounds(0, 60, Decimal(1)), (-887220, 6900))
+        # the range above the upper bound has to end at or below the highest tick
+        self.assertEqual(v3_ticks.get_spaced_tick_bounds(887000, 60, Decimal('0.025')), (886740, 887160))
+
+        for active_tick, depth in ((0, Decimal(1)), (0, Decimal(2)), (887000, Decimal('0.025'))):
+            snapshot = v3_ticks.V3TickLiquiditySnapshot(
+                chain='ethereum',
+                block=100,
+                virtual_ratio=v3.q64_96_to_decimal(v3_math.get_sqrt_ratio_at_tick(active_tick)) ** 2,
+                sqrt_price_x96=v3_math.get_sqrt_ratio_at_tick(active_tick),
+                active_tick=active_tick,
+                active_liquidity=10**18,
+                token0=PoolToken(0, '0xtoken0', 'A', 18),
+                token1=PoolToken(1, '0xtoken1', 'B', 18),
+                tick_spacing=60,
+                ticks=v3_ticks.TickArrays.from_tick_infos([]),
+            )
+            for exact in (False, True):
+                tick_df = v3_ticks.make_tick_liquidity_df(snapshot, depth, exact=exact)
+                self.assertGreaterEqual(tick_df['tick'].iloc[0], v3_math.MIN_TICK)
+                self.assertLessEqual(tick_df['tick_upper'].iloc[-1], v3_math.MAX_TICK)
+
+    def test_tick_lens_only_asked_about_populated_words(self):
+        self.assertEqual(v3_ticks.get_word_indexes(0, 1, Decimal('0.05')), [1, 0, -1, -2, -3])
+
+        def fake_contract_calls(_chain, calls, _block_no=None):
+            if calls and calls[0].fn_name == 'tickBitmap':
+                return [1 << 3 if call.fn_args[0] in (1, -2) else 0 for call in calls]
+            return [[(call.fn_args[1] * 256, 5, 5)] for call in calls]
+
+        with mock.patch.object(
+            v3_ticks, 'contract_calls_at_block', side_effect=fake_contract_calls
+        ) as contract_calls:
+            ticks = v3_ticks.get_initialized_tick_info(
+                'ethereum', '0xpool', '0xlens', 0, 1, Decimal('0.05'), 100
+            )
+
+        self.assertEqual(contract_calls.call_count, 2)
+        lens_calls = contract_calls.call_args_list[1].args[1]
+        self.assertEqual([call.fn_args[1] for call in lens_calls], [1, -2])
+        self.assertEqual(list(ticks.ticks), [-512, 256])
+
+
+class V3MathUnitCase(unittest.TestCase):
+    def test_sqrt_ratio_at_tick_matches_tick_math(self):
+        self.assertEqual(v3_math.get_sqrt_ratio_at_tick(v3_math.MIN_TICK), v3_math.MIN_SQRT_RATIO)
+        self.assertEqual(v3_math.get_sqrt_ratio_at_tick(v3_math.MAX_TICK), v3_math.MAX_SQRT_RATIO)
+        self.assertEqual(v3_math.get_sqrt_ratio_at_tick(0), 2**96)
+        self.assertEqual(v3_math.get_sqrt_ratio_at_tick(50), 79426470787362580746886972461)
+        self.assertEqual(v3_math.get_sqrt_ratio_at_tick(-50), 79030349367926598376800521322)
+        with self.assertRaises(ValueError):
+            v3_math.get_sqrt_ratio_at_tick(v3_math.MAX_TICK + 1)
+
+    def test_amount_deltas_round_like_sqrt_price_math(self):
+        sqrt_ratio_a = 2**96
+        sqrt_ratio_b = v3_math.get_sqrt_ratio_at_tick(1000)
+        liquidity = 10**18
+        amount0_down = v3_math.get_amount0_delta(sqrt_ratio_a, sqrt_ratio_b, liquidity, False)
+        amount0_up = v3_math.get_amount0_delta(sqrt_ratio_b, sqrt_ratio_a, liquidity, True)
+        amount1_down = v3_math.get_amount1_delta(sqrt_ratio_a, sqrt_ratio_b, liquidity, False)
+        amount1_up = v3_math.get_amount1_delta(sqrt_ratio_a, sqrt_ratio_b, liquidity, True)
+        self.assertEqual(amount0_up - amount0_down, 1)
+        self.assertEqual(amount1_up - amount1_down, 1)
+        self.assertAlmostEqual(amount0_down / liquidity, 1 - 1.0001**-500, places=12)
+        self.assertAlmostEqual(amount1_down / liquidity, 1.0001**500 - 1, places=12)
+
+    def test_amounts_for_liquidity_follow_position_range(self):
+        sqrt_price = v3_math.get_sqrt_ratio_at_tick(100)
+        below = v3_math.get_amounts_for_liquidity(100, sqrt_price, 200, 300, 10**18)
+        inside = v3_math.get_amounts_for_liquidity(100, sqrt_price, 0, 200, 10**18)
+        above = v3_math.get_amounts_for_liquidity(100, sqrt_price, -200, 0, 10**18)
+        self.assertTrue(below[0] > 0 and below[1] == 0)
+        self.assertTrue(inside[0] > 0 and inside[1] > 0)
+        self.assertTrue(above[0] == 0 and above[1] > 0)
+        # a position starting at the current tick is in range
+        self.assertGreater(v3_math.get_amounts_for_liquidity(100, sqrt_price, 100, 200, 10**18)[0], 0)
+        self.assertEqual(
+            v3_math.get_amounts_for_liquidity(100, sqrt_price, 0, 200, -(10**18)), (-inside[0], -inside[1])
+        )
+
+
+class LiquidityProfileUnitCase(unittest.TestCase):
+    def make_snapshot(self, active_tick, active_liquidity, ticks):
+        return v3_ticks.V3TickLiquiditySnapshot(
+            chain='ethereum',
+            block=100,
+            virtual_ratio=Decimal(1),
+            sqrt_price_x96=v3_math.get_sqrt_ratio_at_tick(active_tick),
+            active_tick=active_tick,
+            active_liquidity=active_liquidity,
+            token0=PoolToken(0, '0x2260FAC5E5542a773Aa44fBCfeDf7C193bc2C599', 'WBTC', 8),
+            token1=PoolToken(1, '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2', 'WETH', 18),
+            tick_spacing=10,
+            ticks=v3_ticks.TickArrays.from_tick_infos(ticks),
+        )
+
+    def test_pool_events_decoded_from_raw_logs(self):
+        mint_abi = logs.find_event_abi(v3_profile.V3_POOL_CONTRACT_ABI, 'Mint')
+        owner = '0xC36442b4a4522E871399CD717aBDD847Ab11FE88'
+        raw_log = {
+            'address': '0xcbcdf9626bc03e24f779434178a73a0b4bad62ed',
+            'topics': [
+                mint_abi.topic,
+                encode(['address'], [owner]),
+                encode(['int24'], [-120]),
+                encode(['int24'], [60]),
+            ],
+            'data': encode(['address', 'uint128', 'uint256', 'uint256'], [owner, 10**18, 5, 7]),
+            'blockNumber': 101,
+            'logIndex': 3,
+        }
+        decoded_log = logs.decode_log(mint_abi, raw_log)
+        self.assertEqual(decoded_log.event, 'Mint')
+        self.assertEqual(decoded_log.address, '0xCBCdF9626bC03E24f779434178A73a0B4bad62eD')
+        self.assertEqual(
+            decoded_log.args,
+            {
+                'owner': owner,
+                'tickLower': -120,
+                'tickUpper': 60,
+                'sender': owner,
+                'amount': 10**18,
+                'amount0': 5,
+                'amount1': 7,
+            },
+        )
+
+    def test_profile_advanced_from_events_matches_fresh_snapshot(self):
+        seed = self.make_snapshot(5, 300, [(20, -300, 300), (-20, 300, 300)])
+        profile = v3_profile.V3LiquidityProfile('0xpool', seed, Decimal('0.01'))
+
+        def decoded_log(event, block_number, **args):
+            return logs.DecodedLog(event, '0xpool', block_number, 0, args)
+
+        events = [
+            decoded_log('Mint', 101, tickLower=0, tickUpper=40, amount=50),
+            decoded_log('Mint', 101, tickLower=-40, tickUpper=-10, amount=70),
+            decoded_log('Burn', 102, tickLower=-20, tickUpper=20, amount=300),
+            decoded_log(
+                'Swap', 103, sqrtPriceX96=v3_math.get_sqrt_ratio_at_tick(-15), liquidity=70, tick=-15
+            ),
+        ]
+        with mock.patch.object(v3_profile, 'get_decoded_logs', return_value=events) as get_decoded_logs:
+            profile.advance(103)
+        self.assertEqual(get_decoded_logs.call_args.args[3:], (101, 103))
+        self.assertEqual(profile.block, 103)
+        self.assertEqual(profile.ticks, [-40, -10, 0, 40])
+        self.assertEqual(profile.active_liquidity, 70)
+
+        fresh = self.make_snapshot(
+            -15,
+            70,
+            [
+                (40, -50, 50),
+                (0, 50, 50),
+                (-10, -70, 70),
+                (-40, 70, 70),
+            ],
+        )
+        self.assertEqual(profile.to_snapshot().ticks.to_dict(), fresh.ticks.to_dict())
+        pd.testing.assert_frame_equal(
+            profile.make_tick_liquidity_df(Decimal('0.003'), exact=True),
+            v3_ticks.make_tick_liquidity_df(fresh, Decimal('0.003'), exact=True),
+        )
+        with self.assertRaises(ValueError):
+            profile.make_tick_liquidity_df(Decimal('0.5'))
+
+
+class DepthMatrixUnitCase(unittest.TestCase):
+    def test_depth_matrix_rows_follow_pool_events(self):
+        seed = LiquidityProfileUnitCase().make_snapshot(5, 300, [(20, -300, 300), (-20, 300, 300)])
+        events = [
+            logs.DecodedLog('Mint', '0xpool', 101, 0, {'tickLower': 0, 'tickUpper': 40, 'amount': 50}),
+            logs.DecodedLog('Burn', '0xpool', 102, 0, {'tickLower': -20, 'tickUpper': 20, 'amount': 300}),
+            logs.DecodedLog(
+                'Swap',
+                '0xpool',
+                2500,
+                0,
+                {'sqrtPriceX96': v3_math.get_sqrt_ratio_at_tick(-15), 'liquidity': 0, 'tick': -15},
+            ),
+        ]
+
+        def fake_decoded_logs(_chain, _address, _event_abis, from_block, to_block):
+            return [log for log in events if from_block <= log.block_number <= to_block]
+
+        with (
+            tempfile.TemporaryDirectory() as out_dir,
+            mock.patch.object(v3_depth_matrix, 'get_tick_liquidity_info_for_pool', return_value=seed),
+            mock.patch.object(
+                v3_depth_matrix, 'get_decoded_logs', side_effect=fake_decoded_logs
+            ) as decoded_logs,
+        ):
+            v3_depth_matrix.build_depth_matrix(
+                'ethereum', '0xpool', '0xlens', Decimal('0.003'), [3000, 100, 101, 102], out_dir
+            )
+            matrix = v3_depth_matrix.open_depth_matrix(out_dir)
+
+            # the whole range is requested at once, so get_logs sizes the chunks
+            self.assertEqual(decoded_logs.call_count, 1)
+            self.assertEqual(decoded_logs.call_args.args[3:], (101, 3000))
+
+            self.assertIsInstance(matrix.liquidity, np.memmap)
+            self.assertEqual(list(matrix.blocks), [100, 101, 102, 3000])
+            self.assertEqual(list(matrix.ticks), list(range(-30, 31, 10)))
+            np.testing.assert_array_equal(
+                matrix.liquidity,
+                [
+                    [0, 300, 300, 300, 300, 0, 0],
+                    [0, 300, 300, 350, 350, 50, 50],
+                    [0, 0, 0, 50, 50, 50, 50],
+                    [0, 0, 0, 50, 50, 50, 50],
+                ],
+            )
+            rows, columns = matrix.block_rows(101, 102), matrix.tick_columns(0, 10)
+            np.testing.assert_array_equal(matrix.liquidity[rows, columns], [[350, 350], [50, 50]])
+
+            # the last row matches a profile built from a snapshot at the same state
+            fresh = LiquidityProfileUnitCase().make_snapshot(-15, 0, [(40, -50, 50), (0, 50, 50)])
+            fresh_df = (
+                v3_ticks.make_tick_liquidity_df(fresh, Decimal('0.01')).set_index('tick').loc[matrix.ticks]
+            )
+            for column in v3_depth_matrix.DEPTH_MATRIX_COLUMNS:
+                np.testing.assert_allclose(getattr(matrix, column)[-1], fresh_df[column], err_msg=column)
+            del matrix
+
+
+class SwapSimulationUnitCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.liquidity_below, self.liquidity_above = 3 * 10**18, 10**18
+        sqrt_price_x96 = v3_math.get_sqrt_ratio_at_tick(5)
+        self.snapshot = v3_ticks.V3TickLiquiditySnapshot(
+            chain='ethereum',
+            block=100,
+            virtual_ratio=Decimal(sqrt_price_x96**2) / Decimal(2**192),
+            sqrt_price_x96=sqrt_price_x96,
+            active_tick=5,
+            active_liquidity=self.liquidity_below + self.liquidity_above,
+            token0=PoolToken(0, '0x2260FAC5E5542a773Aa44fBCfeDf7C193bc2C599', 'WBTC', 8),
+            token1=PoolToken(1, '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2', 'WETH', 18),
+            tick_spacing=10,
+            ticks=v3_ticks.TickArrays.from_tick_infos(
+                [
+                    (100, -(self.liquidity_below + self.liquidity_above), 0),
+                    (0, self.liquidity_above, 0),
+                    (-100, self.liquidity_below, 0),
+                ]
+            ),
+        )
+        self.tick_df = v3_ticks.make_tick_liquidity_df(self.snapshot, Decimal('0.01'))
+
+    def test_ladder_matches_pool_math(self):
+        sqrt_ratio_0, sqrt_ratio_target = v3_math.get_sqrt_ratio_at_tick(0), v3_math.get_sqrt_ratio_at_tick(
+            -50
+        )
+        expected_amount0 = v3_math.get_amount0_delta(
+            sqrt_ratio_0, self.snapshot.sqrt_price_x96, self.liquidity_below + self.liquidity_above, False
+        ) + v3_math.get_amount0_delta(sqrt_ratio_target, sqrt_ratio_0, self.liquidity_below, False)
+        expected_amount1 = v3_math.get_amount1_delta(
+            sqrt_ratio_0, self.snapshot.sqrt_price_x96, self.liquidity_below + self.liquidity_above, False
+        ) + v3_math.get_amount1_delta(sqrt_ratio_target, sqrt_ratio_0, self.liquidity_below, False)
+        price_impact = (sqrt_ratio_target / self.snapshot.sqrt_price_x96) ** 2 - 1
+
+        ladder_df = v3_swaps.get_price_impact_ladder(self.tick_df, self.snapshot, [price_impact, 0.001, -0.5])
+        self.assertAlmostEqual(ladder_df['amount_in'][0] * 10**8 / expected_amount0, 1, places=9)
+        self.assertAlmostEqual(ladder_df['amount_out'][0] * 10**18 / expected_amount1, 1, places=9)
+        self.assertEqual(list(ladder_df['token_in']), ['WBTC', 'WETH', 'WBTC'])
+        # the profile only reaches 1% below the price
+        self.assertTrue(np.isnan(ladder_df['amount_in'][2]))
+
+        fee_ladder_df = v3_swaps.get_price_impact_ladder(self.tick_df, self.snapshot, [price_impact], 3000)
+        self.assertAlmostEqual(fee_ladder_df['amount_in'][0] * 0.997, ladder_df['amount_in'][0])
+
+    def test_simulated_swaps_reach_ladder_impacts(self):
+        price_impacts = [-0.008, -0.003, -0.0001, 0.0002, 0.004, 0.009]
+        ladder_df = v3_swaps.get_price_impact_ladder(self.tick_df, self.snapshot, price_impacts, 500)
+        for zero_for_one, rows in ((True, slice(0, 3)), (False, slice(3, 6))):
+            swaps_df = v3_swaps.simulate_swaps(
+                self.tick_df, self.snapshot, ladder_df['amount_in'][rows], zero_for_one, 500
+            )
+            np.testing.assert_allclose(swaps_df['price_impact'], price_impacts[rows], rtol=1e-9)
+            np.testing.assert_allclose(swaps_df['amount_out'], ladder_df['amount_out'][rows], rtol=1e-9)
+
+        swaps_df = v3_swaps.simulate_swaps(self.tick_df, self.snapshot, [0, 10**9], True)
+        self.assertEqual(swaps_df['amount_out'][0], 0)
+        self.assertEqual(swaps_df['price_impact'][0], 0)
+        self.assertTrue(np.isnan(swaps_df['amount_out'][1]))
+
+
+class V3OwnerUnitCase(unittest.TestCase):
+    def test_owner_positions_batched_by_pool(self):
+        nft_address = '0xC36442b4a4522E871399CD717aBDD847Ab11FE88'
+        wbtc, weth, usdc = (
+            '0x2260FAC5E5542a773Aa44fBCfeDf7C193bc2C599',
+            '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2',
+            '0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48',
+        )
+        pools = {
+            (wbtc, weth, 3000): '0xCBCdF9626bC03E24f779434178A73a0B4bad62eD',
+            (usdc, weth, 500): '0x88e6',
+        }
+        positions = {
+            11: [0, '0x0', wbtc, weth, 3000, -60, 60, 10**18],
+            12: [0, '0x0', usdc, weth, 500, -10, 10, 2 * 10**18],
+            13: [0, '0x0', wbtc, weth, 3000, -120, 0, 0],
+        }
+        batches = []
+
+        def fake_contract_calls(_, calls, block_no):
+            self.assertEqual(block_no, 100)
+            batches.append([call.fn_name for call in calls])
+            results = {
+                'tokenOfOwnerByIndex': lambda call: 11 + call.fn_args[1],
+                'factory': lambda call: '0xfactory',
+                'positions': lambda call: positions[call.fn_args[0]],
+                'getPool': lambda call: pools[tuple(call.fn_args)],
+                'slot0': lambda call: [v3_math.get_sqrt_ratio_at_tick(0), 0],
+                'liquidity': lambda call: 10**20,
+            }
+            return [results[call.fn_name](call) for call in calls]
+
+        tokens = (PoolToken(0, wbtc, 'WBTC', 8), PoolToken(1, weth, 'WETH', 18))
+        with (
+            mock.patch.object(v3_owner, 'contract_call_at_block', return_value=3),
+            mock.patch.object(v3_owner, 'contract_calls_at_block', side_effect=fake_contract_calls),
+            mock.patch.object(pool_state, 'contract_calls_at_block', side_effect=fake_contract_calls),
+            mock.patch.object(pool_state, 'pool_states', OrderedDict()),
+            mock.patch.object(pool_state, 'prewarm_pool_metadata') as prewarm_pool_metadata,
+            mock.patch.object(pool_state, 'get_pool_tokens', return_value=tokens),
+            mock.patch.object(pool_state, 'get_tick_spacing', return_value=60),
+        ):
+            owner_positions = v3_owner.get_owner_underlying_balances('ethereum', '0xwallet', nft_address, 100)
+
+        self.assertEqual(
+            [(v3_spec.pool_address, v3_spec.nft_id) for v3_spec, _ in owner_positions],
+            [(pools[(wbtc, weth, 3000)], 11), ('0x88e6', 12), (pools[(wbtc, weth, 3000)], 13)],
+        )
+        # one batch each for the ids, the positions, the pools and the pool states, with each pool asked about once
+        self.assertEqual(len(batches), 4)
+        self.assertEqual(batches[2], ['getPool', 'getPool'])
+        self.assertEqual(batches[3], ['slot0', 'liquidity', 'slot0', 'liquidity'])
+        self.assertEqual(len(prewarm_pool_metadata.call_args.args[2]), 2)
+
+        expected_amounts = v3_math.get_amounts_for_liquidity(
+            0, v3_math.get_sqrt_ratio_at_tick(0), -60, 60, 10**18
+        )
+        snapshot = owner_positions[0][1]
+        self.assertEqual(snapshot.num_token0_underlying * 10**8, expected_amounts[0])
+        self.assertEqual(snapshot.num_token1_underlying * 10**18, expected_amounts[1])
+        self.assertEqual(owner_positions[2][1].num_token0_underlying, 0)
+
+
+class PoolStateUnitCase(unittest.TestCase):
+    def test_positions_in_same_pool_and_block_share_one_read(self):
+        pool_address = '0xCBCdF9626bC03E24f779434178A73a0B4bad62eD'
+        pool_batches = []
+
+        def fake_pool_calls(_, calls, block_no):
+            pool_batches.append((block_no, [call.fn_name for call in calls]))
+            return [
+                [v3_math.get_sqrt_ratio_at_tick(0), 0] if call.fn_name == 'slot0' else 10**20
+                for call in calls
+            ]
+
+        def fake_position_calls(_, calls, __):
+            return [[0, '0x0', '0xa', '0xb', 3000, -60, 60, 10**18] for _ in calls]
+
+        tokens = (PoolToken(0, '0xa', 'A', 18), PoolToken(1, '0xb', 'B', 18))
+        with (
+            mock.patch.object(pool_state, 'contract_calls_at_block', side_effect=fake_pool_calls),
+            mock.patch.object(pool_state, 'pool_states', OrderedDict()),
+            mock.patch.object(pool_state, 'prewarm_pool_metadata'),
+            mock.patch.object(pool_state, 'get_pool_tokens', return_value=tokens),
+            mock.patch.object(pool_state, 'get_tick_spacing', return_value=60),
+            mock.patch.object(v3, 'contract_calls_at_block', side_effect=fake_position_calls),
+        ):
+            snapshots = [
+                v3.get_underlying_balances('ethereum', pool_address, '0xnft', '0xnft', nft_id, 100)
+                for nft_id in range(5)
+            ]
+            # addresses are matched case insensitively, a new block is a new read
+            pool_state.prewarm_v3_pool_states('ethereum', [pool_address.lower()], 100)
+            later_state = pool_state.get_v3_pool_state('ethereum', pool_address, 101)
+
+        self.assertEqual(pool_batches, [(100, ['slot0', 'liquidity']), (101, ['slot0', 'liquidity'])])
+        self.assertEqual(later_state.liquidity, 10**20)
+        self.assertEqual(later_state.tick_spacing, 60)
+        self.assertEqual(len({snapshot.num_token0_underlying for snapshot in snapshots}), 1)
+
+
+class PairLiquidityUnitCase(unittest.TestCase):
+    def make_snapshot(self, active_tick, tick_spacing, active_liquidity, ticks):
+        sqrt_price_x96 = v3_math.get_sqrt_ratio_at_tick(active_tick)
+        return v3_ticks.V3TickLiquiditySnapshot(
+            chain='ethereum',
+            block=100,
+            virtual_ratio=Decimal(sqrt_price_x96**2) / Decimal(2**192),
+            sqrt_price_x96=sqrt_price_x96,
+            active_tick=active_tick,
+            active_liquidity=active_liquidity,
+            token0=PoolToken(0, '0x2260FAC5E5542a773Aa44fBCfeDf7C193bc2C599', 'WBTC', 8),
+            token1=PoolToken(1, '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2', 'WETH', 18),
+            tick_spacing=tick_spacing,
+            ticks=v3_ticks.TickArrays.from_tick_infos(ticks),
+        )
+
+    def test_pools_merged_onto_finest_grid(self):
+        depth = Decimal('0.02')
+        snapshots = {
+            500: self.make_snapshot(3, 10, 5 * 10**17, [(-50, 2 * 10**17, 0), (0, 3 * 10**17, 0)]),
+            3000: self.make_snapshot(7, 60, 4 * 10**18, [(-120, 4 * 10**18, 0), (60, -3 * 10**18, 0)]),
+        }
+        pair_df = v3_pairs.make_pair_liquidity_df(snapshots, depth)
+
+        self.assertTrue((np.diff(pair_df['tick']) == 10).all())
+        np.testing.assert_array_equal(
+            pair_df['liquidity'], pair_df['liquidity_500'] + pair_df['liquidity_3000']
+        )
+        np.testing.assert_array_equal(
+            pair_df.set_index('tick').loc[[-60, -10, 0, 50, 60], 'liquidity_3000'],
+            [4e18, 4e18, 4e18, 4e18, 1e18],
+        )
+
+        # a pool on its own is split into grid ranges that add back up to its own ranges
+        pool_df = v3_ticks.make_tick_liquidity_df(snapshots[3000], depth)
+        solo_df = v3_pairs.make_pair_liquidity_df({3000: snapshots[3000]}, depth)
+        self.assertEqual(len(solo_df), len(pool_df))
+        for column in ('token0_underlying', 'token1_underlying'):
+            self.assertAlmostEqual(solo_df[column].sum() / pool_df[column].sum(), 1, places=9)
+
+    def test_tiers_without_pools_left_out(self):
+        pool_address = '0xCBCdF9626bC03E24f779434178A73a0B4bad62eD'
+        zero_address = '0x0000000000000000000000000000000000000000'
+        with (
+            mock.patch.object(v3_pairs, 'get_v3_factory_address', return_value='0xfactory'),
+            mock.patch.object(
+                v3_pairs, 'contract_calls_at_block', return_value=[zero_address, pool_address]
+            ) as contract_calls,
+        ):
+            pools = v3_pairs.get_pair_pools('ethereum', '0xtokenA', '0xtokenB', (500, 3000), 100)
+        self.assertEqual(pools, {3000: pool_address})
+        self.assertEqual(
+            [call.fn_args for call in contract_calls.call_args.args[1]],
+            [['0xtokenA', '0xtokenB', 500], ['0xtokenA', '0xtokenB', 3000]],
+        )
+
+
+class ContractCallUnitCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.token_address = '0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48'
+        self.wallet_address = '0xd7a51ff8357C210D11499E251B2849D1BB35Cbc2'
+        self.balance_call = ContractCall(
+            self.token_address, self.token_address, 'balanceOf', [self.wallet_address], TOKEN_CONTRACT_ABI
+        )
+
+    def test_encoding_matches_web3(self):
+        fn_abi = get_function_abi('ethereum', self.balance_call)
+        calldata = encode_function_call(fn_abi, self.balance_call.fn_args)
+
+        token_contract = Web3().eth.contract(abi=TOKEN_CONTRACT_ABI)
+        self.assertEqual('0x' + calldata.hex(), token_contract.encode_abi('balanceOf', [self.wallet_address]))
+        self.assertEqual(decode_function_result(fn_abi, encode(['uint256'], [42])), 42)
+
+    def test_function_abi_resolved_once_per_abi(self):
+        fn_abi = get_function_abi('ethereum', self.balance_call)
+        self.assertIs(get_function_abi('ethereum', self.balance_call), fn_abi)
+        self.assertEqual(fn_abi.input_types, ('address',))
+        self.assertEqual(fn_abi.fragment['name'], 'balanceOf')
+
+    def test_aggregate3_results_report_failures_per_call(self):
+        fn_abi = get_function_abi('ethereum', self.balance_call)
+        revert_data = bytes.fromhex('08c379a0') + encode(['string'], ['execution reverted'])
+        aggregate_result = [(True, encode(['uint256'], [7])), (False, revert_data), (True, b'')]
+
+        results = decode_aggregate3_results([self.balance_call] * 3, [fn_abi] * 3, aggregate_result)
+
+        self.assertEqual([result.success for result in results], [True, False, False])
+        self.assertEqual(results[0].value, 7)
+        self.assertEqual(results[1].error, 'execution reverted')
+        self.assertIsNotNone(results[2].error)
+
+    def test_rpc_batch_responses_matched_by_id(self):
+        fn_abi = get_function_abi('ethereum', self.balance_call)
+        batch_response = [
+            {'jsonrpc': '2.0', 'id': 1, 'error': {'code': -32000, 'message': 'execution reverted'}},
+            {'jsonrpc': '2.0', 'id': 0, 'result': '0x' + encode(['uint256'], [11]).hex()},
+        ]
+
+        results = decode_rpc_batch_response([self.balance_call] * 3, [fn_abi] * 3, batch_response)
+
+        self.assertEqual(results[0].value, 11)
+        self.assertEqual(results[1].error, 'execution reverted')
+        self.assertFalse(results[2].success)
+
+    def test_abi_misses_shared_per_contract_and_parallel_across_contracts(self):
+        first_address, second_address = '0x' + '1' * 40, '0x' + '2' * 40
+        second_requested = threading.Event()
+        requested_addresses = []
+
+        def fake_request_abi(_chain, address):
+            requested_addresses.append(address)
+            if address == first_address:
+                # a miss for another contract must not have to wait for this one
+                self.assertTrue(second_requested.wait(timeout=5))
+            else:
+                second_requested.set()
+            time.sleep(0.05)
+            return [{'type': 'function', 'name': address}]
+
+        web3_utils.get_abi.cache_clear()
+        with mock.patch.object(web3_utils, 'request_abi', side_effect=fake_request_abi):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = [
+                    executor.submit(web3_utils.get_abi, 'test', address)
+                    for address in (first_address, first_address, second_address, second_address)
+                ]
+                abis = [future.result() for future in futures]
+        web3_utils.get_abi.cache_clear()
+
+        self.assertEqual(sorted(requested_addresses), [first_address, second_address])
+        self.assertEqual([abi[0]['name'] for abi in abis], [first_address] * 2 + [second_address] * 2)
+
+    def test_multicall_falls_back_before_deployment(self):
+        multicall_eth_call = mock.Mock(return_value=b'')
+        individual_eth_call = mock.Mock(return_value=encode(['uint256'], [7]))
+        with (
+            mock.patch.object(
+                batch_calls, 'get_chain_resource', return_value=mock.Mock(batch_mode='multicall')
+            ),
+            mock.patch.object(multicall, 'get_multicall_address', return_value=MULTICALL3_ADDRESS),
+            mock.patch.object(multicall, 'eth_call_at_block', multicall_eth_call),
+            mock.patch.object(multicall, 'multicall_missing_blocks', {}),
+            mock.patch.object(batch_calls, 'eth_call_at_block', individual_eth_call),
+        ):
+            results = batch_calls.send_contract_calls_at_block('test', [self.balance_call] * 2, 100)
+            # earlier blocks are known to be missing the contract too, later ones are tried again
+            batch_calls.send_contract_calls_at_block('test', [self.balance_call], 99)
+            batch_calls.send_contract_calls_at_block('test', [self.balance_call], 200)
+
+        self.assertEqual([result.value for result in results], [7, 7])
+        self.assertEqual([call.args[3] for call in multicall_eth_call.call_args_list], [100, 200])
+        self.assertEqual(individual_eth_call.call_count, 4)
+
+    def test_multicall_chunks_by_call_cost(self):
+        fn_abi = get_function_abi('ethereum', self.balance_call)
+        lens_call = ContractCall(
+            self.token_address, self.token_address, 'getPopulatedTicksInWord', [self.wallet_address]
+        )
+        # the lens call is encoded as a balanceOf, only its name matters for the chunking
+        with (
+            mock.patch.object(
+                multicall,
+                'get_function_abi',
+                side_effect=lambda chain, call: (
+                    fn_abi if call.fn_name == 'getPopulatedTicksInWord' else get_function_abi(chain, call)
+                ),
+            ),
+            mock.patch.object(multicall, 'get_multicall_address', return_value=MULTICALL3_ADDRESS),
+        ):
+            light_requests = multicall.build_aggregate3_requests('test', [self.balance_call] * 150)
+            heavy_requests = multicall.build_aggregate3_requests('test', [lens_call] * 15)
+
+        self.assertEqual([len(request.calls) for request in light_requests], [100, 50])
+        self.assertEqual([len(request.calls) for request in heavy_requests], [10, 5])
+
+    def test_multicall_split_when_out_of_gas(self):
+        half_response = encode(['(bool,bytes)[]'], [[(True, encode(['uint256'], [5]))] * 2])
+        multicall_eth_call = mock.Mock(
+            side_effect=[ValueError('execution reverted: out of gas'), half_response, half_response]
+        )
+        with (
+            mock.patch.object(multicall, 'get_multicall_address', return_value=MULTICALL3_ADDRESS),
+            mock.patch.object(multicall, 'eth_call_at_block', multicall_eth_call),
+            mock.patch.object(multicall, 'multicall_missing_blocks', {}),
+        ):
+            results = multicall.aggregate3_at_block('test', [self.balance_call] * 4, 100)
+
+        self.assertEqual(multicall_eth_call.call_count, 3)
+        self.assertEqual([result.value for result in results], [5, 5, 5, 5])
+
+    def test_rpc_batch_throttled_in_body_is_retried(self):
+        value_result = {'jsonrpc': '2.0', 'id': 0, 'result': '0x' + encode(['uint256'], [11]).hex()}
+        revert_result = {'jsonrpc': '2.0', 'id': 1, 'error': {'code': 3, 'message': 'execution reverted'}}
+        throttled_result = {'jsonrpc': '2.0', 'id': 0, 'error': {'code': -32005, 'message': 'limit exceeded'}}
+        bodies = [
+            {'jsonrpc': '2.0', 'id': None, 'error': {'code': 429, 'message': 'too many requests'}},
+            [throttled_result, revert_result],
+            [revert_result, value_result],
+        ]
+        session = mock.Mock()
+        session.post.side_effect = [mock.Mock(**{'json.return_value': body}) for body in bodies]
+        limiter = rate_limit.RateLimiter('test rpc', 1000.0)
+        rate_limit.rate_limiters[('test', 'rpc')] = limiter
+
+        with (
+            mock.patch.object(rpc_batch, 'get_chain_resource', return_value=mock.Mock(rpc_url='http://rpc')),
+            mock.patch.object(rpc_batch, 'get_rpc_session', return_value=session),
+            mock.patch.object(rate_limit.time, 'sleep'),
+        ):
+            results = rpc_batch.eth_call_batch_at_block('test', [self.balance_call] * 2, 100)
+
+        # both throttled bodies were retried and slowed the limiter down, the revert stays on its call
+        self.assertEqual(session.post.call_count, 3)
+        self.assertLess(limiter.rate, 1000.0)
+        self.assertEqual(results[0].value, 11)
+        self.assertEqual(results[1].error, 'execution reverted')
+
+
+class SqliteStoreUnitCase(unittest.TestCase):
+    def test_put_and_get(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            store = SqliteStore(str(Path(cache_dir) / 'store.sqlite'), 'eth_calls')
+            self.assertIsNone(store.get('missing'))
+
+            store.put('key', b'\x00\x01')
+            store.put('key', b'\x02')
+            self.assertEqual(store.get('key'), b'\x02')
+            self.assertEqual(len(store), 1)
+
+            reopened_store = SqliteStore(str(Path(cache_dir) / 'store.sqlite'), 'eth_calls')
+            self.assertEqual(reopened_store.keys(), ['key'])
+
+
+class PoolMetadataUnitCase(unittest.TestCase):
+    def test_pool_tokens_served_from_registry(self):
+        pool_address = '0x88e6A0c2dDD26FEEb64F039a2c41296FcB3f5640'
+        usdc_address = '0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48'
+        weth_address = '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2'
+        pool_metadata.put_metadata(
+            pool_metadata.pool_tokens_key('ethereum', pool_address), [usdc_address, weth_address]
+        )
+        pool_metadata.put_metadata(
+            pool_metadata.token_key('ethereum', usdc_address),
+            {'address': usdc_address, 'symbol': 'USDC', 'decimals': 6},
+        )
+        pool_metadata.put_metadata(
+            pool_metadata.token_key('ethereum', weth_address),
+            {'address': weth_address, 'symbol': 'WETH', 'decimals': 18},
+        )
+        pool_metadata.put_metadata(pool_metadata.tick_spacing_key('ethereum', pool_address), 10)
+
+        token0, token1 = pool_metadata.get_pool_tokens('ethereum', pool_address.lower())
+
+        self.assertEqual((token0.index, token0.symbol, token0.decimals), (0, 'USDC', 6))
+        self.assertEqual((token1.index, token1.address, token1.decimals), (1, weth_address, 18))
+        self.assertEqual(pool_metadata.get_tick_spacing('ethereum', pool_address), 10)
+
+
+class V2BatchUnitCase(unittest.TestCase):
+    def evaluate_specs(self, get_snapshots):
+        pool_a = '0xBb2b8038a1640196FbE3e38816F3e67Cba72D940'
+        pool_b = '0xA478c2975Ab1Ea89e8196811F51A7B7Ade33eB11'
+        wallets = [f'0x{i:040x}' for i in range(1, 4)]
+        v2_specs = [
+            V2PositionSpec('ethereum', pool_a, wallets[0], None, 100),
+            V2PositionSpec('ethereum', pool_b, wallets[1], None, 100),
+            V2PositionSpec('ethereum', pool_a.lower(), None, Decimal(25), 100),
+            V2PositionSpec('ethereum', pool_a, wallets[2], None, 100),
+        ]
+        pool_states = {pool_a: (100 * 10**18, (10**10, 2 * 10**20, 0)), pool_b: (10**18, (10**8, 10**18, 0))}
+        wallet_balances = {wallets[0]: 10 * 10**18, wallets[1]: 5 * 10**17, wallets[2]: 65 * 10**18}
+
+        def fake_contract_calls(_, calls, block_no):
+            self.assertEqual(block_no, 100)
+            total_supply, reserves = pool_states[calls[0].interface_address]
+            return [total_supply, reserves] + [wallet_balances[call.fn_args[0]] for call in calls[2:]]
+
+        tokens = (PoolToken(0, '0xtoken0', 'WBTC', 8), PoolToken(1, '0xtoken1', 'WETH', 18))
+        with (
+            mock.patch.object(v2, 'get_pool_tokens', return_value=tokens),
+            mock.patch.object(
+                v2, 'contract_calls_at_block', side_effect=fake_contract_calls
+            ) as contract_calls,
+            # the specs' blocks are already pinned
+            mock.patch.object(v2, 'pin_block_no', side_effect=AssertionError("pinned again")),
+        ):
+            snapshots = get_snapshots(v2_specs)
+
+        # one batch per pool, with every wallet in the pool's batch
+        self.assertEqual(contract_calls.call_count, 2)
+        self.assertEqual([snapshot.num_lp_tokens for snapshot in snapshots], [10, Decimal('0.5'), 25, 65])
+        self.assertEqual(
+            [snapshot.num_token0_underlying for snapshot in snapshots], [10, Decimal('0.5'), 25, 65]
+        )
+        self.assertEqual(
+            [snapshot.num_token1_underlying for snapshot in snapshots], [20, Decimal('0.5'), 50, 130]
+        )
+
+    def test_specs_grouped_by_pool_and_block(self):
+        self.evaluate_specs(v2.get_underlying_balances_for_specs)
+
+    def test_threaded_groups_keep_spec_order(self):
+        self.evaluate_specs(lambda v2_specs: report_runner.threaded_v2_snapshots(v2_specs, 2))
+
+
+class V2SeriesUnitCase(unittest.TestCase):
+    def test_pool_state_rebuilt_from_events(self):
+        holder = '0x0000000000000000000000000000000000000001'
+        zero_address = v2_series.ZERO_ADDRESS
+        events = [
+            logs.DecodedLog(
+                'Transfer', '0xpool', 103, 0, {'from': zero_address, 'to': holder, 'value': 10**18}
+            ),
+            logs.DecodedLog('Sync', '0xpool', 103, 1, {'reserve0': 2 * 10**8, 'reserve1': 4 * 10**18}),
+            logs.DecodedLog('Transfer', '0xpool', 105, 0, {'from': holder, 'to': '0xpool', 'value': 10**18}),
+            logs.DecodedLog(
+                'Transfer', '0xpool', 106, 0, {'from': '0xpool', 'to': zero_address, 'value': 10**18}
+            ),
+            logs.DecodedLog('Sync', '0xpool', 106, 1, {'reserve0': 10**8, 'reserve1': 2 * 10**18}),
+        ]
+        tokens = (PoolToken(0, '0xtoken0', 'WBTC', 8), PoolToken(1, '0xtoken1', 'WETH', 18))
+        with (
+            mock.patch.object(v2_series, 'get_pool_tokens', return_value=tokens),
+            mock.patch.object(
+                v2_series, 'contract_calls_at_block', return_value=[10**18, (10**8, 2 * 10**18, 0)]
+            ) as contract_calls,
+            mock.patch.object(v2_series, 'get_decoded_logs', return_value=events),
+        ):
+            series_df = v2_series.get_underlying_balances_series(
+                'ethereum', '0xpool', Decimal('0.5'), 100, 107
+            )
+
+        self.assertEqual(contract_calls.call_args.args[2], 100)
+        self.assertEqual(list(series_df['block']), list(range(100, 108)))
+        self.assertEqual(list(series_df['total_supply']), [1, 1, 1, 2, 2, 2, 1, 1])
+        self.assertEqual(list(series_df['token0_reserves']), [1, 1, 1, 2, 2, 2, 1, 1])
+        self.assertEqual(list(series_df['token1_underlying']), [1, 1, 1, 1, 1, 1, 1, 1])
+
+    def test_log_chunks_adapt_to_provider_limits(self):
+        requested_ranges = []
+
+        def fake_get_logs(filter_params):
+            block_range = filter_params['toBlock'] - filter_params['fromBlock'] + 1
+            requested_ranges.append(block_range)
+            if block_range > 1500:
+                raise ValueError("query exceeds max block range 1500")
+            return [{'blockNumber': filter_params['fromBlock']}]
+
+        w3_provider = mock.Mock()
+        w3_provider.eth.get_logs.side_effect = fake_get_logs
+        with (
+            mock.patch.object(logs, 'get_w3_provider', return_value=w3_provider),
+            mock.patch.object(
+                logs, 'call_with_retries', side_effect=lambda chain, endpoint, request: request()
+            ),
+        ):
+            chunk_logs = logs.get_logs(
+                'ethereum', '0x88e6A0c2dDD26FEEb64F039a2c41296FcB3f5640', [], 1, 10_000
+            )
+
+        # rejected once, then held to half of the rejected range
+        self.assertEqual(requested_ranges[:3], [2000, 1000, 1000])
+        self.assertEqual(max(requested_ranges[2:]), 1000)
+        self.assertEqual([log['blockNumber'] for log in chunk_logs], list(range(1, 10_001, 1000)))
+
+
+class V3SeriesUnitCase(unittest.TestCase):
+    def test_position_rebuilt_from_events(self):
+        tokens = (PoolToken(0, '0xtoken0', 'A', 18), PoolToken(1, '0xtoken1', 'B', 18))
+        seed_state = pool_state.V3PoolState(
+            'ethereum', '0xpool', 100, v3_math.get_sqrt_ratio_at_tick(0), 0, 10**20, 60, *tokens
+        )
+        far_above = v3_math.get_sqrt_ratio_at_tick(120)
+
+        def swap(block_number, log_index, sqrt_price_x96, tick):
+            return logs.DecodedLog(
+                'Swap', '0xpool', block_number, log_index, {'sqrtPriceX96': sqrt_price_x96, 'tick': tick}
+            )
+
+        events = {
+            '0xpool': [swap(102, 0, far_above, 120), swap(104, 0, far_above, 120), swap(104, 1, 2**96, 0)],
+            '0xnft': [
+                logs.DecodedLog('IncreaseLiquidity', '0xnft', 103, 0, {'liquidity': 10**18}),
+                logs.DecodedLog('DecreaseLiquidity', '0xnft', 105, 0, {'liquidity': 2 * 10**18}),
+            ],
+        }
+
+        def fake_decoded_logs(_, address, __, from_block, to_block, *indexed_topics):
+            self.assertEqual((from_block, to_block), (101, 105))
+            if address == '0xnft':
+                self.assertEqual(indexed_topics, ([f'0x{7:064x}'],))
+            return events[address]
+
+        with (
+            mock.patch.object(v3_series, 'get_v3_pool_state', return_value=seed_state),
+            mock.patch.object(
+                v3_series, 'contract_calls_at_block', return_value=[[0, '0x0', '', '', 3000, -60, 60, 10**18]]
+            ),
+            mock.patch.object(v3_series, 'get_decoded_logs', side_effect=fake_decoded_logs),
+        ):
+            series_df = v3_series.get_underlying_balances_series('ethereum', '0xpool', '0xnft', 7, 100, 105)
+
+        self.assertEqual(list(series_df['block']), list(range(100, 106)))
+        self.assertEqual(list(series_df['tick']), [0, 0, 120, 120, 0, 0])
+        self.assertEqual(list(series_df['liquidity']), [10**18, 10**18, 10**18, 2 * 10**18, 2 * 10**18, 0])
+        # out of range above the position it is all token1
+        self.assertEqual(list(series_df['token0_underlying'])[2:4], [0, 0])
+        token0_amount, token1_amount = v3_math.get_amounts_for_liquidity(0, 2**96, -60, 60, 2 * 10**18)
+        self.assertAlmostEqual(series_df['token0_underlying'][4], float(token0_amount) / 10**18, places=9)
+        self.assertAlmostEqual(series_df['token1_underlying'][4], float(token1_amount) / 10**18, places=9)
+        self.assertEqual(series_df['token1_underlying'][5], 0)
+
+
+class V2HoldersUnitCase(unittest.TestCase):
+    def test_holders_rebuilt_from_transfers(self):
+        zero_address = v2_holders.ZERO_ADDRESS
+        alice, bob, pool = (f'0x{i:040x}' for i in range(1, 4))
+
+        def transfer(block_number, sender, recipient, value):
+            return logs.DecodedLog(
+                'Transfer', pool, block_number, 0, {'from': sender, 'to': recipient, 'value': value}
+            )
+
+        transfers = [
+            transfer(10, zero_address, zero_address, 1000),
+            transfer(10, zero_address, alice, 3 * 10**18),
+            transfer(11, zero_address, bob, 10**18),
+            transfer(12, alice, bob, 10**18),
+            # a burn sends the LP tokens to the pool, which burns them
+            transfer(13, bob, pool, 10**18),
+            transfer(13, pool, zero_address, 10**18),
+        ]
+        tokens = (PoolToken(0, '0xtoken0', 'WBTC', 8), PoolToken(1, '0xtoken1', 'WETH', 18))
+        with (
+            mock.patch.object(v2_holders, 'get_pool_tokens', return_value=tokens),
+            mock.patch.object(
+                v2_holders,
+                'contract_calls_at_block',
+                return_value=[3 * 10**18 + 1000, (3 * 10**8, 6 * 10**18, 0)],
+            ),
+            mock.patch.object(v2_holders, 'get_decoded_logs', return_value=transfers),
+            mock.patch.object(
+                v2_holders, 'get_pool_creation_block', return_value=10
+            ) as get_pool_creation_block,
+            self.assertNoLogs(v2_holders.logger, level='WARNING'),
+        ):
+            holders_df = v2_holders.get_lp_holder_breakdown('ethereum', pool, 20)
+
+        self.assertEqual(get_pool_creation_block.call_args.args, ('ethereum', pool, 20))
+        self.assertEqual(list(holders_df['holder']), [alice, bob])
+        self.assertEqual(list(holders_df['lp_balance']), [2, 1])
+        np.testing.assert_allclose(holders_df['token0_underlying'], [2, 1])
+        np.testing.assert_allclose(holders_df['token1_underlying'], [4, 2])
+
+    def test_creation_block_found_by_bisection(self):
+        with mock.patch.object(
+            web3_utils, 'has_code_at_block', side_effect=lambda chain, address, block_no: block_no >= 12_345
+        ) as has_code_at_block:
+            self.assertEqual(web3_utils.find_creation_block('ethereum', '0xpool', 20_000_000), 12_345)
+        self.assertLessEqual(has_code_at_block.call_count, 26)
+
+
+class AsyncReportUnitCase(unittest.TestCase):
+    def test_async_report_keeps_config_order_and_concurrency_limit(self):
+        v2_specs = [
+            V2PositionSpec(chain, f'0x{i:040x}', None, Decimal(i + 1), None)
+            for i, chain in enumerate(['ethereum', 'arbitrum'] * 4)
+        ]
+        in_flight: Dict[str, int] = {}
+        max_in_flight: Dict[str, int] = {}
+
+        async def fake_v2_position_snapshot(v2_spec):
+            in_flight[v2_spec.chain] = in_flight.get(v2_spec.chain, 0) + 1
+            max_in_flight[v2_spec.chain] = max(max_in_flight.get(v2_spec.chain, 0), in_flight[v2_spec.chain])
+            # later positions finish first
+            await asyncio.sleep(0.01 / float(v2_spec.lp_balance))
+            in_flight[v2_spec.chain] -= 1
+            return v2.V2LiquiditySnapshot(
+                v2_spec.chain, None, v2_spec.lp_balance, None, Decimal(0), None, Decimal(0)
+            )
+
+        with mock.patch.object(report_runner, 'async_v2_position_snapshot', fake_v2_position_snapshot):
+            report_dict = asyncio.run(
+                report_runner.async_position_report_entries(PositionSpecs(v2_specs, []), 2)
+            )
+
+        self.assertEqual(
+            [entry['position_spec']['pool_address'] for entry in report_dict['V2 Positions']],
+            [v2_spec.pool_address for v2_spec in v2_specs],
+        )
+        self.assertEqual(report_dict['V3 Positions'], [])
+        self.assertEqual(max_in_flight, {'ethereum': 2, 'arbitrum': 2})
+
+
+class ThreadedReportUnitCase(unittest.TestCase):
+    def test_threaded_report_keeps_config_order_and_worker_limit(self):
+        v3_specs = [
+            V3PositionSpec(chain, f'0x{i:040x}', '0xC36442b4a4522E871399CD717aBDD847Ab11FE88', i + 1, None)
+            for i, chain in enumerate(['ethereum', 'arbitrum'] * 4)
+        ]
+        in_flight: Dict[str, int] = {}
+        max_in_flight: Dict[str, int] = {}
+        in_flight_lock = threading.Lock()
+
+        def fake_v3_position_snapshot(v3_spec):
+            with in_flight_lock:
+                in_flight[v3_spec.chain] = in_flight.get(v3_spec.chain, 0) + 1
+                max_in_flight[v3_spec.chain] = max(
+                    max_in_flight.get(v3_spec.chain, 0), in_flight[v3_spec.chain]
+                )
+            # later positions finish first
+            time.sleep(0.02 / v3_spec.nft_id)
+            with in_flight_lock:
+                in_flight[v3_spec.chain] -= 1
+            return v2.V2LiquiditySnapshot(v3_spec.chain, None, Decimal(0), None, Decimal(0), None, Decimal(0))
+
+        entries = report_runner.threaded_position_report_entries(v3_specs, fake_v3_position_snapshot, 2)
+
+        self.assertEqual([entry['position_spec']['nft_id'] for entry in entries], list(range(1, 9)))
+        self.assertLessEqual(max(max_in_flight.values()), 2)
+
+
+class RateLimitUnitCase(unittest.TestCase):
+    def test_token_bucket_queues_and_adapts_to_throttling(self):
+        limiter = rate_limit.RateLimiter('test rpc', 10.0)
+        delays = [limiter.reserve() for _ in range(12)]
+        self.assertEqual(delays[:10], [0.0] * 10)
+        self.assertGreater(delays[11], delays[10])
+        self.assertLess(delays[11], 0.25)
+
+        limiter.record_throttle()
+        self.assertEqual(limiter.rate, 5.0)
+        for _ in range(100):
+            limiter.record_throttle()
+        self.assertEqual(limiter.rate, limiter.min_rate)
+        for _ in range(100):
+            limiter.record_success()
+        self.assertEqual(limiter.rate, 10.0)
+
+    def test_retries_throttled_requests_only(self):
+        limiter = rate_limit.RateLimiter('test rpc', 1000.0)
+        rate_limit.rate_limiters[('test', 'rpc')] = limiter
+        throttled_response = requests.Response()
+        throttled_response.status_code = 429
+        responses = [requests.HTTPError(response=throttled_response), requests.Timeout(), 'ok']
+
+        def flaky_request():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        with mock.patch.object(rate_limit.time, 'sleep'):
+            self.assertEqual(rate_limit.call_with_retries('test', 'rpc', flaky_request), 'ok')
+            self.assertEqual(limiter.rate, 500.0 + 1000.0 * rate_limit.RATE_INCREASE_FRACTION)
+
+            def reverting_request():
+                raise ContractLogicError('execution reverted')
+
+            with self.assertRaises(ContractLogicError):
+                rate_limit.call_with_retries('test', 'rpc', reverting_request)
+
+
+class PinBlocksUnitCase(unittest.TestCase):
+    def test_head_resolved_once_per_chain(self):
+        nft_address = '0xC36442b4a4522E871399CD717aBDD847Ab11FE88'
+        position_specs = PositionSpecs(
+            v2_positions=[
+                V2PositionSpec('ethereum', '0x01', None, Decimal(1), None),
+                V2PositionSpec('arbitrum', '0x02', None, Decimal(1), 100),
+            ],
+            v3_positions=[
+                V3PositionSpec('ethereum', '0x03', nft_address, 1, None),
+                V3PositionSpec('arbitrum', '0x04', nft_address, 2, None),
+            ],
+            v3_owner_positions=[V3OwnerPositionSpec('ethereum', '0x05', nft_address, None)],
+        )
+        head_blocks = {'ethereum': 17485966, 'arbitrum': 101674590}
+
+        with mock.patch.object(
+            report_runner, 'pin_block_no', side_effect=lambda chain, _: head_blocks[chain]
+        ) as pin_block_no:
+            pinned_specs = report_runner.pin_position_blocks(position_specs)
+
+        self.assertEqual(pin_block_no.call_count, 2)
+        self.assertEqual([v2_spec.block_no for v2_spec in pinned_specs.v2_positions], [17485966, 100])
+        self.assertEqual([v3_spec.block_no for v3_spec in pinned_specs.v3_positions], [17485966, 101674590])
+        self.assertEqual(pinned_specs.v3_owner_positions[0].block_no, 17485966)